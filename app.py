@@ -8,6 +8,7 @@ from flask_caching import Cache
 import dash
 import dash_auth
 import dash_bootstrap_components as dbc
+import dataset
 import settings
 from jinja2 import Environment, FileSystemLoader
 
@@ -62,6 +63,21 @@ if credentials:
     app.server.view_functions["static"] = app.server.send_static_file
 
 
+@server.route("/healthz")
+def healthz():
+    return "OK"
+
+
+@server.route("/ready")
+def ready():
+    """Respond with an error until the data has been loaded, so that load
+    balancers only send requests to workers which can answer them quickly
+    """
+    if not dataset.is_ready():
+        return "Loading data", 503
+    return "OK"
+
+
 @server.route("/")
 def index():
     return render_template("index.html")
@@ -118,6 +134,9 @@ VALID_KEYS = {
     "ccg_ids_for_practice_filter",
     "result_filter",
     "by",
+    "month_from",
+    "month_to",
+    "granularity",
     "sort_by",
 }
 
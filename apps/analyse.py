@@ -1,13 +1,19 @@
+import json
 import logging
 
 
+import dash
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import plotly.graph_objs as go
 
 from app import app
+from apps.base import get_count_data_for_state
 from apps.base import get_yaxis_label
+from apps.heatmap import get_heatmap_figure
 from apps.linecharts import get_chart_components
 from stateful_routing import get_state
+from stateful_routing import get_state_from_url
 import settings
 
 
@@ -15,16 +21,61 @@ logger = logging.getLogger(__name__)
 
 
 @app.callback(
-    Output("deciles-graph", "figure"),
-    [Input("page-state", "children")],
-    [State("url-for-update", "search")],
+    [
+        Output("deciles-graph", "figure"),
+        Output("heatmap-graph", "figure"),
+        Output("charts-state", "children"),
+    ],
+    [
+        Input("url-from-user", "pathname"),
+        Input("url-from-user", "search"),
+        Input("tweak-form", "value"),
+        Input("sort-order-dropdown", "value"),
+    ],
+    [State("charts-state", "children")],
 )
-def update_deciles(page_state, current_qs):
-    page_state = get_state(page_state)
+def update_charts(pathname, query_string, tweak_form, sort_order, charts_state):
+    """Update the deciles chart and the heatmap, which show the same data, so
+    that it's only fetched once
+
+    The charts are rendered straight from the URL, which follows every change
+    to the page state, rather than from the page state. Dash holds a
+    callback back until every callback upstream of its inputs has run, so
+    this way a URL from the user is rendered after one request, rather than
+    once the inputs and the page state have caught up with it. The state the
+    charts were last rendered for is kept in `charts-state`, so that they're
+    only rendered again when it changes.
+    """
+    if not pathname:
+        raise PreventUpdate
+    page_state = get_state_from_url(pathname, query_string)
+    tweak_form = tweak_form or []
+    page_state["sparse_data_toggle"] = "suppress_sparse_data" in tweak_form
+    page_state["equalise_colorscale"] = "equalise_colours" in tweak_form
+    state = {
+        "page_state": {k: v for k, v in page_state.items() if k != "update_counter"},
+        "sort_order": sort_order,
+    }
+    last_state = get_state(charts_state)
+    if state == last_state:
+        raise PreventUpdate
 
     if page_state.get("page_id") != settings.CHART_ID:
-        return settings.EMPTY_CHART_LAYOUT
-    components = get_chart_components(page_state)
+        return settings.EMPTY_CHART_LAYOUT, {}, json.dumps(state)
+    trace_df = get_count_data_for_state(page_state)
+    # Only the heatmap depends on the sort order
+    if state["page_state"] != last_state.get("page_state"):
+        deciles_figure = get_deciles_figure(page_state, trace_df)
+    else:
+        deciles_figure = dash.no_update
+    heatmap_figure = get_heatmap_figure(
+        page_state, trace_df, query_string or "", sort_order
+    )
+    return deciles_figure, heatmap_figure, json.dumps(state)
+
+
+def get_deciles_figure(page_state, trace_df):
+    components = get_chart_components(page_state, trace_df)
     if components:
         traces, title, annotations = components
         if traces:
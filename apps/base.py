@@ -1,6 +1,7 @@
 """Callbacks that apply to all pages
 """
 from data import get_all_entity_ids
+from data import get_count_data
 from data import get_test_code_to_name_map
 from data import get_entity_label_to_id_map
 from data import humanise_entity_name
@@ -207,3 +208,24 @@ def get_yaxis_label(page_state):
     else:
         yaxis_label = "proportion"
     return yaxis_label
+
+
+def get_count_data_for_state(page_state):
+    """Return the count data (see `data.get_count_data`) for the query
+    described by `page_state`, which the charts on the analysis page all show
+    """
+    return get_count_data(
+        numerators=page_state.get("numerators", []),
+        denominators=page_state.get("denominators", []),
+        result_filter=page_state.get("result_filter", []),
+        lab_ids_for_practice_filter=page_state.get("lab_ids_for_practice_filter", []),
+        ccg_ids_for_practice_filter=page_state.get("ccg_ids_for_practice_filter", []),
+        practice_ids_for_practice_filter=page_state.get(
+            "practice_ids_for_practice_filter", []
+        ),
+        by=page_state.get("groupby", None),
+        hide_entities_with_sparse_data=page_state.get("sparse_data_toggle"),
+        month_from=page_state.get("month_from"),
+        month_to=page_state.get("month_to"),
+        granularity=page_state.get("granularity"),
+    )
@@ -31,6 +31,9 @@ def update_datatable(page_state, page_current, page_size, sort_by):
         ccg_ids_for_practice_filter=page_state.get("ccg_ids_for_practice_filter", []),
         lab_ids_for_practice_filter=page_state.get("lab_ids_for_practice_filter", []),
         by=page_state.get("groupby", None),
+        month_from=page_state.get("month_from"),
+        month_to=page_state.get("month_to"),
+        granularity=page_state.get("granularity"),
         page_current=page_current,
         page_size=page_size,
         sort_by=sort_by,
@@ -59,6 +62,9 @@ def update_datatable_download_link(page_state, sort_by):
             "lab_ids_for_practice_filter", []
         ),
         "by": page_state.get("groupby", None),
+        "month_from": page_state.get("month_from"),
+        "month_to": page_state.get("month_to"),
+        "granularity": page_state.get("granularity"),
         "sort_by": sort_by,
     }
 
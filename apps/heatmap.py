@@ -1,35 +1,39 @@
 import logging
+import math
 import urllib
 
 import plotly.graph_objs as go
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output
 
 from app import app
 from apps.base import get_title_fragment, initial_capital, humanise_column_name
 
 import numpy as np
 
-import matplotlib
-import matplotlib.cm
-
-from data import get_count_data
 from data import humanise_entity_name
 from stateful_routing import get_state
+from colormaps import get_colorscale_divisions
+from colormaps import get_colormap_rgb_codes
+from store import MONTHS_PER_PERIOD
 import settings
 
 logger = logging.getLogger(__name__)
 
 
-def sort_by_index(df, ascending=True):
+def sort_by_index(df, ascending=True, num_periods=6):
     """Compute a sort order for the practice charts, based on the mean
-    calc_value of the last 6 months.
+    calc_value of the last `num_periods` periods (by default, 6 months).
 
     Note that we sort in ascending order, because the origin of a
     heatmap is bottom left, and we want the highest values at the top.
 
     """
     return df.reindex(
-        df.fillna(0).iloc[:, -6:].mean(axis=1).sort_values(ascending=ascending).index,
+        df.fillna(0)
+        .iloc[:, -num_periods:]
+        .mean(axis=1)
+        .sort_values(ascending=ascending)
+        .index,
         axis=0,
     )
 
@@ -40,16 +44,10 @@ def get_colorscale(values, cmap):
     distributed evenly across all colour values in that cmap.
 
     """
-    num_divisions = 20
-    divisions = np.append(np.arange(0, 1, 1 / num_divisions), 1)
-
-    # Generate RGB codes for `num_divisions` equally spaced points
-    # across the colormap
-    cmap = matplotlib.cm.get_cmap(cmap)
-    cmap_points = [list(map(np.uint8, np.array(cmap(x)[:3]) * 255)) for x in divisions]
-    cmap_rgb_codes = [f"rgb({x[0]},{x[1]},{x[2]})" for x in cmap_points]
+    divisions = get_colorscale_divisions()
+    cmap_rgb_codes = get_colormap_rgb_codes(cmap)
 
-    # Find values at `num_divisions` percentiles, normalised to range 0 - 1
+    # Find values at the percentile for each division, normalised to range 0 - 1
     values = sorted(values[~np.isnan(values)])
     max_value = max(values)
     percentiles = [
@@ -61,20 +59,10 @@ def get_colorscale(values, cmap):
     return scale
 
 
-@app.callback(
-    Output("heatmap-graph", "figure"),
-    [
-        Input("page-state", "children"),
-        Input("url-for-update", "search"),
-        Input("sort-order-dropdown", "value"),
-    ],
-    [State("deciles-graph", "figure")],
-)
-def update_heatmap(page_state, current_qs, sort_order, current_fig):
+def get_heatmap_figure(page_state, trace_df, current_qs, sort_order):
+    """Return the heatmap figure for `page_state`, given its count data
+    """
     EMPTY_RESPONSE = settings.EMPTY_CHART_LAYOUT
-    page_state = get_state(page_state)
-    if page_state.get("page_id") != settings.CHART_ID:
-        return {}
     query_string = urllib.parse.parse_qs(current_qs[1:])
     highlight_entities = set(query_string.get("highlight_entities", []))
     numerators = page_state.get("numerators", [])
@@ -82,26 +70,16 @@ def update_heatmap(page_state, current_qs, sort_order, current_fig):
     result_filter = page_state.get("result_filter", [])
     groupby = page_state.get("groupby", None)
     equalise_colorscale = page_state.get("equalise_colorscale", None)
-    ccg_ids_for_practice_filter = page_state.get("ccg_ids_for_practice_filter", [])
-    lab_ids_for_practice_filter = page_state.get("lab_ids_for_practice_filter", [])
-    practice_ids_for_practice_filter = page_state.get(
-        "practice_ids_for_practice_filter", []
-    )
     col_name = groupby
-    trace_df = get_count_data(
-        numerators=numerators,
-        denominators=denominators,
-        result_filter=result_filter,
-        lab_ids_for_practice_filter=lab_ids_for_practice_filter,
-        ccg_ids_for_practice_filter=ccg_ids_for_practice_filter,
-        practice_ids_for_practice_filter=practice_ids_for_practice_filter,
-        by=col_name,
-        hide_entities_with_sparse_data=page_state.get("sparse_data_toggle"),
-    )
     if trace_df.empty:
         return EMPTY_RESPONSE
 
-    vals_by_entity = sort_results(trace_df, col_name, sort_order=sort_order)
+    vals_by_entity = sort_results(
+        trace_df,
+        col_name,
+        sort_order=sort_order,
+        granularity=page_state.get("granularity"),
+    )
 
     if equalise_colorscale:
         colorscale = get_colorscale(
@@ -176,14 +154,20 @@ def update_heatmap(page_state, current_qs, sort_order, current_fig):
     }
 
 
-def sort_results(trace_df, col_name, sort_order=None):
-    if not sort_order:
+def sort_results(trace_df, col_name, sort_order=None, granularity=None):
+    # The sort order isn't reset when it stops being one of the options (see
+    # `update_sort_order_options`), as the heatmap would then have to wait
+    # for the page state before it could be rendered
+    if not sort_order or sort_order == "ccg" and col_name != "practice_id":
         sort_order = "mean_six_month_asc"
     if sort_order in ("mean_six_month_asc", "mean_six_month_desc"):
         ascending = sort_order == "mean_six_month_asc"
+        # Use the periods covering the last 6 months
+        months_per_period = MONTHS_PER_PERIOD[granularity or "month"]
         return sort_by_index(
             trace_df.pivot(index=col_name, columns="month", values="calc_value"),
             ascending=ascending,
+            num_periods=math.ceil(6 / months_per_period),
         )
     elif sort_order == "ccg":
         df = trace_df.pivot_table(
@@ -199,11 +183,9 @@ def sort_results(trace_df, col_name, sort_order=None):
 
 
 @app.callback(
-    [Output("sort-order-dropdown", "options"), Output("sort-order-dropdown", "value")],
-    [Input("page-state", "children")],
-    [State("sort-order-dropdown", "value")],
+    Output("sort-order-dropdown", "options"), [Input("page-state", "children")]
 )
-def update_sort_order_options(page_state, current_value):
+def update_sort_order_options(page_state):
     page_state = get_state(page_state)
     # Note that asc/desc are deliberately reversed below because we naturally
     # read the heatmap top-to-bottom but it's defined bottom-to-top
@@ -220,14 +202,7 @@ def update_sort_order_options(page_state, current_value):
 
     if page_state.get("groupby", None) == "practice_id":
         options.append({"value": "ccg", "label": "Sort by CCG"})
-
-    # If the current value isn't one of the available options replace it with
-    # the first available option
-    value = current_value
-    if not any(option["value"] == value for option in options):
-        value = options[0]["value"]
-
-    return options, value
+    return options
 
 
 @app.callback(
@@ -7,11 +7,11 @@ import pandas as pd
 import plotly.graph_objs as go
 
 import numpy as np
+from apps.base import get_count_data_for_state
 from apps.base import get_title, filter_entity_ids_for_type
 from apps.base import humanise_column_name
 from apps.base import linebreakify
 from data import humanise_entity_name
-from data import get_count_data
 
 import settings
 
@@ -71,7 +71,7 @@ def get_decile_traces(
     return deciles_traces
 
 
-def get_chart_components(page_state):
+def get_chart_components(page_state, trace_df=None):
     """Given current page state, return all the bits you need to assemble
     a plotly figure:
 
@@ -79,6 +79,9 @@ def get_chart_components(page_state):
     pointers on what to do next; and an array annotations used for
     explaining the legend.
 
+    `trace_df` is the count data for the page state, which is fetched if
+    not supplied.
+
     """
     numerators = page_state.get("numerators", [])
     denominators = page_state.get("denominators", [])
@@ -86,20 +89,9 @@ def get_chart_components(page_state):
     groupby = page_state.get("groupby", None)
     ccg_ids_for_practice_filter = page_state.get("ccg_ids_for_practice_filter", [])
     lab_ids_for_practice_filter = page_state.get("lab_ids_for_practice_filter", [])
-    practice_ids_for_practice_filter = page_state.get(
-        "practice_ids_for_practice_filter", []
-    )
 
-    trace_df = get_count_data(
-        numerators=numerators,
-        denominators=denominators,
-        result_filter=result_filter,
-        lab_ids_for_practice_filter=lab_ids_for_practice_filter,
-        ccg_ids_for_practice_filter=ccg_ids_for_practice_filter,
-        practice_ids_for_practice_filter=practice_ids_for_practice_filter,
-        by=groupby,
-        hide_entities_with_sparse_data=page_state.get("sparse_data_toggle"),
-    )
+    if trace_df is None:
+        trace_df = get_count_data_for_state(page_state)
     if trace_df.empty:
         return [], "", ""
 
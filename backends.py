@@ -0,0 +1,459 @@
+"""Backends which answer queries about the processed data for `data.py`.
+
+A backend filters the processed data, sums counts and errors over groups of
+the filtered rows, and lists the distinct values of a column. Each backend
+returns exactly the same DataFrames, with the types given by the schema
+written by the pipeline.
+
+`PandasBackend` holds the whole dataset in memory. `SQLiteBackend` runs
+queries against the database written by `flask build_sqlite`, so workers
+using it never need to load the dataset at all. `ShardedBackend` splits the
+dataset by lab across worker processes, which each answer the query for
+their own labs in parallel, and merges their partial results.
+
+Filters are the same for every method: `test_codes`, `lab_ids`, `ccg_ids`
+and `practice_ids` restrict rows to those with one of the given values (when
+supplied), `month_from` and `month_to` restrict rows to that range of months
+(inclusive), and `result_filter_query` is a condition on `result_category` as
+returned by `data.get_result_filter_query`. These conditions are written in
+a syntax which both pandas' `query` and SQLite understand.
+
+Raw rows are returned in month order, and are indexed by their position in
+the data as it was read from the store. Aggregates can be summed by month, or
+by quarter or year (see `store.MONTHS_PER_PERIOD`) from data rolled up into
+those periods in advance, in which case the `month` of each group is the
+first month of its period.
+
+"""
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from pandas.api.types import CategoricalDtype
+
+import store
+
+
+# The column restricted by each filter
+FILTER_COLUMNS = {
+    "test_codes": "test_code",
+    "lab_ids": "lab_id",
+    "ccg_ids": "ccg_id",
+    "practice_ids": "practice_id",
+}
+
+
+class PandasBackend:
+    """Answer queries using DataFrames held in memory
+
+    `get_data` returns the compact processed data given a sample size (see
+    `store.compact_processed_data`), and `get_processed_practices` returns the
+    table of practices split from it. `get_rolled_up_data` returns the data
+    rolled up into a granularity of period (see `store.roll_up`), and
+    `get_all_test_totals` returns the totals across all tests for a sample
+    size and granularity. All but the practices must be sorted by month, so
+    that we only need to look at the rows for the months we want.
+    """
+
+    def __init__(
+        self,
+        get_data,
+        get_processed_practices,
+        get_rolled_up_data,
+        get_all_test_totals,
+    ):
+        self.get_data = get_data
+        self.get_processed_practices = get_processed_practices
+        self.get_rolled_up_data = get_rolled_up_data
+        self.get_all_test_totals = get_all_test_totals
+
+    def rows(self, sample_size=None, result_filter_query=None, **filters):
+        """Return the rows of the processed data which match the filters
+        """
+        df = self._filter(self.get_data(sample_size), result_filter_query, filters)
+        return store.expand_processed_data(df, self.get_processed_practices())
+
+    def aggregate(
+        self,
+        groupby,
+        sample_size=None,
+        all_test_totals=False,
+        result_filter_query=None,
+        granularity="month",
+        **filters,
+    ):
+        """Return the total count and error of the rows which match the
+        filters, indexed by the columns in `groupby`, for each `granularity`
+        period
+
+        If `all_test_totals` is True these are summed from the totals across
+        all tests, so `groupby` must be a subset of
+        `store.ALL_TEST_TOTALS_COLUMNS` and `test_codes` can't be supplied.
+        Otherwise, for periods other than months, `groupby` must be a subset
+        of `store.ROLLUP_COLUMNS`.
+        """
+        if all_test_totals:
+            df = self.get_all_test_totals(sample_size, granularity)
+        elif granularity != "month":
+            df = self.get_rolled_up_data(granularity, sample_size)
+        else:
+            df = self.get_data(sample_size)
+        df = self._filter(df, result_filter_query, filters)
+        return store.restore_processed_types(store.sum_counts(df, groupby))
+
+    def distinct(self, column, **filters):
+        """Return the sorted distinct values of `column` in the rows which
+        match the filters
+        """
+        df = self._filter(self.get_data(), None, filters)
+        df = store.restore_processed_types(df[[column]].drop_duplicates())
+        return sorted(df[column].dropna())
+
+    def _filter(self, df, result_filter_query, filters):
+        filters = dict(filters)
+        df = store.slice_months(
+            df, filters.pop("month_from", None), filters.pop("month_to", None)
+        )
+        and_query = [
+            f"({FILTER_COLUMNS[key]}.isin({list(values)}))"
+            for key, values in filters.items()
+            if values
+        ]
+        if result_filter_query:
+            and_query.append(result_filter_query)
+        if and_query:
+            return df.query(" & ".join(and_query))
+        else:
+            return df
+
+
+class SQLiteBackend:
+    """Answer queries using the SQLite database at `path`, giving the results
+    the types in `schema` (the schema of the processed data)
+
+    The database is opened when the backend is created, so the backend
+    carries on reading the same data when the pipeline replaces the file.
+    """
+
+    def __init__(self, path, schema):
+        if not path.exists():
+            raise ValueError(f"{path} doesn't exist. Has `build_sqlite` been run?")
+        if schema is None:
+            raise ValueError("The SQLite backend requires a schema for the data")
+        self.path = path
+        self.schema = schema
+        self.connection = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+
+    def rows(self, sample_size=None, result_filter_query=None, **filters):
+        """Return the rows of the processed data which match the filters,
+        indexed by their position in the data
+        """
+        self._check_sample_size(sample_size)
+        where, params = self._where(result_filter_query, filters)
+        columns = ", ".join(f'"{column}"' for column in store.PROCESSED_COLUMNS)
+        df = self._query(
+            f"SELECT rowid - 1 AS position, {columns} FROM processed {where} "
+            'ORDER BY "month", rowid',
+            params,
+        )
+        df = df.set_index("position")
+        df.index.name = None
+        return df
+
+    def aggregate(
+        self,
+        groupby,
+        sample_size=None,
+        all_test_totals=False,
+        result_filter_query=None,
+        granularity="month",
+        **filters,
+    ):
+        """Return the total count and error of the rows which match the
+        filters, indexed by the columns in `groupby`, for each `granularity`
+        period
+
+        If `all_test_totals` is True these are summed from the totals across
+        all tests, so `groupby` must be a subset of
+        `store.ALL_TEST_TOTALS_COLUMNS` and `test_codes` can't be supplied.
+        Otherwise, for periods other than months, `groupby` must be a subset
+        of `store.ROLLUP_COLUMNS`.
+        """
+        self._check_sample_size(sample_size)
+        table = "all_test_totals" if all_test_totals else "processed"
+        if granularity != "month":
+            if granularity not in store.MONTHS_PER_PERIOD:
+                raise ValueError(granularity)
+            table += f"_{granularity}"
+        where, params = self._where(result_filter_query, filters)
+        columns = ", ".join(f'"{column}"' for column in groupby)
+        df = self._query(
+            f'SELECT {columns}, SUM("count") AS "count", SUM("error") AS "error" '
+            f"FROM {table} {where} GROUP BY {columns} ORDER BY {columns}",
+            params,
+        )
+        return df.set_index(list(groupby))
+
+    def distinct(self, column, **filters):
+        """Return the sorted distinct values of `column` in the rows which
+        match the filters
+        """
+        where, params = self._where(None, filters)
+        df = self._query(
+            f'SELECT DISTINCT "{column}" FROM processed {where} ORDER BY "{column}"',
+            params,
+        )
+        return list(df[column].dropna())
+
+    def _check_sample_size(self, sample_size):
+        if sample_size:
+            raise ValueError("The SQLite backend doesn't support sampling")
+
+    def _where(self, result_filter_query, filters):
+        filters = dict(filters)
+        conditions = []
+        params = []
+        month_from = filters.pop("month_from", None)
+        if month_from is not None:
+            conditions.append('("month" >= ?)')
+            params.append(f"{month_from:{store.DATE_FORMAT}}")
+        month_to = filters.pop("month_to", None)
+        if month_to is not None:
+            conditions.append('("month" <= ?)')
+            params.append(f"{month_to:{store.DATE_FORMAT}}")
+        for key, values in filters.items():
+            if values:
+                placeholders = ", ".join("?" for _ in values)
+                conditions.append(f'("{FILTER_COLUMNS[key]}" IN ({placeholders}))')
+                params.extend(values)
+        if result_filter_query:
+            conditions.append(result_filter_query)
+        if conditions:
+            return "WHERE " + " AND ".join(conditions), params
+        else:
+            return "", params
+
+    def _query(self, sql, params):
+        with self.lock:
+            df = pd.read_sql_query(sql, self.connection, params=params)
+        return self._apply_schema_types(df)
+
+    def _apply_schema_types(self, df):
+        for column in df.columns:
+            spec = self.schema["columns"].get(column)
+            if spec is None:
+                continue
+            if spec["type"] == "date":
+                df[column] = pd.to_datetime(df[column], format=spec["format"])
+            elif spec["type"] == "category":
+                df[column] = df[column].astype(CategoricalDtype(spec["categories"]))
+            else:
+                df[column] = df[column].astype(spec["type"])
+        return df
+
+
+class Shard:
+    """A worker process holding the partitions at `paths`, which are all the
+    partitions for `lab_ids`
+
+    The worker starts loading the partitions straight away, so it holds the
+    data as it was when the shard was created.
+    """
+
+    def __init__(self, lab_ids, paths, schema):
+        self.lab_ids = lab_ids
+        self.executor = ProcessPoolExecutor(
+            max_workers=1, initializer=_load_shard, initargs=(paths, schema)
+        )
+        self._row_count = self.executor.submit(_count_shard_rows)
+        _running_shards.add(self)
+
+    def submit(self, method, *args, **kwargs):
+        """Call `method` of a `PandasBackend` for the shard's data in the
+        worker, returning a future
+        """
+        return self.executor.submit(_call_shard, method, args, kwargs)
+
+    @property
+    def row_count(self):
+        return self._row_count.result()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+# The running shards. Each `ShardedBackend` owns its shards, which stop once
+# it (and so they) are no longer used, after finishing any queries submitted
+# to them.
+_running_shards = weakref.WeakSet()
+
+
+def start_shards(paths_by_lab, schema, num_shards):
+    """Return shards holding the partitions in `paths_by_lab` (an ordered
+    mapping of lab_id to partition paths)
+
+    Labs are divided into `num_shards` contiguous groups, in order, so that
+    the shards hold consecutive blocks of the dataset.
+    """
+    lab_ids = list(paths_by_lab)
+    num_shards = max(1, min(num_shards, len(lab_ids)))
+    size, remainder = divmod(len(lab_ids), num_shards)
+    shards = []
+    start = 0
+    for i in range(num_shards):
+        end = start + size + (1 if i < remainder else 0)
+        group = lab_ids[start:end]
+        paths = [path for lab_id in group for path in paths_by_lab[lab_id]]
+        shards.append(Shard(group, paths, schema))
+        start = end
+    return shards
+
+
+def shutdown_shards():
+    """Stop all running shards
+    """
+    for shard in list(_running_shards):
+        shard.shutdown()
+
+
+class ShardedBackend:
+    """Answer queries by scattering them across shards, each holding the data
+    for some of the labs in the processed data store, and merging their
+    partial results
+
+    Group sums are summed again across shards, so any grouping can be merged,
+    and raw rows are concatenated in the order of the full dataset.
+    """
+
+    def __init__(self, partition_paths, schema, num_shards):
+        if not partition_paths:
+            raise ValueError("The sharded backend requires a processed data store")
+        if schema is None:
+            raise ValueError("The sharded backend requires a schema for the data")
+        paths_by_lab = OrderedDict()
+        for path in partition_paths:
+            paths_by_lab.setdefault(path.parent.name, []).append(path)
+        self.shards = start_shards(paths_by_lab, schema, num_shards)
+
+    def rows(self, sample_size=None, result_filter_query=None, **filters):
+        """Return the rows of the processed data which match the filters,
+        indexed by their position in the data
+        """
+        self._check_sample_size(sample_size)
+        # Each shard holds a consecutive block of the dataset
+        offsets = {}
+        offset = 0
+        for shard in self.shards:
+            offsets[shard] = offset
+            offset += shard.row_count
+        frames = []
+        for shard, future in self._scatter(
+            "rows", filters, result_filter_query=result_filter_query, **filters
+        ):
+            df = future.result()
+            df.index += offsets[shard]
+            frames.append(df)
+        # Rows with the same month are in order of position within each shard,
+        # and the shards are in order of position, so a stable sort puts them
+        # all in order
+        return store.sort_by_month(pd.concat(frames))
+
+    def aggregate(
+        self,
+        groupby,
+        sample_size=None,
+        all_test_totals=False,
+        result_filter_query=None,
+        granularity="month",
+        **filters,
+    ):
+        """Return the total count and error of the rows which match the
+        filters, indexed by the columns in `groupby`, for each `granularity`
+        period
+
+        If `all_test_totals` is True these are summed from the totals across
+        all tests, so `groupby` must be a subset of
+        `store.ALL_TEST_TOTALS_COLUMNS` and `test_codes` can't be supplied.
+        Otherwise, for periods other than months, `groupby` must be a subset
+        of `store.ROLLUP_COLUMNS`.
+        """
+        self._check_sample_size(sample_size)
+        frames = [
+            future.result().reset_index()
+            for _, future in self._scatter(
+                "aggregate",
+                filters,
+                groupby,
+                all_test_totals=all_test_totals,
+                result_filter_query=result_filter_query,
+                granularity=granularity,
+                **filters,
+            )
+        ]
+        df = pd.concat(frames, ignore_index=True)
+        return df.groupby(list(groupby), observed=True)[["count", "error"]].sum()
+
+    def distinct(self, column, **filters):
+        """Return the sorted distinct values of `column` in the rows which
+        match the filters
+        """
+        values = set()
+        for _, future in self._scatter("distinct", filters, column, **filters):
+            values.update(future.result())
+        return sorted(values)
+
+    def _scatter(self, method, filters, *args, **kwargs):
+        """Call `method` on each shard which could have rows matching
+        `filters`, returning (shard, future) pairs in shard order
+        """
+        shards = self.shards
+        lab_ids = filters.get("lab_ids")
+        if lab_ids:
+            shards = [
+                shard for shard in shards if set(shard.lab_ids) & set(lab_ids)
+            ] or shards[:1]
+        futures = [shard.submit(method, *args, **kwargs) for shard in shards]
+        return list(zip(shards, futures))
+
+    def _check_sample_size(self, sample_size):
+        if sample_size:
+            raise ValueError("The sharded backend doesn't support sampling")
+
+
+# The data for the shard running in this worker process
+_shard_backend = None
+
+
+def _load_shard(paths, schema):
+    global _shard_backend
+    df = store.sort_by_month(store.read_partitions(paths, schema, check=False))
+    practices = store.get_processed_practices(df)
+    df = store.compact_processed_data(df)
+    rollups = {
+        granularity: store.roll_up(df, granularity)
+        for granularity in store.MONTHS_PER_PERIOD
+        if granularity != "month"
+    }
+    totals = {"month": store.total_all_tests(df)}
+    for granularity, rollup in rollups.items():
+        totals[granularity] = store.total_all_tests(rollup)
+    _shard_backend = PandasBackend(
+        lambda sample_size=None: df,
+        lambda: practices,
+        lambda granularity, sample_size=None: rollups[granularity],
+        lambda sample_size=None, granularity="month": totals[granularity],
+    )
+
+
+def _call_shard(method, args, kwargs):
+    return getattr(_shard_backend, method)(*args, **kwargs)
+
+
+def _count_shard_rows():
+    return len(_shard_backend.get_data())
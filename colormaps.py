@@ -0,0 +1,73 @@
+"""Colours for the heatmap's colorscales, taken from matplotlib's colormaps
+
+matplotlib takes longer to import than the rest of the app put together, so
+we keep the colours of the colormaps we use (see `settings.COLORSCALE`) in
+this module, and only import it for any others.
+
+"""
+import numpy as np
+
+
+# The number of colours in each colorscale, less one
+NUM_COLORSCALE_DIVISIONS = 20
+
+# The RGB codes given by `compute_colormap_rgb_codes` for the colormaps we
+# use, so that workers don't need to import matplotlib
+COLORMAP_RGB_CODES = {
+    "viridis": [
+        "rgb(68,1,84)",
+        "rgb(71,18,101)",
+        "rgb(72,35,116)",
+        "rgb(69,52,127)",
+        "rgb(64,67,135)",
+        "rgb(58,82,139)",
+        "rgb(52,94,141)",
+        "rgb(46,107,142)",
+        "rgb(41,120,142)",
+        "rgb(36,132,141)",
+        "rgb(32,144,140)",
+        "rgb(30,155,137)",
+        "rgb(34,167,132)",
+        "rgb(47,179,123)",
+        "rgb(68,190,112)",
+        "rgb(94,201,97)",
+        "rgb(121,209,81)",
+        "rgb(154,216,60)",
+        "rgb(189,222,38)",
+        "rgb(223,227,24)",
+        "rgb(253,231,36)",
+    ]
+}
+
+
+def get_colorscale_divisions():
+    return np.append(np.arange(0, 1, 1 / NUM_COLORSCALE_DIVISIONS), 1)
+
+
+def get_colormap_rgb_codes(cmap):
+    """Return RGB codes for `NUM_COLORSCALE_DIVISIONS` + 1 equally spaced
+    points across the matplotlib colormap `cmap`
+    """
+    if cmap in COLORMAP_RGB_CODES:
+        return COLORMAP_RGB_CODES[cmap]
+    return compute_colormap_rgb_codes(cmap)
+
+
+def compute_colormap_rgb_codes(cmap):
+    """Compute the RGB codes returned by `get_colormap_rgb_codes` from
+    matplotlib
+    """
+    import matplotlib
+
+    try:
+        cmap = matplotlib.colormaps[cmap]
+    except AttributeError:
+        # matplotlib < 3.5 has no colormap registry
+        import matplotlib.cm
+
+        cmap = matplotlib.cm.get_cmap(cmap)
+    cmap_points = [
+        list(map(np.uint8, np.array(cmap(x)[:3]) * 255))
+        for x in get_colorscale_divisions()
+    ]
+    return [f"rgb({x[0]},{x[1]},{x[2]})" for x in cmap_points]
@@ -1,70 +1,323 @@
+import math
+
 import pandas as pd
-from pandas.api.types import CategoricalDtype
 
 from app import cache
 
+import backends
+import dataset
 import settings
+import singleflight
+import store
 
 
-@cache.memoize()
+@dataset.preloadable
+@cache.memoize(make_name=dataset.versioned_name)
 def get_data(sample_size=None):
     """Get suitably massaged data
+
+    This is the union of the partitions in the processed data store or, for
+    deployments which only have the merged file, `all_processed.csv.zip`. Types
+    come from the schema written by the pipeline. We hold it in the compact
+    form returned by `store.compact_processed_data`, without the columns in
+    `get_processed_practices`.
+
+    If `sample_size` is supplied, only the data for that many practices is
+    returned. The sample is always the same for the same data (see
+    `store.sample_practices`), and is read from the file written by `flask
+    write_sample`, if there is one, rather than from the full data.
     """
-    categorical = CategoricalDtype(ordered=False)
-    dtypes = {
-        "ccg_id": categorical,
-        "practice_id": categorical,
-        "count": int,
-        "error": int,
-        "lab_id": categorical,
-        "practice_name": categorical,
-        "result_category": int,
-        "test_code": categorical,
-        "total_list_size": int,
-    }
-    df = pd.read_csv(
-        settings.CSV_DIR / "all_processed.csv.zip", dtype=dtypes, parse_dates=["month"]
+    if not sample_size:
+        return store.compact_processed_data(store.load_processed_data())
+    path = store.get_sample_path(sample_size)
+    if path.exists():
+        df = store.read_csv(path, store.read_schema(path), store.PROCESSED_DTYPES)
+        return store.compact_processed_data(store.sort_by_month(df))
+    df = get_data()
+    return df[df["practice_id"].isin(store.sample_practices(df, sample_size))]
+
+
+@dataset.preloadable
+@cache.memoize(make_name=dataset.versioned_name)
+def get_processed_practices():
+    """Return the name and list size of each practice in each month of the
+    processed data, indexed by month and practice_id
+
+    This is written by the pipeline to `processed_practices.csv`; we only
+    compute it here for deployments which don't have that file.
+    """
+    path = store.get_processed_practices_path()
+    if path.exists():
+        df = store.read_csv(
+            path, store.read_schema(path), store.PROCESSED_PRACTICE_DTYPES
+        )
+        return df.set_index(["month", "practice_id"])
+    return store.get_processed_practices(store.load_processed_data())
+
+
+@cache.memoize(make_name=dataset.versioned_name)
+def get_practice_data():
+    """Return the list size of each practice with data in each month, along
+    with its name, CCG and assigned lab
+
+    This is computed by the pipeline and written to `practice_list_sizes.csv`;
+    we only compute it here for deployments which don't have that file.
+    """
+    path = store.get_practice_list_sizes_path()
+    if path.exists():
+        return store.read_csv(
+            path, store.read_schema(path), store.PRACTICE_LIST_SIZE_DTYPES
+        )
+    return store.get_practice_list_sizes(
+        read_practice_data(),
+        get_backend().distinct("practice_id"),
+        get_labs_for_practices(),
     )
-    if sample_size:
-        some_practices = df.practice_id.sample(sample_size)
-        return df[df.loc[:, "practice_id"].isin(some_practices)]
+
+
+# The practice-related columns we can group list sizes by
+LIST_SIZE_GROUPBY_COLUMNS = {"month", "practice_id", "ccg_id", "lab_id"}
+
+
+@cache.memoize(make_name=dataset.versioned_name)
+def get_list_sizes(groupby, granularity="month"):
+    """Return a Series of total list sizes, indexed by the columns in
+    `groupby` (which must all be in `LIST_SIZE_GROUPBY_COLUMNS`)
+
+    For periods longer than a month, this is the average of the monthly totals
+    over each period (see `store.average_over_periods`).
+    """
+    practice_df = get_practice_data()
+    list_sizes = practice_df.groupby(list(groupby), observed=True)[
+        ["total_list_size"]
+    ].sum()
+    if granularity != "month":
+        list_sizes = store.average_over_periods(list_sizes, granularity)
+    return list_sizes["total_list_size"]
+
+
+@cache.memoize(make_name=dataset.versioned_name)
+def get_list_sizes_by_ccg_and_lab():
+    """Return a DataFrame of total list sizes by month, CCG and lab, from which
+    totals for any combination of CCGs and labs can be summed cheaply.
+    Practices not assigned to any lab in a month have an empty lab_id.
+    """
+    practice_df = get_practice_data()
+    lab_ids = practice_df["lab_id"].astype(object).fillna("")
+    df = practice_df.groupby(["month", "ccg_id", lab_ids], observed=True)[
+        "total_list_size"
+    ].sum()
+    return df.reset_index()
+
+
+def get_filtered_list_sizes(
+    lab_ids=None, ccg_ids=None, practice_ids=None, granularity="month"
+):
+    """Return a DataFrame of total list sizes by month for practices
+    serviced by `lab_ids`, in `ccg_ids` and in `practice_ids` (where each
+    filter is only applied if supplied), averaged over each `granularity`
+    period as in `get_list_sizes`
+    """
+    if practice_ids:
+        df = get_practice_data()
+        df = df[df["practice_id"].isin(practice_ids)]
     else:
-        return df
+        df = get_list_sizes_by_ccg_and_lab()
+    if lab_ids:
+        df = df[df["lab_id"].isin(lab_ids)]
+    if ccg_ids:
+        df = df[df["ccg_id"].isin(ccg_ids)]
+    df = df.groupby("month")[["total_list_size"]].sum()
+    if granularity != "month":
+        df = store.average_over_periods(df, granularity)
+    return df
 
 
-@cache.memoize()
-def get_practice_data():
-    practice_df = read_practice_data()
-    practices_with_data = get_data().practice_id.unique()
-    # If we have no data for a practice at all then we don't want to include it
-    # in our practice data, mainly so that its list size doesn't unfairly
-    # contribute to the CCG list size
-    practice_df = practice_df[practice_df.practice_id.isin(practices_with_data)]
-    lab_df = get_labs_for_practices()
-    practice_df = practice_df.merge(lab_df, how="left", on=["month", "practice_id"])
-    return practice_df
+@dataset.preloadable
+@cache.memoize(make_name=dataset.versioned_name)
+def get_rolled_up_data(granularity, sample_size=None):
+    """Return the total count and error by quarter or year (see
+    `store.roll_up`)
 
+    Queries by these periods are answered from this rather than by summing
+    the monthly data again for every request.
+    """
+    return store.roll_up(get_data(sample_size), granularity)
 
-def read_practice_data():
-    categorical = CategoricalDtype(ordered=False)
-    dtypes = {
-        "ccg_id": categorical,
-        "practice_id": categorical,
-        "practice_name": categorical,
-        # Even though list sizes are ints, because we have some NaN values in
-        # the data (i.e. practices without a known list size) we have to use
-        # floats
-        "total_list_size": float,
-    }
-    practice_df = pd.read_csv(
-        settings.CSV_DIR / "practice_codes.csv",
-        dtype=dtypes,
-        parse_dates=["month"],
-        # We need NaN handling (see above) but we don't want to interpret
-        # anything other than an empty string as NaN
-        keep_default_na=False,
-        na_values=[""],
+
+@dataset.preloadable
+@cache.memoize(make_name=dataset.versioned_name)
+def get_all_test_totals(sample_size=None, granularity="month"):
+    """Return the total count and error across all tests by month (or the
+    first month of each `granularity` period), practice, lab and result
+    category
+
+    Queries over all tests can be answered from this rather than from the full
+    data, which has a row for every test code.
+    """
+    if granularity == "month":
+        return store.total_all_tests(get_data(sample_size))
+    return store.total_all_tests(get_rolled_up_data(granularity, sample_size))
+
+
+@dataset.per_version
+def get_processed_schema():
+    """Return the schema of the processed data written by the pipeline, or
+    None if there isn't one
+    """
+    return store.read_schema(store.get_processed_data_path())
+
+
+def get_backend():
+    """Return the backend (see `backends.py`) configured by
+    `settings.QUERY_BACKEND`
+    """
+    if settings.QUERY_BACKEND == "pandas":
+        return backends.PandasBackend(
+            get_data, get_processed_practices, get_rolled_up_data, get_all_test_totals
+        )
+    return get_file_backend(settings.QUERY_BACKEND)
+
+
+@dataset.per_version
+def get_file_backend(name):
+    """Return the backend called `name` which reads the processed data from
+    files (see `get_backend`), which is only created once for each version of
+    the data
+
+    Requests which started before a new version became current carry on
+    using the backend for their version, which keeps reading the files as
+    they were when it was created, and is released once they've finished.
+    """
+    if name == "sqlite":
+        return backends.SQLiteBackend(store.get_sqlite_path(), get_processed_schema())
+    elif name == "sharded":
+        return backends.ShardedBackend(
+            store.get_partition_paths(), get_processed_schema(), settings.QUERY_SHARDS
+        )
+    else:
+        raise ValueError(name)
+
+
+def get_filtered_data(
+    sample_size=None,
+    test_codes=None,
+    result_filter=None,
+    lab_ids=None,
+    ccg_ids=None,
+    practice_ids=None,
+    month_from=None,
+    month_to=None,
+):
+    """Return the rows of the data for `test_codes` which match
+    `result_filter`, for practices serviced by `lab_ids`, in `ccg_ids` and in
+    `practice_ids`, from `month_from` to `month_to` inclusive (where each
+    filter is only applied if supplied)
+    """
+    return get_backend().rows(
+        sample_size,
+        get_result_filter_query(result_filter),
+        test_codes=test_codes,
+        lab_ids=lab_ids,
+        ccg_ids=ccg_ids,
+        practice_ids=practice_ids,
+        month_from=month_from,
+        month_to=month_to,
     )
+
+
+@cache.memoize(make_name=dataset.versioned_name)
+def get_aggregate(
+    groupby,
+    sample_size=None,
+    test_codes=None,
+    result_filter=None,
+    lab_ids=None,
+    ccg_ids=None,
+    practice_ids=None,
+    month_from=None,
+    month_to=None,
+    granularity="month",
+):
+    """Return the total count and error of the rows matching the filters (see
+    `get_filtered_data`), grouped by the columns in `groupby` for each
+    `granularity` period, or the empty set of matching rows if there aren't
+    any
+
+    These are the numerators and denominators from which `get_count_data`
+    builds its results. Many queries share one of these (e.g. "tests of X per
+    1000 patients" and "tests of X out of range as a proportion of tests of
+    X") so we cache them separately. Callers should pass filters through
+    `canonicalise_filters` so that equivalent queries share a cache entry.
+
+    Aggregates over all tests are read from the much smaller table of totals
+    across all tests, where possible.
+    """
+    totals_columns = set(store.ALL_TEST_TOTALS_COLUMNS)
+    all_test_totals = not test_codes and set(groupby) <= totals_columns
+    df = get_backend().aggregate(
+        groupby,
+        sample_size,
+        all_test_totals,
+        get_result_filter_query(result_filter),
+        granularity,
+        test_codes=test_codes,
+        lab_ids=lab_ids,
+        ccg_ids=ccg_ids,
+        practice_ids=practice_ids,
+        month_from=month_from,
+        month_to=month_to,
+    )
+    if df.empty:
+        # Callers expect the columns of the full data in this case
+        return get_filtered_data(
+            sample_size,
+            test_codes,
+            result_filter,
+            lab_ids,
+            ccg_ids,
+            practice_ids,
+            month_from,
+            month_to,
+        )
+    return df
+
+
+def canonicalise_filters(
+    test_codes,
+    result_filter,
+    practice_filters,
+    month_from=None,
+    month_to=None,
+    granularity="month",
+):
+    """Return filters for `get_aggregate` as keyword arguments whose values
+    don't depend on the order in which ids were supplied, or on how months
+    were written
+
+    For periods longer than a month, `month_from` is moved back to the start
+    of its period, so that every period overlapping the range is included.
+    """
+    filters = {key: tuple(sorted(ids)) for key, ids in practice_filters.items() if ids}
+    if test_codes:
+        filters["test_codes"] = tuple(sorted(test_codes))
+    if result_filter:
+        filters["result_filter"] = result_filter
+    if month_from:
+        filters["month_from"] = pd.Timestamp(month_from)
+    if month_to:
+        filters["month_to"] = pd.Timestamp(month_to)
+    if granularity != "month":
+        filters["granularity"] = granularity
+        if month_from:
+            frequency = store.PERIOD_FREQUENCIES[granularity]
+            filters["month_from"] = pd.Period(month_from, frequency).start_time
+    return filters
+
+
+def read_practice_data():
+    path = store.get_practice_data_path()
+    practice_df = store.read_csv(path, store.read_schema(path), store.PRACTICE_DTYPES)
     practice_df = practice_df.dropna()
     return practice_df
 
@@ -80,28 +333,24 @@ def get_labs_for_practices():
     potassium tests to any one lab. This implies that some practices will not
     have any associated lab in some months.
 
-    NOTE: If we change this algorithm we should also update the text at
-    /faq#lab-list-sizes
+    NOTE: If we change this algorithm (see `store.assign_labs_to_practices`)
+    we should also update the text at /faq#lab-list-sizes
+
+    The assignment is computed by the pipeline and written to
+    `practice_labs.csv`; we only compute it here for deployments which don't
+    have that file.
     """
-    df = get_data()
-    # Filter to just potassium tests and just the columns we need
-    df = df[df.loc[:, "test_code"] == "K"]
-    df = df[["month", "practice_id", "lab_id", "count"]]
-    # Get total tests each practice sent to each lab in each month
-    df = df.groupby(["month", "practice_id", "lab_id"], observed=True).sum()
-    df = df.reset_index()
-    # For each month and practice, keep only the lab with the highest test count
-    df = df.sort_values("count", na_position="first")
-    df = df.drop_duplicates(["month", "practice_id"], keep="last")
-    # Filter out practices which didn't order enough tests
-    df = df[df.loc[:, "count"] >= 50]
-    # We no longer need this column and don't want it accidentally ending up in
-    # any merges
-    df = df.drop(columns=["count"])
-    return df
+    path = store.get_practice_labs_path()
+    if path.exists():
+        return store.read_csv(path, store.read_schema(path), store.PRACTICE_LAB_DTYPES)
+    potassium_counts = store.count_potassium_tests(get_data())
+    return store.restore_processed_types(
+        store.assign_labs_to_practices(potassium_counts)
+    )
 
 
-@cache.memoize()
+@singleflight.single_flight
+@cache.memoize(make_name=dataset.versioned_name)
 def get_count_data(
     numerators=[],
     denominators=[],
@@ -112,11 +361,23 @@ def get_count_data(
     by="practice_id",
     sample_size=None,
     hide_entities_with_sparse_data=False,
+    month_from=None,
+    month_to=None,
+    granularity="month",
 ):
     """Get anonymised count data (for all categories) by month and test_code and practice
-    """
-    df = get_data(sample_size)
 
+    If `month_from` or `month_to` (e.g. "2019-01") are supplied, only data from
+    that range of months, inclusive, is included.
+
+    If `granularity` is "quarter" or "year", counts are totals for each of
+    those periods (which are labelled by their first month), and include
+    every period overlapping the range of months. List sizes are averaged
+    over the months in each period.
+    """
+    granularity = granularity or "month"
+    if granularity not in store.MONTHS_PER_PERIOD:
+        raise ValueError(granularity)
     # If we're filtering the numerator to below/within/over range then we
     # filter the denominator to just numeric results, which is the ratio we're
     # generally interested in. It would be nicer not to hardcode this behaviour
@@ -126,7 +387,6 @@ def get_count_data(
         denominator_result_filter = "numeric"
 
     if by == "practice_id":
-        cols = ["month", "total_list_size", "practice_id", "ccg_id", "count", "error"]
         groupby = ["month", "practice_id", "ccg_id"]
         required_cols = [
             "month",
@@ -142,7 +402,6 @@ def get_count_data(
     # XXX how do we do this.
     # We group by X, then do calc-value; but what about the percentiles?
     elif by == "test_code":
-        cols = ["month", "test_code", "count", "error", "total_list_size"]
         groupby = ["month", "test_code"]
         required_cols = [
             "month",
@@ -154,7 +413,6 @@ def get_count_data(
             "denominator",
         ]
     elif by == "result_category":
-        cols = ["month", "result_category", "count", "error", "total_list_size"]
         groupby = ["month", "result_category"]
         required_cols = [
             "month",
@@ -166,7 +424,6 @@ def get_count_data(
             "denominator",
         ]
     elif by == "ccg_id":
-        cols = ["month", "total_list_size", "ccg_id", "count", "error"]
         groupby = ["month", "ccg_id"]
         required_cols = [
             "month",
@@ -179,7 +436,6 @@ def get_count_data(
             "calc_value_error",
         ]
     elif by == "lab_id":
-        cols = ["month", "total_list_size", "lab_id", "count", "error"]
         groupby = ["month", "lab_id"]
         required_cols = [
             "month",
@@ -211,45 +467,47 @@ def get_count_data(
         ]
 
         groupby = None
-    base_and_query = []
+        if granularity != "month":
+            raise ValueError("Raw rows are only available by month")
+    practice_filters = {}
     if lab_ids_for_practice_filter and "all" not in lab_ids_for_practice_filter:
-        base_and_query.append(f"(lab_id.isin({lab_ids_for_practice_filter}))")
+        practice_filters["lab_ids"] = lab_ids_for_practice_filter
     if ccg_ids_for_practice_filter and "all" not in ccg_ids_for_practice_filter:
-        base_and_query.append(f"(ccg_id.isin({ccg_ids_for_practice_filter}))")
+        practice_filters["ccg_ids"] = ccg_ids_for_practice_filter
     if (
         practice_ids_for_practice_filter
         and "all" not in practice_ids_for_practice_filter
     ):
-        base_and_query.append(f"(practice_id.isin({practice_ids_for_practice_filter}))")
-    numerator_and_query = base_and_query[:]
-    result_filter_query = get_result_filter_query(result_filter)
-    if result_filter_query:
-        numerator_and_query.append(result_filter_query)
+        practice_filters["practice_ids"] = practice_ids_for_practice_filter
+    numerator_test_codes = None
     if numerators and numerators != ["all"]:
-        numerator_and_query += [f"(test_code.isin({numerators}))"]
-    if numerator_and_query:
-        filtered_df = df.query(" & ".join(numerator_and_query))
+        numerator_test_codes = numerators
+    numerator_filters = canonicalise_filters(
+        numerator_test_codes,
+        result_filter,
+        practice_filters,
+        month_from,
+        month_to,
+        granularity,
+    )
+    result_filter_query = get_result_filter_query(result_filter)
+    if groupby:
+        num_df_agg = get_aggregate(tuple(groupby), sample_size, **numerator_filters)
     else:
-        filtered_df = df
-    if groupby and not filtered_df.empty:
+        num_df_agg = get_filtered_data(sample_size, **numerator_filters)
+    if groupby and not num_df_agg.empty:
         # Because each practice-month pair might occur multiple times in our
         # dataframe (once for each test code and result category) we can't
         # simply sum the `total_list_size` column as this will end up counting
-        # the same list size value multiple times. So we handle this
-        # separately.
-        cols_without_list_size = [c for c in cols if c != "total_list_size"]
-        num_df_agg = (
-            filtered_df[cols_without_list_size].groupby(groupby, observed=True).sum()
-        )
-
-        practice_df = get_practice_data()
+        # the same list size value multiple times. So the aggregate only has
+        # counts, and we handle list sizes separately.
 
         # The easy case is when we're grouping by practice-related columns. In
-        # this case we just apply the same group/sum to the practice dataframe
-        # and copy the list size column across.
-        if all(col in practice_df.columns for col in groupby):
-            list_size_df = practice_df.groupby(groupby, observed=True).sum()
-            num_df_agg.loc[:, "total_list_size"] = list_size_df["total_list_size"]
+        # this case we look up the list size totals for the same grouping and
+        # copy the list size column across.
+        if set(groupby) <= LIST_SIZE_GROUPBY_COLUMNS:
+            list_sizes = get_list_sizes(tuple(groupby), granularity)
+            num_df_agg.loc[:, "total_list_size"] = list_sizes
             num_df_agg = num_df_agg.reset_index()
 
         # The more complex case is where we're grouping by something not
@@ -259,15 +517,13 @@ def get_count_data(
             # If we're filtering by CCG or Lab then we need to apply that
             # filter here otherwise we'll get the national total list size
             # rather than the total for just the selected CCG/Lab.
-            if base_and_query:
-                practice_df = practice_df.query(" & ".join(base_and_query))
-            list_size_df = practice_df.groupby("month", observed=True).sum()
+            list_size_df = get_filtered_list_sizes(
+                granularity=granularity, **practice_filters
+            )
             num_df_agg = num_df_agg.reset_index()
             num_df_agg = num_df_agg.merge(
                 list_size_df, left_on="month", right_index=True
             )
-    else:
-        num_df_agg = filtered_df
     if denominators == ["per1000"]:
         num_df_agg.loc[:, "denominator"] = num_df_agg["total_list_size"]
         num_df_agg.loc[:, "denominator_error"] = num_df_agg["error"]
@@ -313,19 +569,20 @@ def get_count_data(
             else:
                 # The denominator needs to be summed across all tests
                 groupby = ["month"]
-        denominator_and_query = base_and_query[:]
+        denominator_test_codes = None
         if denominators and "all" not in denominators:
-            denominator_and_query += [f"test_code.isin({denominators})"]
-        denominator_filter_query = get_result_filter_query(denominator_result_filter)
-        if denominator_filter_query:
-            denominator_and_query.append(denominator_filter_query)
-        if denominator_and_query:
-            filtered_df = df.query(" & ".join(denominator_and_query))
-        else:
-            filtered_df = df
-        denom_df_agg = (
-            filtered_df[cols].groupby(groupby, observed=True).sum().reset_index()
+            denominator_test_codes = denominators
+        denominator_filters = canonicalise_filters(
+            denominator_test_codes,
+            denominator_result_filter,
+            practice_filters,
+            month_from,
+            month_to,
+            granularity,
         )
+        denom_df_agg = get_aggregate(
+            tuple(groupby), sample_size, **denominator_filters
+        ).reset_index()
         num_df_agg = num_df_agg.merge(
             denom_df_agg,
             how="right",
@@ -355,19 +612,26 @@ def get_count_data(
             columns={"count": "numerator", "error": "numerator_error"}
         )
         # Always include date in label
-        label_format += " in {0[month]:%b %Y}"
+        num_df_agg["period"] = store.format_periods(num_df_agg["month"], granularity)
+        label_format += " in {0[period]}"
         num_df_agg["label"] = num_df_agg.apply(label_format.format, axis=1)
         # If `by` is `None` then we're getting the raw, unaggregated data to
         # display in a table and the filtering mechanism below won't work (and
         # also, probably, is less necessary as the table will be too big to
         # parse visually in any case)
         if hide_entities_with_sparse_data and by is not None:
-            # Remove all rows without data in at least 6 of the last 9 months
+            # Remove all rows without data in at least 6 of the last 9 months,
+            # or the periods covering them
+            months_per_period = store.MONTHS_PER_PERIOD[granularity]
             num_df_agg = _filter_rows_with_sparse_data(
                 num_df_agg,
                 index_col=by,
-                months_to_check=settings.NUM_MONTHS_TO_CHECK,
-                months_required=settings.NUM_MONTHS_REQUIRED,
+                months_to_check=math.ceil(
+                    settings.NUM_MONTHS_TO_CHECK / months_per_period
+                ),
+                months_required=math.ceil(
+                    settings.NUM_MONTHS_REQUIRED / months_per_period
+                ),
             )
         # The fillna is to work around this bug: https://github.com/plotly/plotly.js/issues/3296
         num_df_agg["calc_value_error"] = num_df_agg["calc_value_error"].fillna(0)
@@ -388,13 +652,27 @@ def _filter_rows_with_sparse_data(df, index_col, months_to_check, months_require
     return df[df[index_col].isin(remaining_ids)]
 
 
-@cache.memoize()
+@cache.memoize(make_name=dataset.versioned_name)
+def get_distinct_values(column):
+    """Return the sorted distinct values of `column` in the processed data
+
+    For categorical columns these are the categories in the schema written by
+    the pipeline, so the app can build its layout without loading the data.
+    """
+    schema = get_processed_schema()
+    spec = schema["columns"].get(column, {}) if schema else {}
+    if "categories" in spec:
+        return list(spec["categories"])
+    return get_backend().distinct(column)
+
+
+@cache.memoize(make_name=dataset.versioned_name)
 def get_test_list():
     """Get a list of tests suitable for showing in HTML dropdown forms
     """
     df = pd.read_csv(settings.CSV_DIR / "test_codes.csv")
     df = df[["datalab_testcode", "testname"]]
-    data_testcodes = get_data()["test_code"].unique()
+    data_testcodes = get_distinct_values("test_code")
     df = df[df["datalab_testcode"].isin(data_testcodes)]
     df = df[["datalab_testcode", "testname"]]
     df = df.rename(columns={"datalab_testcode": "value", "testname": "label"})
@@ -402,7 +680,7 @@ def get_test_list():
     return df
 
 
-@cache.memoize()
+@cache.memoize(make_name=dataset.versioned_name)
 def get_test_code_to_name_map():
     df = get_test_list()
     name_map = dict(zip(df.value, df.label))
@@ -415,15 +693,14 @@ def get_test_code_to_name_map():
     return name_map
 
 
-@cache.memoize()
+@cache.memoize(make_name=dataset.versioned_name)
 def get_all_entity_ids():
     """
     Return a dict mapping entity column names to the set of all the possible
     entity_ids for that column
     """
-    df = get_data()
     return {
-        column_name: set(df[column_name].unique())
+        column_name: set(get_distinct_values(column_name))
         for column_name in [
             "lab_id",
             "ccg_id",
@@ -434,7 +711,7 @@ def get_all_entity_ids():
     }
 
 
-@cache.memoize()
+@cache.memoize(make_name=dataset.versioned_name)
 def get_entity_label_to_id_map():
     """Return a dict of labels to ids. Required for interaction between
     deciles and heatmap charts
@@ -465,14 +742,14 @@ def ids_to_labels(org_type, entity_ids):
     return org_labels
 
 
-@cache.memoize()
+@cache.memoize(make_name=dataset.versioned_name)
 def get_org_list(org_type, ccg_ids_filter=None, lab_ids_filter=None):
-    df = get_data()
-    if ccg_ids_filter:
-        df = df[df["ccg_id"].isin(ccg_ids_filter)]
-    if lab_ids_filter:
-        df = df[df["lab_id"].isin(lab_ids_filter)]
-    org_values = df.groupby(org_type, observed=True)["test_code"].groups.keys()
+    if ccg_ids_filter or lab_ids_filter:
+        org_values = get_backend().distinct(
+            org_type, ccg_ids=ccg_ids_filter, lab_ids=lab_ids_filter
+        )
+    else:
+        org_values = get_distinct_values(org_type)
     org_labels = ids_to_labels(org_type, org_values)
 
     org_values_and_labels = zip(org_values, org_labels)
@@ -509,3 +786,34 @@ def get_result_filter_query(result_filter):
         return f"(result_category == {result_filter})"
     else:
         raise ValueError(result_filter)
+
+
+def preload():
+    """Load the data in this process, before worker processes are forked
+    from it (see `dataset.preload`)
+
+    The pandas backend's frames only hold numbers, categorical codes and
+    small tables of categories, none of which are written to when workers
+    read them, so they stay shared between all the workers.
+    """
+    if settings.QUERY_BACKEND == "pandas":
+        dataset.preload(get_data)
+        dataset.preload(get_processed_practices)
+        for granularity in store.MONTHS_PER_PERIOD:
+            if granularity != "month":
+                dataset.preload(get_rolled_up_data, granularity)
+            dataset.preload(get_all_test_totals, granularity=granularity)
+    warm_cache()
+
+
+def warm_cache():
+    """Compute the results which almost every request needs, so that they're
+    cached for the current version of the data (see `dataset.load_version`)
+    """
+    if settings.QUERY_BACKEND == "pandas":
+        get_all_test_totals()
+    get_list_sizes_by_ccg_and_lab()
+    get_test_code_to_name_map()
+    get_entity_label_to_id_map()
+    for org_type in ["ccg_id", "lab_id", "practice_id"]:
+        get_org_list(org_type)
@@ -0,0 +1,434 @@
+"""Track the version of the data the app serves, and switch to new versions
+written by the pipeline without restarting the app.
+
+A version is a fingerprint of the files the app reads its data from (see
+`store.get_served_data_paths`). Every memoized function in `data.py` includes
+the current version in its cache keys (see `versioned_name`), so results
+computed from one version of the data are never served for another.
+Results which can't be pickled, like query backends, are held in memory
+for each version instead (see `per_version`).
+
+The watcher thread started by `start_watcher` checks the files every
+`settings.DATA_RELOAD_INTERVAL` seconds. Once a new version has stopped
+changing, it loads that version and computes the results most requests need
+in the background, while requests continue to be answered from the current
+version, and then makes it the current version with a single assignment.
+Entries for the old version are never read again, and are evicted as the
+cache fills up.
+
+When the app starts, `start_loader` loads the data and computes those
+results in the background too, so that workers can answer requests (and
+health checks) straight away. `is_ready` says whether it has finished.
+
+Deployments which fork workers from a master process (see
+`gunicorn.conf.py`) can instead load the data in the master, before forking,
+with `preload`. The largest results are then held as they are, rather than
+pickled in the cache, so that workers share their memory with the master
+rather than each unpickling a copy of their own.
+
+The watcher also saves the cached results for the current version to a
+snapshot on disk, named for the version of the data and of the code which
+computed them (see `get_code_version`), which `load_cache_snapshot` reads when the app starts.
+A redeploy which doesn't change the data therefore starts with the query
+results the previous deploy had computed. Results of `preloadable`
+functions are copies of the data itself, which are quick to recompute from
+the files, so they're left out. Only one worker at a time writes snapshots
+(see `is_snapshot_writer`).
+
+"""
+import fcntl
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import platform
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+from flask_caching.backends import SimpleCache
+
+import settings
+import store
+
+
+logger = logging.getLogger(__name__)
+
+# The version of the data used to answer requests
+_current_version = None
+
+# The version being loaded by the watcher, which its own thread uses instead
+_loading = threading.local()
+
+# Set once the data has been loaded when the app starts
+_ready = threading.Event()
+
+# Results held in memory by `preload`, keyed by function, version of the
+# data, and arguments
+_preloaded = {}
+
+# Results held in memory for each version of the data by `per_version`,
+# keyed like `_preloaded`
+_held = {}
+_held_lock = threading.RLock()
+
+# The cache keys of results of `preloadable` functions, which are left out of
+# cache snapshots, and the version of the data each is for
+_unsnapshotted_keys = {}
+
+# The process ID and locked file descriptor of the process which writes cache
+# snapshots, if it's this one or its parent
+_snapshot_writer = None
+
+
+def get_data_version():
+    """Return a fingerprint of the files the app reads its data from, which
+    changes whenever any of them are written, added or removed
+    """
+    fingerprint = hashlib.md5()
+    for path in store.get_served_data_paths():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        fingerprint.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return fingerprint.hexdigest()
+
+
+def get_version():
+    """Return the version of the data which this thread should use
+    """
+    global _current_version
+    version = getattr(_loading, "version", None)
+    if version is not None:
+        return version
+    if _current_version is None:
+        _current_version = get_data_version()
+    return _current_version
+
+
+def versioned_name(fname):
+    """Return the name under which results of the memoized function `fname`
+    are cached for the version of the data this thread is using
+    """
+    return f"{fname}@{get_version()}"
+
+
+def get_code_version():
+    """Return a fingerprint of the app's code, and of the versions of Python
+    and pandas used to pickle cached results
+    """
+    fingerprint = hashlib.md5()
+    fingerprint.update(f"{platform.python_version()}:{pd.__version__}\n".encode())
+    root = Path(__file__).parent
+    for path in sorted(root.glob("*.py")) + sorted(root.glob("apps/*.py")):
+        fingerprint.update(path.read_bytes())
+    return fingerprint.hexdigest()
+
+
+def get_cache_snapshot_path():
+    """Return the path of the snapshot of the cache for the current versions
+    of the data and the code
+    """
+    name = f"{get_version()}-{get_code_version()}.pickle"
+    return store.get_cache_snapshots_dir() / name
+
+
+class VersionedSimpleCache(SimpleCache):
+    """flask-caching's in-memory cache, which also records the version of
+    the data each entry was computed for, so that snapshots only hold the
+    entries for the current version
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.versions = {}
+
+    def set(self, key, value, timeout=None):
+        self.versions[key] = get_version()
+        return super().set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        self.versions.setdefault(key, get_version())
+        return super().add(key, value, timeout)
+
+
+def versioned_simple_cache(app, config, args, kwargs):
+    """Return a `VersionedSimpleCache` for flask-caching (see
+    `settings.CACHE_CONFIG`)
+    """
+    kwargs.update(
+        threshold=config["CACHE_THRESHOLD"],
+        ignore_errors=config["CACHE_IGNORE_ERRORS"],
+    )
+    return VersionedSimpleCache(*args, **kwargs)
+
+
+def _get_cached_entries(cache):
+    # Only the in-memory cache configured in `settings` can be snapshotted
+    if not isinstance(cache.cache, VersionedSimpleCache):
+        return None
+    return cache.cache._cache
+
+
+def load_cache_snapshot(cache):
+    """Add the entries in the snapshot for the current versions of the data
+    and the code, if there is one, to `cache`
+
+    Returns the number of entries loaded.
+    """
+    entries = _get_cached_entries(cache)
+    path = get_cache_snapshot_path()
+    if entries is None or not path.exists():
+        return 0
+    try:
+        snapshot = pickle.loads(path.read_bytes())
+    except Exception:
+        logger.exception("Failed to read cache snapshot %s", path)
+        return 0
+    entries.update(snapshot)
+    cache.cache.versions.update(dict.fromkeys(snapshot, get_version()))
+    logger.info("Loaded %s cached results from %s", len(snapshot), path)
+    return len(snapshot)
+
+
+def save_cache_snapshot(cache):
+    """Write the entries in `cache` for the current version of the data to
+    the snapshot for the current versions of the data and the code, replacing
+    any other snapshots
+
+    Returns the path written, or None if the cache can't be snapshotted.
+    """
+    entries = _get_cached_entries(cache)
+    if entries is None:
+        return None
+    version = get_version()
+    versions = cache.cache.versions
+    # Entries for older versions are never read again
+    for key, key_version in list(versions.items()):
+        if key_version != version:
+            versions.pop(key, None)
+    # Copying the dict is atomic, so other threads can carry on using the cache.
+    # flask-caching's `_memver` keys hold the version of each memoized
+    # function, which the keys of its results for every version of the data
+    # include, so they're always kept.
+    snapshot = {
+        key: entry
+        for key, entry in dict(entries).items()
+        if (versions.get(key) == version or key.endswith("_memver"))
+        and key not in _unsnapshotted_keys
+    }
+    path = get_cache_snapshot_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write a temporary file and rename it, so that readers never see part of
+    # a snapshot
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_bytes(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+    os.replace(tmp_path, path)
+    for other_path in path.parent.glob("*.pickle"):
+        if other_path != path:
+            other_path.unlink()
+    return path
+
+
+def is_snapshot_writer():
+    """Return whether this process writes the cache snapshots
+
+    Only the first worker to lock a file in the snapshots directory writes
+    them, so that workers don't each write a snapshot of their own cache,
+    or remove each other's. It holds the lock until it exits, when another
+    worker takes over.
+    """
+    global _snapshot_writer
+    if _snapshot_writer is not None and _snapshot_writer[0] == os.getpid():
+        return True
+    lock_path = store.get_cache_snapshots_dir() / "writer.lock"
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _snapshot_writer = (os.getpid(), fd)
+    return True
+
+
+def get_call_key(f, args, kwargs):
+    """Return a key identifying a call of `f` with the given arguments for
+    the version of the data this thread is using
+    """
+    arguments = inspect.signature(f).bind(*args, **kwargs)
+    arguments.apply_defaults()
+    return (f.__qualname__, get_version()) + tuple(arguments.arguments.items())
+
+
+def preloadable(f):
+    """Decorate `f` so that it returns the results held for it by `preload`,
+    if there are any, for the version of the data this thread is using, and
+    so that its cached results are left out of snapshots
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        result = _preloaded.get(get_call_key(f, args, kwargs))
+        if result is None:
+            result = f(*args, **kwargs)
+            if hasattr(f, "make_cache_key"):
+                key = f.make_cache_key(f.uncached, *args, **kwargs)
+                _unsnapshotted_keys[key] = get_version()
+        return result
+
+    return wrapper
+
+
+def preload(f, *args, **kwargs):
+    """Call `f`, which must be decorated with `preloadable`, with the given
+    arguments, and hold on to the result, so that it's returned by every call
+    with the same arguments (and version of the data) without unpickling it
+
+    Results are shared with any processes forked from this one, but callers
+    must never modify them.
+    """
+    key = get_call_key(f.__wrapped__, args, kwargs)
+    # Don't also keep a pickled copy in the cache
+    uncached = getattr(f.__wrapped__, "uncached", f.__wrapped__)
+    _preloaded[key] = uncached(*args, **kwargs)
+
+
+def per_version(f):
+    """Decorate `f` so that it's only called once for each version of the
+    data (and set of arguments), holding on to the result in memory rather
+    than pickling it in the cache, until a newer version is current
+
+    This is for results which can't be pickled, like backends, or which are
+    needed by so many requests that unpickling them each time would be slow.
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        key = get_call_key(f, args, kwargs)
+        try:
+            return _held[key]
+        except KeyError:
+            pass
+        with _held_lock:
+            if key not in _held:
+                _held[key] = f(*args, **kwargs)
+            return _held[key]
+
+    return wrapper
+
+
+def _discard_old_results(version):
+    for results in (_preloaded, _held):
+        for key in list(results):
+            if key[1] != version:
+                del results[key]
+    for key, key_version in list(_unsnapshotted_keys.items()):
+        if key_version != version:
+            _unsnapshotted_keys.pop(key, None)
+
+
+def load_version(version, warm):
+    """Call `warm` to load `version` of the data and compute any results
+    which should be cached for it, and then make it the current version
+    """
+    global _current_version
+    _loading.version = version
+    try:
+        warm()
+    finally:
+        _loading.version = None
+    _current_version = version
+    _discard_old_results(version)
+
+
+def check_for_new_version(warm, pending_version=None):
+    """Load the version of the data on disk, if it differs from the current
+    version and hasn't changed since the last check, when it was
+    `pending_version`
+
+    Returns the version to pass as `pending_version` to the next check.
+    """
+    version = get_data_version()
+    if version == get_version():
+        return None
+    if version != pending_version:
+        # The pipeline may still be writing files
+        return version
+    logger.info("Loading data version %s", version)
+    load_version(version, warm)
+    logger.info("Now serving data version %s", version)
+    return None
+
+
+def is_ready():
+    """Return whether the data has been loaded since the app started
+    """
+    return _ready.is_set()
+
+
+def load(warm, cache):
+    """Load the snapshot of `cache` for the current version of the data, if
+    there is one, and then call `warm` to compute anything it's missing
+    """
+    try:
+        load_cache_snapshot(cache)
+        warm()
+    except Exception:
+        logger.exception("Failed to load the data")
+        return
+    _ready.set()
+    logger.info("Loaded data version %s", get_version())
+
+
+def start_loader(warm, cache):
+    """Start a daemon thread which calls `load`, returning the thread
+    """
+    thread = threading.Thread(
+        target=load, args=(warm, cache), name="dataset-loader", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def watch(warm, cache, interval):
+    pending_version = None
+    saved_keys = set(_get_cached_entries(cache) or {})
+    while True:
+        time.sleep(interval)
+        try:
+            pending_version = check_for_new_version(warm, pending_version)
+        except Exception:
+            logger.exception("Failed to load a new version of the data")
+            pending_version = None
+        # Only save a snapshot when there are new results to save
+        keys = set(_get_cached_entries(cache) or {})
+        if keys != saved_keys and is_snapshot_writer():
+            try:
+                save_cache_snapshot(cache)
+                saved_keys = keys
+            except Exception:
+                logger.exception("Failed to save cache snapshot")
+
+
+def start_watcher(warm, cache, interval=None):
+    """Start a daemon thread which loads new versions of the data, calling
+    `warm` for each (see `check_for_new_version`), and saves snapshots of
+    `cache`
+
+    Returns the thread, or None if reloading is disabled.
+    """
+    if interval is None:
+        interval = settings.DATA_RELOAD_INTERVAL
+    if not interval:
+        return None
+    thread = threading.Thread(
+        target=watch, args=(warm, cache, interval), name="dataset-watcher", daemon=True,
+    )
+    thread.start()
+    return thread
@@ -0,0 +1,16 @@
+# Read by gunicorn (from the working directory) when it starts the app
+import settings
+
+
+# With PRELOAD_DATA set, the app (and so the data, see `index.py`) is loaded
+# once, in the master process, and shared by the workers forked from it. New
+# versions of the data are loaded by each worker, which then holds its own
+# copy, so restart the app after updating the data to share it again.
+preload_app = settings.PRELOAD_DATA
+
+
+def post_fork(server, worker):
+    if settings.PRELOAD_DATA:
+        import index
+
+        index.start_data_watcher()
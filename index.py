@@ -1,24 +1,98 @@
 #!/usr/bin/env python
+import gc
 import os
+import dataset
 import settings
 
 
-def setup_app_and_layout():
-    from app import app
+def build_layout():
     from layout import layout
     from data import get_test_list
     from data import get_org_list
 
-    app.layout = layout(
+    return layout(
         get_test_list(),
         get_org_list("ccg_id"),
         get_org_list("lab_id"),
         get_org_list("practice_id"),
     )
+
+
+def set_layout(app):
+    """Build the layout for the current data, and make it the app's layout
+    """
+    from layout import index_components
+
+    dash_layout = build_layout()
+    index_components(dash_layout)
+    app.layout = dash_layout
+
+
+def setup_app_and_layout():
+    from app import app
+
+    set_layout(app)
     return app
 
 
+def warm_new_data_version():
+    """Load a new version of the data, and rebuild the layout so that its
+    dropdowns list the tests and organisations in it (see `dataset.py`)
+
+    With `settings.PRELOAD_DATA`, the new data is held in memory as it was
+    before, rather than pickled in the cache. Each worker loads it after
+    forking, though, so the workers no longer share it, and each holds its
+    own copy until the app is restarted.
+    """
+    from app import app
+    from data import preload
+    from data import warm_cache
+
+    if settings.PRELOAD_DATA:
+        preload()
+    else:
+        warm_cache()
+    set_layout(app)
+
+
+def preload_data():
+    """Load the data before any worker processes are forked, so that they
+    share it, and stop the garbage collector from touching (and so copying)
+    the pages holding it afterwards
+    """
+    from app import cache
+    from data import preload
+
+    dataset.load(preload, cache)
+    gc.freeze()
+
+
+def start_data_watcher():
+    from app import cache
+
+    dataset.start_watcher(warm_new_data_version, cache)
+
+
+def start_data_loading():
+    """Load the data in the background, starting with the results computed
+    by the last deploy if the data and code are the same, and then watch for
+    new versions of it
+    """
+    from app import cache
+    from data import warm_cache
+
+    dataset.start_loader(warm_cache, cache)
+    start_data_watcher()
+
+
 def setup_callbacks():
+    """Register the callbacks defined in each app module
+
+    Dash needs every callback before it serves the first request, so these
+    modules are imported when the app starts rather than when first used.
+    The libraries they need (dash, plotly and pandas) are imported by
+    `app.py` and the data modules in any case.
+    """
     import apps.base
 
     import apps.analyse
@@ -31,6 +105,12 @@ def setup_callbacks():
 
 app = setup_app_and_layout()
 setup_callbacks()
+if settings.PRELOAD_DATA:
+    # Threads don't survive forking, so `gunicorn.conf.py` starts a watcher in
+    # each worker
+    preload_data()
+else:
+    start_data_loading()
 server = app.server
 
 if __name__ == "__main__":
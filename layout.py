@@ -7,6 +7,10 @@ import settings
 
 OPTION_SEPARATOR = {"value": "__sep__", "label": "\u2015" * 16, "disabled": True}
 
+# The components of the app's current layout which have ids, keyed by id
+# (see `index_components`)
+components_by_id = {}
+
 # This ensures that downloaded graph images match the size shown on screen
 COMMON_GRAPH_CONFIG = {"toImageButtonOptions": {"width": None, "height": None}}
 
@@ -36,6 +40,9 @@ def layout(tests_df, ccgs_list, labs_list, practices_list):
                     html.Pre(id="page-state", className="collapse"),
                 ]
             ),
+            # Hidden div that stores the state the charts were last
+            # rendered for
+            html.Div(id="charts-state", style={"display": "none"}),
             # Two "locations" with the same function, to allow two
             # different callbacks to use them without cycles in the
             # graph.  This one represents URLs from the user,
@@ -173,7 +180,11 @@ def layout(tests_df, ccgs_list, labs_list, practices_list):
         ]
     )
     sort_order_form = dbc.FormGroup(
-        [dcc.Dropdown(id="sort-order-dropdown", clearable=False)]
+        [
+            dcc.Dropdown(
+                id="sort-order-dropdown", value="mean_six_month_asc", clearable=False
+            )
+        ]
     )
 
     chart_selector_tabs = dbc.Tabs(
@@ -351,3 +362,15 @@ def layout(tests_df, ccgs_list, labs_list, practices_list):
     )
     dash_app = html.Div([state_components, header, form, body])
     return dash_app
+
+
+def index_components(dash_layout):
+    """Index the components in `dash_layout` by id, so that callbacks can
+    find them without walking the whole layout
+    """
+    global components_by_id
+    components_by_id = {
+        component.id: component
+        for _, component in dash_layout._traverse_with_paths()
+        if getattr(component, "id", None)
+    }
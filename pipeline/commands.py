@@ -3,13 +3,20 @@
 from flask import Flask
 
 from .get_blogs import get_blogs
-from .get_data import get_practices, process_file, postprocess_files
+from .get_data import get_practices, process_file, postprocess_files, process_all
+from .get_data import derive_list_sizes, build_sqlite, memory_report
+from .get_data import write_sample
 
 app = Flask(__name__)
 
 app.cli.command("get_practices")(get_practices)
 app.cli.command("process_file")(process_file)
 app.cli.command("postprocess_files")(postprocess_files)
+app.cli.command("process_all")(process_all)
+app.cli.command("derive_list_sizes")(derive_list_sizes)
+app.cli.command("build_sqlite")(build_sqlite)
+app.cli.command("memory_report")(memory_report)
+app.cli.command("write_sample")(write_sample)
 
 
 app.cli.command("fetch_blogs")(get_blogs)
@@ -1,12 +1,35 @@
 """Get a list of test codes and names that have been mapped between all labs
 """
+import os
+import pickle
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import requests
 
 import settings
 import click
-
-from io import StringIO
+from store import PROCESSED_COLUMNS, PROCESSED_DTYPES, PRACTICE_DTYPES
+from store import PROCESSED_PRACTICE_COLUMNS
+from store import get_partition_paths, get_lab_partitions_dir
+from store import get_processed_data_path, get_practice_data_path
+from store import get_practice_labs_path, PRACTICE_LAB_DTYPES
+from store import assign_labs_to_practices, count_potassium_tests
+from store import get_practice_list_sizes_path, get_practice_list_sizes
+from store import PRACTICE_LIST_SIZE_DTYPES, read_csv, read_schema
+from store import get_read_dtypes, get_schema_path
+from store import get_sqlite_path
+from store import get_processed_practices, get_processed_practices_path
+from store import PROCESSED_PRACTICE_DTYPES, compact_processed_data
+from store import describe_memory, load_processed_data
+from store import get_sample_path, sample_practices
+
+from .manifest import Manifest, hash_inputs
+from .write import SchemaBuilder, write_partitions, write_schema, write_sqlite
+
+from io import StringIO, TextIOWrapper
 
 
 CODE_MAPPINGS = {
@@ -15,6 +38,9 @@ CODE_MAPPINGS = {
     "plymouth": ["plym_testcode", "other_plym_codes"],
 }
 
+# Number of rows to read at a time when merging processed files
+CHUNK_SIZE = 500000
+
 
 def get_codes():
     """Make a CSV of all the normalised test codes and lab test codes that
@@ -42,7 +68,7 @@ def get_practices():
     practices_url = (
         "https://openprescribing.net/api/1.0/org_code/?org_type=practice&format=csv"
     )
-    target_path = settings.CSV_DIR / "practice_codes.csv"
+    target_path = get_practice_data_path()
     # For some reason delegating the URL-grabbing to pandas results in a 403
     df = pd.read_csv(StringIO(requests.get(practices_url).text), na_filter=False)
     df = df[df["setting"] == 4]
@@ -56,6 +82,30 @@ def get_practices():
     df = df[["ccg", "code", "name", "date", "total_list_size"]]
     df.columns = ["ccg_id", "practice_id", "practice_name", "month", "total_list_size"]
     df.to_csv(target_path, index=False)
+    describe_csv(target_path, PRACTICE_DTYPES)
+
+
+def read_csv_in_chunks(path, dtypes, **kwargs):
+    """Read the CSV at `path` in chunks of `CHUNK_SIZE` rows, with date
+    columns read as categories
+    """
+    return pd.read_csv(
+        path,
+        dtype=get_read_dtypes(None, dtypes),
+        chunksize=CHUNK_SIZE,
+        keep_default_na=False,
+        na_values=[""],
+        **kwargs,
+    )
+
+
+def describe_csv(path, dtypes):
+    """Write a schema sidecar for the CSV at `path`
+    """
+    builder = SchemaBuilder(dtypes)
+    for chunk in read_csv_in_chunks(path, dtypes):
+        builder.add(chunk)
+    write_schema(path, builder.build())
 
 
 #####
@@ -69,14 +119,30 @@ def add_lab_code(df, lab_code):
     return df
 
 
-def trim_practices_and_add_population(df):
+def load_practices():
+    """Load the practices table written by `get_practices`
+    """
+    practices = pd.read_csv(settings.CSV_DIR / "practice_codes.csv", na_filter=False)
+    practices["month"] = pd.to_datetime(practices["month"])
+    return practices
+
+
+def load_nd_practice_mapping():
+    """Load the mapping from North Devon LIMS codes to ODS practice codes
+    """
+    return pd.read_csv(
+        settings.CSV_DIR / "north_devon_practice_mapping.csv", na_filter=False
+    )
+
+
+def trim_practices_and_add_population(df, practices=None):
     """Remove practices unlikely to be normal GP ones
     """
     # 1. Join on practices table
     # 2. Remove practices with fewer than 1000 total tests
     # 3. Remove practices that are missing population data
-    practices = pd.read_csv(settings.CSV_DIR / "practice_codes.csv", na_filter=False)
-    practices["month"] = pd.to_datetime(practices["month"])
+    if practices is None:
+        practices = load_practices()
     df["month"] = pd.to_datetime(df["month"])
     return df.merge(
         practices,
@@ -95,12 +161,12 @@ def trim_trailing_months(df):
     return df.merge(t2["month"].reset_index(drop=True), on="month", how="inner")
 
 
-def normalise_practice_codes(df, lab_code):
+def normalise_practice_codes(df, lab_code, practice_mapping=None):
     # XXX move to ND data processor
     if lab_code == "nd":
-        prac = pd.read_csv(
-            settings.CSV_DIR / "north_devon_practice_mapping.csv", na_filter=False
-        )
+        if practice_mapping is None:
+            practice_mapping = load_nd_practice_mapping()
+        prac = practice_mapping
 
         df3 = df.copy()
         df3 = df3.merge(
@@ -139,25 +205,30 @@ def anonymise(df):
     return df
 
 
-def report_oddness(df):
-    report = (
-        df.query("result_category > 1")
-        .groupby(["test_code", "lab_id", "result_category"])
-        .count()
-        .reset_index()[["result_category", "lab_id", "test_code", "month"]]
-    )
+def count_results(df):
+    """Count the rows for each test code, lab and result category
+    """
+    return df.groupby(["test_code", "lab_id", "result_category"], observed=True).size()
+
+
+def report_oddness(result_counts):
+    """Print any error codes which make up more than 10% of the results for a
+    test at a lab, given row counts as returned by `count_results`
+    """
+    counts = result_counts.rename("rows").reset_index()
     denominators = (
-        df.groupby(["test_code", "lab_id"])
-        .count()
-        .reset_index()[["lab_id", "test_code", "month"]]
+        counts.groupby(["test_code", "lab_id"], observed=True)["rows"]
+        .sum()
+        .rename("total_rows")
+        .reset_index()
     )
-    report = report.merge(
+    report = counts[counts["result_category"] > 1].merge(
         denominators,
         how="inner",
         left_on=["test_code", "lab_id"],
         right_on=["test_code", "lab_id"],
     )
-    report["percentage"] = report["month_x"] / report["month_y"]
+    report["percentage"] = report["rows"] / report["total_rows"]
     report["result_category"] = report["result_category"].replace(settings.ERROR_CODES)
     odd = report[report["percentage"] > 0.1]
     if len(odd):
@@ -167,40 +238,466 @@ def report_oddness(df):
             print(odd[["result_category", "test_code", "lab_id", "percentage"]])
 
 
-@click.argument("lab_code")
-@click.argument("filename")
-def process_file(lab_code, filename):
+class StageTimer:
+    """Record how long each named stage of some processing takes
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def __call__(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = now - self._last
+        self._last = now
+
+
+def process_lab_file(lab_code, filename, practices=None, practice_mapping=None):
+    """Process the raw data file for a lab, writing the results to the
+    processed data store.
+
+    The file is taken to hold all the lab's data for the months it covers,
+    so partitions for months within that range which it no longer produces
+    any data for are removed.
+
+    Returns the paths of the partitions which were new, changed or removed,
+    and the time taken by each stage. The practices table and North Devon
+    mapping are loaded from disk unless supplied.
+    """
+    timer = StageTimer()
     df = pd.read_csv(filename, na_filter=False)
+    months = pd.to_datetime(df["month"])
+    covering = (months.min(), months.max()) if len(df) else None
+    timer("read")
     df = add_lab_code(df, lab_code)
-    df = normalise_practice_codes(df, lab_code)
+    df = normalise_practice_codes(df, lab_code, practice_mapping=practice_mapping)
+    timer("normalise_practice_codes")
     df = estimate_errors(df)  # XXX can do this earlier in the pipeline
+    timer("estimate_errors")
     df = trim_trailing_months(df)
-    df = trim_practices_and_add_population(df)
-    df = df[
-        [
-            "ccg_id",
-            "count",
-            "error",
-            "lab_id",
-            "month",
-            "practice_id",
-            "practice_name",
-            "result_category",
-            "test_code",
-            "total_list_size",
-        ]
+    timer("trim_trailing_months")
+    df = trim_practices_and_add_population(df, practices=practices)
+    timer("trim_practices_and_add_population")
+    written = write_partitions(df[PROCESSED_COLUMNS], lab_code, covering=covering)
+    timer("write")
+    return written, timer.timings
+
+
+FORCE_OPTION = click.option(
+    "--force", is_flag=True, help="Rebuild even if the inputs haven't changed"
+)
+
+WRITE_ZIP_OPTION = click.option(
+    "--write-zip",
+    is_flag=True,
+    help="Also merge the processed data into all_processed.csv.zip",
+)
+
+
+def get_process_file_inputs(lab_code, filename):
+    """Return the name of the `process_file` stage for `lab_code` and a hash
+    of its inputs
+    """
+    paths = [filename, settings.CSV_DIR / "practice_codes.csv"]
+    if lab_code == "nd":
+        paths.append(settings.CSV_DIR / "north_devon_practice_mapping.csv")
+    return f"process_file:{lab_code}", hash_inputs(paths, {"lab_code": lab_code})
+
+
+@click.argument("lab_code")
+@click.argument("filename")
+@FORCE_OPTION
+def process_file(lab_code, filename, force=False):
+    manifest = Manifest()
+    stage, input_hash = get_process_file_inputs(lab_code, filename)
+    outputs = [get_lab_partitions_dir(lab_code)]
+    if not force and manifest.is_current(stage, input_hash, outputs):
+        print(f"Inputs for {lab_code} unchanged, skipping (use --force to rebuild)")
+        return
+    written, _ = process_lab_file(lab_code, filename)
+    manifest.record(stage, input_hash)
+    print(f"Updated {len(written)} partitions for {lab_code}")
+
+
+# Lookups shared by all the labs processed by `process_all`, set in each
+# worker process by `_init_worker`
+_shared_lookups = {}
+
+
+def _init_worker(lookups):
+    _shared_lookups.update(lookups)
+
+
+def _process_lab_file_in_worker(lab_code, filename):
+    return process_lab_file(lab_code, filename, **_shared_lookups)
+
+
+@click.option(
+    "--lab",
+    "labs",
+    type=(str, str),
+    multiple=True,
+    help="A lab code and the raw data file for that lab; may be repeated",
+)
+@click.option("--workers", type=int, default=None, help="Number of worker processes")
+@FORCE_OPTION
+@WRITE_ZIP_OPTION
+def process_all(labs, workers, force=False, write_zip=False):
+    """Process the raw data files for several labs in parallel and then run
+    `postprocess_files` over the whole store.
+
+    The practices table and North Devon mapping are loaded once and shared
+    with every worker, rather than being re-read for each lab. Labs whose
+    inputs haven't changed since they were last processed are skipped.
+    """
+    timings = {}
+    timer = StageTimer()
+    manifest = Manifest()
+    input_hashes = {}
+    for lab_code, filename in labs:
+        stage, input_hash = get_process_file_inputs(lab_code, filename)
+        outputs = [get_lab_partitions_dir(lab_code)]
+        if force or not manifest.is_current(stage, input_hash, outputs):
+            input_hashes[lab_code] = (stage, input_hash)
+        else:
+            print(f"Inputs for {lab_code} unchanged, skipping")
+    labs = [
+        (lab_code, filename) for lab_code, filename in labs if lab_code in input_hashes
     ]
-    df.to_csv(settings.CSV_DIR / f"{lab_code}_processed.csv", index=False)
+    timer("check_manifest")
+    lookups = {
+        "practices": load_practices(),
+        "practice_mapping": load_nd_practice_mapping(),
+    }
+    timer("load_lookups")
+    timings["overall"] = timer.timings
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(lookups,)
+    ) as executor:
+        futures = {
+            lab_code: executor.submit(_process_lab_file_in_worker, lab_code, filename)
+            for lab_code, filename in labs
+        }
+        for lab_code, future in futures.items():
+            written, timings[lab_code] = future.result()
+            manifest.record(*input_hashes[lab_code])
+            print(f"Updated {len(written)} partitions for {lab_code}")
+    timer("process_labs")
+    postprocess_files((), force=force, write_zip=write_zip)
+    timer("postprocess_files")
+    print()
+    print("Timings (seconds):")
+    with pd.option_context("display.max_rows", None, "display.max_columns", None):
+        print(pd.DataFrame(timings).round(2).fillna(""))
+
+
+def write_practice_labs(potassium_counts):
+    """Write the lab each practice is assigned to in each month (see
+    `data.get_labs_for_practices`) to `practice_labs.csv`, given a list of
+    potassium test counts for chunks of the data
+    """
+    if potassium_counts:
+        counts = pd.concat(potassium_counts)
+        counts = counts.groupby(level=counts.index.names).sum()
+    else:
+        counts = pd.Series(
+            [],
+            name="count",
+            index=pd.MultiIndex.from_arrays(
+                [[], [], []], names=["month", "practice_id", "lab_id"]
+            ),
+        )
+    path = get_practice_labs_path()
+    assign_labs_to_practices(counts).to_csv(path, index=False)
+    describe_csv(path, PRACTICE_LAB_DTYPES)
+
+
+def write_processed_practices(practices):
+    """Write the name and list size of each practice in each month of the
+    processed data (see `data.get_processed_practices`) to
+    `processed_practices.csv`, given a list of them for chunks of the data
+    """
+    path = get_processed_practices_path()
+    if practices:
+        df = pd.concat([chunk.reset_index() for chunk in practices])
+        df = df.drop_duplicates(["month", "practice_id"])
+    else:
+        df = pd.DataFrame(columns=PROCESSED_PRACTICE_COLUMNS)
+    df.to_csv(path, index=False, columns=PROCESSED_PRACTICE_COLUMNS)
+    describe_csv(path, PROCESSED_PRACTICE_DTYPES)
+
+
+def get_summaries_dir():
+    return settings.CSV_DIR / "processed_summaries"
+
+
+class ProcessedDataSummary:
+    """The things `postprocess_files` needs to know about some processed data,
+    built up from one or more chunks of it
+
+    A summary is saved for each processed file, so that when only some files
+    have changed, the others don't need to be read again.
+    """
+
+    def __init__(self):
+        self.schema = SchemaBuilder(PROCESSED_DTYPES)
+        self.result_counts = []
+        self.potassium_counts = []
+        self.practices = []
+
+    def add(self, df):
+        self.schema.add(df)
+        self.result_counts.append(count_results(df))
+        self.potassium_counts.append(count_potassium_tests(df))
+        self.practices.append(get_processed_practices(df))
+
+    def update(self, other):
+        """Add the data `other` summarises to this summary
+        """
+        self.schema.update(other.schema)
+        self.result_counts.extend(other.result_counts)
+        self.potassium_counts.extend(other.potassium_counts)
+        self.practices.extend(other.practices)
+
+    def compact(self):
+        """Combine the counts and practices for each chunk, so there's one of
+        each to save
+        """
+        self.result_counts = sum_counts(self.result_counts)
+        self.potassium_counts = sum_counts(self.potassium_counts)
+        if self.practices:
+            practices = pd.concat(self.practices)
+            self.practices = [practices[~practices.index.duplicated()]]
+
+
+def sum_counts(counts):
+    """Return a list of one Series holding the sum of the Series of counts in
+    `counts`, or an empty list if there aren't any
+    """
+    if not counts:
+        return []
+    counts = pd.concat(counts)
+    return [counts.groupby(level=counts.index.names).sum()]
+
+
+def summarise_file(filename, key, out=None):
+    """Return a `ProcessedDataSummary` of the processed file `filename`, whose
+    contents hash to `key`
+
+    The summary saved for `key` is used if there is one. Otherwise the file is
+    read, and its summary saved. If `out` is given, the file is always read,
+    and its rows written to `out` as CSV, without a header.
+    """
+    path = get_summaries_dir() / f"{key}.pickle"
+    if out is None and path.exists():
+        try:
+            return pickle.loads(path.read_bytes())
+        except Exception:
+            print(f"Couldn't read summary of {filename}, reading it again")
+    summary = ProcessedDataSummary()
+    chunks = read_csv_in_chunks(filename, PROCESSED_DTYPES, usecols=PROCESSED_COLUMNS)
+    for chunk in chunks:
+        if out is not None:
+            chunk.to_csv(out, header=False, index=False, columns=PROCESSED_COLUMNS)
+        summary.add(chunk)
+    summary.compact()
+    path.parent.mkdir(exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_bytes(pickle.dumps(summary))
+    os.replace(tmp_path, path)
+    return summary
+
+
+def remove_old_summaries(keys):
+    """Remove the saved summaries of files other than those whose contents
+    hash to `keys`
+    """
+    for path in get_summaries_dir().glob("*.pickle"):
+        if path.stem not in keys:
+            path.unlink()
 
 
 @click.argument("filenames", nargs=-1)
-def postprocess_files(filenames):
-    df = pd.DataFrame()
-    for filename in filenames:
-        if not filename.endswith("/all_processed.csv"):
-            df = pd.concat([df, pd.read_csv(filename, na_filter=False)], sort=False)
+@FORCE_OPTION
+@WRITE_ZIP_OPTION
+def postprocess_files(filenames, force=False, write_zip=False):
+    """Write the schema sidecar the app uses to load the processed data,
+    along with the practice to lab assignment and the table of practices the
+    app holds separately from the data, and report outlier data. If no
+    filenames are given, these cover all the partitions in the processed data
+    store.
+
+    These are built from a summary of each file (see `ProcessedDataSummary`),
+    so only new or changed files are read. Deployments which ship a single
+    data file rather than the store can pass `--write-zip` to also merge the
+    files into `all_processed.csv.zip`, which reads every file; files passed
+    by name are always merged, as the zip is the only place the app can read
+    them from. Each file is streamed through once, a chunk at a time, so
+    merge time grows linearly with the number of labs and we never hold the
+    combined dataset (or its CSV representation) in memory.
+    """
+    if filenames:
+        write_zip = True
+    else:
+        filenames = [str(path) for path in get_partition_paths()]
+    filenames = [f for f in filenames if not f.endswith("/all_processed.csv")]
+    target_path = get_processed_data_path()
+    manifest = Manifest()
+    stage = "postprocess_files"
+    keys = [hash_inputs([filename]) for filename in filenames]
+    input_hash = hash_inputs(
+        [], {"filenames": filenames, "keys": keys, "write_zip": write_zip}
+    )
+    practice_labs_path = get_practice_labs_path()
+    processed_practices_path = get_processed_practices_path()
+    outputs = [
+        get_schema_path(target_path),
+        practice_labs_path,
+        get_schema_path(practice_labs_path),
+        processed_practices_path,
+        get_schema_path(processed_practices_path),
+    ]
+    if write_zip:
+        outputs.append(target_path)
+    if not force and manifest.is_current(stage, input_hash, outputs):
+        print("Processed files unchanged, skipping (use --force to rebuild)")
+        derive_list_sizes(force=force)
+        return
+    if force:
+        remove_old_summaries(set())
+    summary = ProcessedDataSummary()
+    if write_zip:
+        with zipfile.ZipFile(target_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            # `force_zip64` is required when writing more than 2GiB to a stream
+            with zf.open("all_processed.csv", "w", force_zip64=True) as f:
+                with TextIOWrapper(f, encoding="utf-8", newline="") as out:
+                    out.write(",".join(PROCESSED_COLUMNS) + "\n")
+                    for filename, key in zip(filenames, keys):
+                        summary.update(summarise_file(filename, key, out=out))
+    else:
+        for filename, key in zip(filenames, keys):
+            summary.update(summarise_file(filename, key))
+    remove_old_summaries(set(keys))
+    # The schema describes both the merged file and the store it was built
+    # from
+    write_schema(target_path, summary.schema.build())
+    write_practice_labs(summary.potassium_counts)
+    write_processed_practices(summary.practices)
     # df = anonymise(df)
-    report_oddness(df)
-    df.to_csv(
-        settings.CSV_DIR / f"all_processed.csv.zip", index=False, compression="infer"
+    if summary.result_counts:
+        result_counts = pd.concat(summary.result_counts)
+        report_oddness(result_counts.groupby(level=result_counts.index.names).sum())
+    manifest.record(stage, input_hash)
+    derive_list_sizes(force=force)
+
+
+@FORCE_OPTION
+def derive_list_sizes(force=False):
+    """Write the list size of each practice with data in each month, along
+    with the lab it's assigned to, to `practice_list_sizes.csv`. The app
+    sums these to get the list size denominators for each grouping.
+
+    This only needs the practices table, the practice to lab assignment and
+    the schema of the processed data, so is cheap to re-run after
+    `get_practices`.
+    """
+    practice_data_path = get_practice_data_path()
+    practice_labs_path = get_practice_labs_path()
+    processed_schema_path = get_schema_path(get_processed_data_path())
+    target_path = get_practice_list_sizes_path()
+    manifest = Manifest()
+    stage = "derive_list_sizes"
+    input_hash = hash_inputs(
+        [practice_data_path, practice_labs_path, processed_schema_path]
+    )
+    outputs = [target_path, get_schema_path(target_path)]
+    if not force and manifest.is_current(stage, input_hash, outputs):
+        print("List size inputs unchanged, skipping (use --force to rebuild)")
+        return
+    practice_df = read_csv(
+        practice_data_path, read_schema(practice_data_path), PRACTICE_DTYPES
+    ).dropna()
+    practice_labs = read_csv(
+        practice_labs_path, read_schema(practice_labs_path), PRACTICE_LAB_DTYPES
     )
+    # The practice_id categories of the processed data are all the practices
+    # we have data for
+    processed_schema = read_schema(get_processed_data_path())
+    practices_with_data = processed_schema["columns"]["practice_id"]["categories"]
+    df = get_practice_list_sizes(practice_df, practices_with_data, practice_labs)
+    df.to_csv(target_path, index=False)
+    describe_csv(target_path, PRACTICE_LIST_SIZE_DTYPES)
+    manifest.record(stage, input_hash)
+
+
+def memory_report():
+    """Print the memory the app uses to hold the processed data, in bytes and
+    in bytes per row, both as it's read and in the compact form in which it's
+    held (see `store.compact_processed_data`)
+    """
+    df = load_processed_data()
+    practices = get_processed_practices(df)
+    facts = compact_processed_data(df)
+    print("As read:")
+    print(describe_memory({"processed": df}, len(df)))
+    print()
+    print("As held by the app:")
+    print(describe_memory({"facts": facts, "practices": practices}, len(df)))
+
+
+@FORCE_OPTION
+def build_sqlite(force=False):
+    """Write the processed data to `all_processed.sqlite`, for deployments
+    which use the SQLite query backend (see `backends.py`) rather than
+    holding the whole dataset in memory.
+
+    Rows are read from the same place, and in the same order, as the app
+    loads them: the processed data store if it exists, otherwise
+    `all_processed.csv.zip`.
+    """
+    filenames = [str(path) for path in get_partition_paths()]
+    if not filenames:
+        filenames = [str(get_processed_data_path())]
+    target_path = get_sqlite_path()
+    manifest = Manifest()
+    stage = "build_sqlite"
+    input_hash = hash_inputs(filenames, {"filenames": filenames})
+    if not force and manifest.is_current(stage, input_hash, [target_path]):
+        print("Processed data unchanged, skipping (use --force to rebuild)")
+        return
+    chunks = (
+        chunk
+        for filename in filenames
+        for chunk in read_csv_in_chunks(
+            filename, PROCESSED_DTYPES, usecols=PROCESSED_COLUMNS
+        )
+    )
+    write_sqlite(target_path, chunks)
+    manifest.record(stage, input_hash)
+
+
+@click.argument("sample_size", type=int)
+@FORCE_OPTION
+def write_sample(sample_size, force=False):
+    """Write the processed data for a sample of `sample_size` practices (see
+    `store.sample_practices`) to `samples/processed_<sample_size>.csv`, from
+    which the app reads `data.get_data(sample_size)` without loading the full
+    dataset.
+    """
+    filenames = [str(path) for path in get_partition_paths()]
+    if not filenames:
+        filenames = [str(get_processed_data_path())]
+    target_path = get_sample_path(sample_size)
+    manifest = Manifest()
+    stage = f"write_sample_{sample_size}"
+    input_hash = hash_inputs(filenames, {"filenames": filenames})
+    outputs = [target_path, get_schema_path(target_path)]
+    if not force and manifest.is_current(stage, input_hash, outputs):
+        print("Processed data unchanged, skipping (use --force to rebuild)")
+        return
+    df = load_processed_data()
+    df = df[df["practice_id"].isin(sample_practices(df, sample_size))]
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(target_path, index=False, columns=PROCESSED_COLUMNS)
+    describe_csv(target_path, PROCESSED_DTYPES)
+    manifest.record(stage, input_hash)
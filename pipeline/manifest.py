@@ -0,0 +1,87 @@
+"""Skip pipeline stages whose inputs haven't changed, like `make`.
+
+Each stage records a hash of its input files and parameters in a manifest
+in `CSV_DIR`. When a stage is next run with the same hash, and its outputs
+still exist, the work is skipped.
+
+"""
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+
+import settings
+import store
+
+
+MANIFEST_FILENAME = "pipeline_manifest.json"
+
+# The code which produces the processed data. Changing it invalidates every
+# stage.
+CODE_PATHS = [Path(__file__).parent / "get_data.py", Path(__file__).parent / "write.py"]
+
+# What the pipeline uses from `store.py`, which it shares with the app, to
+# compute what it writes. Only changes to these, rather than to anything in
+# `store.py`, invalidate every stage.
+SHARED_CODE = [
+    store.PROCESSED_DTYPES,
+    store.get_read_dtypes,
+    store.read_csv,
+    store.count_potassium_tests,
+    store.MIN_POTASSIUM_TESTS_FOR_LAB,
+    store.assign_labs_to_practices,
+    store.get_practice_list_sizes,
+    store.get_processed_practices,
+    store.sample_practices,
+]
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_inputs(paths, params=None):
+    """Return a hash of the contents of the files at `paths` (along with the
+    pipeline code itself) and of the JSON-serialisable `params`
+    """
+    digest = hashlib.sha256()
+    for path in list(CODE_PATHS) + list(paths):
+        digest.update(hash_file(path).encode("ascii"))
+    for code in SHARED_CODE:
+        source = inspect.getsource(code) if callable(code) else repr(code)
+        digest.update(source.encode("utf8"))
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode("utf8"))
+    return digest.hexdigest()
+
+
+class Manifest:
+    """The input hashes recorded for each stage of the pipeline
+    """
+
+    def __init__(self):
+        self.path = settings.CSV_DIR / MANIFEST_FILENAME
+        try:
+            with open(self.path) as f:
+                self.stages = json.load(f)
+        except FileNotFoundError:
+            self.stages = {}
+
+    def is_current(self, stage, input_hash, outputs=()):
+        """Return True if `stage` was last run with inputs matching
+        `input_hash`, and all of its `outputs` still exist
+        """
+        return self.stages.get(stage) == input_hash and all(
+            Path(output).exists() for output in outputs
+        )
+
+    def record(self, stage, input_hash):
+        self.stages[stage] = input_hash
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
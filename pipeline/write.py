@@ -0,0 +1,190 @@
+"""Writing the processed data store (see `store.py`), which only the
+pipeline does.
+
+"""
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+from store import ALL_TEST_TOTALS_COLUMNS
+from store import DATE_COLUMNS
+from store import DATE_FORMAT
+from store import MONTHS_PER_PERIOD
+from store import PROCESSED_COLUMNS
+from store import PROCESSED_DTYPES
+from store import ROLLUP_COLUMNS
+from store import get_partition_path
+from store import get_schema_path
+
+
+def write_partitions(df, lab_id, covering=None):
+    """Write `df`, which contains processed data for a single lab, to the
+    store, one partition per month.
+
+    Partitions whose contents haven't changed are left untouched. If
+    `covering` gives the first and last months of the data `df` was processed
+    from, partitions for months in that range which `df` no longer has any
+    data for are removed. Returns the paths of the partitions that were
+    written or removed.
+    """
+    written = []
+    paths = set()
+    for month, month_df in df.groupby("month"):
+        path = get_partition_path(lab_id, month)
+        paths.add(path)
+        content = month_df.to_csv(index=False, columns=PROCESSED_COLUMNS)
+        if path.exists() and path.read_text() == content:
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename so a partially written
+        # partition is never visible to readers
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, path)
+        written.append(path)
+    if covering is not None:
+        first, last = covering
+        for month in pd.period_range(first, last, freq="M").to_timestamp():
+            path = get_partition_path(lab_id, month)
+            if path not in paths and path.exists():
+                path.unlink()
+                written.append(path)
+    return written
+
+
+class SchemaBuilder:
+    """Build up a schema for a dataset from one or more chunks of it
+
+    Each chunk must already have the types given by `dtypes`, with its date
+    columns read as categories of strings in `DATE_FORMAT`.
+    """
+
+    def __init__(self, dtypes, date_columns=DATE_COLUMNS):
+        self.dtypes = dtypes
+        self.date_columns = date_columns
+        self.row_count = 0
+        self.null_counts = {}
+        self.categories = {}
+
+    def add(self, df):
+        self.row_count += len(df)
+        for column in list(self.dtypes) + list(self.date_columns):
+            values = df[column]
+            self.null_counts[column] = (
+                self.null_counts.get(column, 0) + values.isnull().sum()
+            )
+            if values.dtype.name == "category":
+                self.categories.setdefault(column, set()).update(values.cat.categories)
+
+    def update(self, other):
+        """Add the chunks `other` was built from to this schema
+        """
+        self.row_count += other.row_count
+        for column, null_count in other.null_counts.items():
+            self.null_counts[column] = self.null_counts.get(column, 0) + null_count
+        for column, categories in other.categories.items():
+            self.categories.setdefault(column, set()).update(categories)
+
+    def build(self):
+        columns = {}
+        for column, dtype in self.dtypes.items():
+            columns[column] = {"type": str(dtype)}
+            if dtype == "category":
+                columns[column]["categories"] = sorted(self.categories[column])
+        for column in self.date_columns:
+            dates = sorted(self.categories[column])
+            columns[column] = {
+                "type": "date",
+                "format": DATE_FORMAT,
+                "categories": dates,
+                "range": [dates[0], dates[-1]] if dates else None,
+            }
+        for column, null_count in self.null_counts.items():
+            columns[column]["null_count"] = int(null_count)
+        return {"row_count": self.row_count, "columns": columns}
+
+
+def write_schema(csv_path, schema):
+    schema_path = get_schema_path(csv_path)
+    tmp_path = schema_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(schema, f, indent=2)
+    os.replace(tmp_path, schema_path)
+
+
+def write_sqlite(path, chunks):
+    """Write processed data to a SQLite database at `path`, for the app's
+    SQLite query backend
+
+    `chunks` is an iterable of DataFrames with the types given by
+    `get_read_dtypes`, so dates are still strings in `DATE_FORMAT`. The data
+    goes in a `processed` table, indexed on the columns we most often filter
+    by, with the totals across all tests in an `all_test_totals` table. Each
+    of these is also rolled up into quarters and years (see `roll_up`), in
+    tables such as `processed_quarter` and `all_test_totals_year`.
+    """
+    tmp_path = path.with_suffix(".tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    connection = sqlite3.connect(tmp_path)
+    try:
+        column_defs = [
+            f'"{column}" INTEGER'
+            if PROCESSED_DTYPES.get(column) == "int64"
+            else f'"{column}" TEXT'
+            for column in PROCESSED_COLUMNS
+        ]
+        connection.execute(f"CREATE TABLE processed ({', '.join(column_defs)})")
+        for chunk in chunks:
+            chunk[PROCESSED_COLUMNS].to_sql(
+                "processed", connection, if_exists="append", index=False
+            )
+        for column in ["month", "practice_id", "test_code"]:
+            connection.execute(
+                f'CREATE INDEX processed_{column} ON processed ("{column}")'
+            )
+        _create_sqlite_totals(
+            connection, "all_test_totals", "processed", ALL_TEST_TOTALS_COLUMNS
+        )
+        for granularity, months_per_period in MONTHS_PER_PERIOD.items():
+            if granularity == "month":
+                continue
+            # Dates are in `DATE_FORMAT`, so we can find the first month of
+            # each period from the year and month
+            period_start = (
+                "substr(\"month\", 1, 5) || printf('%02d', "
+                '(CAST(substr("month", 6, 2) AS INTEGER) - 1) '
+                f"/ {months_per_period} * {months_per_period} + 1) || '-01'"
+            )
+            table = f"processed_{granularity}"
+            _create_sqlite_totals(
+                connection, table, "processed", ROLLUP_COLUMNS, period_start
+            )
+            connection.execute(f'CREATE INDEX {table}_month ON {table} ("month")')
+            _create_sqlite_totals(
+                connection,
+                f"all_test_totals_{granularity}",
+                table,
+                ALL_TEST_TOTALS_COLUMNS,
+            )
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+
+
+def _create_sqlite_totals(connection, table, source, columns, month='"month"'):
+    """Create `table` holding the total count and error in `source` grouped by
+    `columns`, taking the month of each row from the SQL expression `month`
+    """
+    selected = ", ".join(
+        f'{month} AS "month"' if column == "month" else f'"{column}"'
+        for column in columns
+    )
+    grouped = ", ".join(str(i + 1) for i in range(len(columns)))
+    connection.execute(
+        f'CREATE TABLE {table} AS SELECT {selected}, SUM("count") AS "count", '
+        f'SUM("error") AS "error" FROM {source} GROUP BY {grouped}'
+    )
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 # Error/success codes for `result_category` field
@@ -33,11 +34,35 @@ if "DATA_CSVS_PATH" in os.environ:
 else:
     CSV_DIR = Path(__file__).parents[0] / "data_csvs"
 
+# How `data.py` queries the processed data: "pandas" to hold it all in
+# memory, "sqlite" to query the database written by `flask build_sqlite`, or
+# "sharded" to split it by lab across `QUERY_SHARDS` worker processes
+QUERY_BACKEND = os.environ.get("QUERY_BACKEND", "pandas")
+QUERY_SHARDS = int(os.environ.get("QUERY_SHARDS", os.cpu_count()))
+
+# How often, in seconds, the app checks for a new version of the data (see
+# `dataset.py`). Set to zero to only load the data when the app starts
+DATA_RELOAD_INTERVAL = int(os.environ.get("DATA_RELOAD_INTERVAL", 60))
+
+# Whether to load the data in gunicorn's master process, before it forks the
+# workers, so that they share it (see `gunicorn.conf.py`)
+PRELOAD_DATA = os.environ.get("PRELOAD_DATA", "").strip().lower() == "true"
+
+# Where workers coordinate identical queries which arrive at the same time
+# (see `singleflight.py`), and for how long, in seconds, they keep results to
+# share with each other
+SINGLE_FLIGHT_DIR = Path(
+    os.environ.get(
+        "SINGLE_FLIGHT_DIR", Path(tempfile.gettempdir()) / "openpath_single_flight"
+    )
+)
+SINGLE_FLIGHT_RESULT_TIMEOUT = 60
 
 CACHE_CONFIG = {
     # A simple in-memory cache. This app relies on caching as it assumes it's
-    # OK to repeatedly call otherwise expensive functions like `get_data`
-    "CACHE_TYPE": "simple",
+    # OK to repeatedly call otherwise expensive functions like `get_data`. It
+    # records the version of the data each entry is for (see `dataset.py`).
+    "CACHE_TYPE": "dataset.versioned_simple_cache",
     # Set to zero to avoid any time-based expiration. Entries will still be
     # evicted once the cache size exceeds the default threshold.
     "CACHE_DEFAULT_TIMEOUT": 0,
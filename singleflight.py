@@ -0,0 +1,160 @@
+"""Coalesce identical queries which arrive at the same time.
+
+A change to the page state fires several callbacks, which each call
+`data.get_count_data` with the same arguments at almost the same moment. On
+a cold cache, they would all compute the same result in parallel. Functions
+decorated with `single_flight` only compute the result for the first call,
+and other calls with the same arguments wait for it and use its result.
+
+Within a worker, calls wait for each other on a lock, and the result is then
+in the cache. Workers each have their own cache, so across workers calls
+wait on a lock file in `settings.SINGLE_FLIGHT_DIR`. Workers which have to
+wait say so, and then the first worker leaves its result beside the lock
+file for them to read; when nobody is waiting, the result isn't written at
+all. Only workers which were waiting for it read the result, so it isn't a
+cache, and it's removed after `settings.SINGLE_FLIGHT_RESULT_TIMEOUT`
+seconds.
+
+"""
+import fcntl
+import functools
+import hashlib
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+
+from app import cache
+
+import dataset
+import settings
+
+
+# A lock for each call in progress in this worker, with the number of
+# threads using it
+_locks = {}
+_locks_lock = threading.Lock()
+
+# When this worker last looked for old results to remove
+_last_removed = 0
+
+
+@contextmanager
+def _thread_lock(key):
+    with _locks_lock:
+        lock, users = _locks.get(key, (threading.Lock(), 0))
+        _locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _locks_lock:
+            lock, users = _locks[key]
+            if users == 1:
+                del _locks[key]
+            else:
+                _locks[key] = (lock, users - 1)
+
+
+def _lock_file(path, blocking=True):
+    """Return a file descriptor holding an exclusive lock on `path`, or None
+    if `blocking` is False and another process holds it
+    """
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        # Whoever held the lock before us may have removed the file (see
+        # `_remove_old_results`), in which case we have to lock the new one
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def _written_since(path, since):
+    try:
+        return path.stat().st_mtime >= since
+    except FileNotFoundError:
+        return False
+
+
+def _is_recent(path):
+    return _written_since(path, time.time() - settings.SINGLE_FLIGHT_RESULT_TIMEOUT)
+
+
+def _remove_old_results():
+    global _last_removed
+    now = time.time()
+    if now - _last_removed < settings.SINGLE_FLIGHT_RESULT_TIMEOUT:
+        return
+    _last_removed = now
+    for lock_path in settings.SINGLE_FLIGHT_DIR.glob("*.lock"):
+        paths = [lock_path.with_suffix(".pickle"), lock_path.with_suffix(".waiting")]
+        if any(_is_recent(path) for path in [lock_path] + paths):
+            continue
+        fd = _lock_file(lock_path, blocking=False)
+        if fd is None:
+            continue
+        try:
+            if not any(_is_recent(path) for path in paths):
+                for path in paths:
+                    if path.exists():
+                        path.unlink()
+                lock_path.unlink()
+        finally:
+            os.close(fd)
+
+
+def _call_once_across_workers(f, name, args, kwargs):
+    settings.SINGLE_FLIGHT_DIR.mkdir(parents=True, exist_ok=True)
+    lock_path = settings.SINGLE_FLIGHT_DIR / f"{name}.lock"
+    result_path = settings.SINGLE_FLIGHT_DIR / f"{name}.pickle"
+    waiting_path = settings.SINGLE_FLIGHT_DIR / f"{name}.waiting"
+    started = time.time()
+    fd = _lock_file(lock_path, blocking=False)
+    waited_since = None
+    if fd is None:
+        # Another worker is computing the result, so ask it to share it
+        waited_since = started
+        waiting_path.touch()
+        fd = _lock_file(lock_path)
+    try:
+        if waited_since and _written_since(result_path, waited_since):
+            result = pickle.loads(result_path.read_bytes())
+            cache.set(f.make_cache_key(f.uncached, *args, **kwargs), result)
+            return result
+        result = f(*args, **kwargs)
+        # Only pickle the result when another worker is waiting for it
+        if _written_since(waiting_path, started):
+            tmp_path = result_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_bytes(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+            os.replace(tmp_path, result_path)
+    finally:
+        os.close(fd)
+    _remove_old_results()
+    return result
+
+
+def single_flight(f):
+    """Decorate `f`, which must be memoized, so that concurrent calls with the
+    same arguments (and version of the data) only compute its result once
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        key = dataset.get_call_key(f, args, kwargs)
+        name = hashlib.md5(repr(key).encode()).hexdigest()
+        with _thread_lock(name):
+            result = cache.get(f.make_cache_key(f.uncached, *args, **kwargs))
+            if result is not None:
+                return result
+            return _call_once_across_workers(f, name, args, kwargs)
+
+    return wrapper
@@ -14,6 +14,7 @@ from dash.exceptions import PreventUpdate
 import dash_html_components as html
 
 from app import app
+import layout
 from data import get_org_list
 from apps.base import toggle_entity_id_list_from_click_data
 from apps.base import humanise_column_name
@@ -38,6 +39,51 @@ def get_state(possible_state_text):
     return state
 
 
+def get_url_state(pathname):
+    """Return the page state described by `pathname`, raising `NotFound` if
+    it isn't one of our URLs
+    """
+    _, url_state = urls.match(pathname)
+    # The range of months and the granularity are optional, so clear any
+    # we had before if the URL doesn't have them
+    url_state.setdefault("month_from", "")
+    url_state.setdefault("month_to", "")
+    url_state.setdefault("granularity", "")
+    return url_state
+
+
+def get_state_from_url(pathname, query_string):
+    """Return the page state for a URL supplied by the user, as it will be
+    once the inputs have been updated to match it
+    """
+    state = {"update_counter": 0}
+    try:
+        update_state(state, **get_url_state(pathname))
+    except NotFound:
+        update_state(state, error=get_not_found_error(pathname))
+    query = get_query(query_string)
+    update_state(
+        state,
+        highlight_entities=query.get("highlight_entities", []),
+        practice_ids_for_practice_filter=query.get(
+            "practice_ids_for_practice_filter", []
+        ),
+    )
+    state.pop("_dirty", None)
+    return state
+
+
+def get_query(query_string):
+    """Return the parameters in `query_string`, which starts with "?", or is
+    empty
+    """
+    return query_string and urllib.parse.parse_qs(query_string[1:]) or {}
+
+
+def get_not_found_error(pathname):
+    return {"status_code": 404, "message": f"Unable to find page at {pathname}"}
+
+
 def update_state(state, **kw):
     """Update `state` with keyword values, if they are different from
     current values, and non-null. Keyword values of None or empty
@@ -79,26 +125,6 @@ def update_url_from_page_state(page_state):
     return url
 
 
-@app.callback(
-    [
-        Output("measurements-fieldset", "style"),
-        Output("groupby-label", "children"),
-        Output("groupby-dropdown", "options"),
-    ],
-    [Input("chart-selector-tabs", "active_tab")],
-)
-def toggle_numerator_denominator_visibility(active_tab):
-    if active_tab == "measure":
-        display = "none"
-        groupby_label = "Compare by"
-        dropdown_options = settings.CORE_DROPDOWN_OPTIONS
-    else:
-        display = "block"
-        groupby_label = "Compare by"
-        dropdown_options = settings.ANALYSE_DROPDOWN_OPTIONS
-    return [{"display": display}, groupby_label, dropdown_options]
-
-
 @app.callback(
     Output("org-focus-label", "children"), [Input("groupby-dropdown", "value")]
 )
@@ -119,7 +145,8 @@ def _select_value_from_url(selector_id, page_state_key, url, is_multi=False):
             logger.info("****-> %s", current_value)
             value = is_multi and [current_value] or current_value
     except NotFound:
-        value = default
+        # Leave the dropdown as it is; the error is shown from the page state
+        return False, current_value
     changed = value != current_value or using_default
     return changed, value
 
@@ -146,14 +173,6 @@ def update_org_filter_dropdowns(groupby, url):
     return [selected_labs, selected_ccgs]
 
 
-@app.callback(Output("org-focus-form", "style"), [Input("groupby-dropdown", "value")])
-def show_or_hide_org_focus_dropdown(groupby_selector):
-    if groupby_selector in ["practice_id", "ccg_id", "lab_id"]:
-        return {"display": "block"}
-    else:
-        return {"display": "none"}
-
-
 @app.callback(
     Output("page-state", "children"),
     [
@@ -205,16 +224,9 @@ def update_state_from_inputs(
     if "error" in page_state:
         del page_state["error"]
     try:
-        _, url_state = urls.match(current_path)
-        update_state(page_state, **url_state)
+        update_state(page_state, **get_url_state(current_path))
     except NotFound:
-        update_state(
-            page_state,
-            error={
-                "status_code": 404,
-                "message": f"Unable to find page at {current_path}",
-            },
-        )
+        update_state(page_state, error=get_not_found_error(current_path))
     # The value of `selected_denominator` (derived from the dropdown
     # with id `denominators-dropdown`) is a mixture of things which
     # (hopefully) belong together from the user's point of view, but
@@ -289,10 +301,7 @@ def _get_dropdown_current_value_by_id(component_id):
     options
 
     """
-    component = None
-    for _, component in app.layout._traverse_with_paths():
-        if getattr(component, "id", None) == component_id:
-            break
+    component = layout.components_by_id.get(component_id)
     if component is not None:
         if hasattr(component, "value"):
             using_default = False
@@ -304,104 +313,86 @@ def _get_dropdown_current_value_by_id(component_id):
         return ""
 
 
-def _create_dropdown_update_func(selector_id, page_state_key, default, is_multi):
-    """Create a callback function that updates a dropdown based on the current URL
+def _get_denominators_dropdown_value_from_url(pathname):
+    """Return the value of the denominators dropdown for the current page
+    location, or `dash.no_update` if it already has that value
     """
+    using_default, current_value = _get_dropdown_current_value_by_id(
+        "denominators-dropdown"
+    )
+    try:
+        _, url_state = urls.match(pathname)
+        # if it's raw, per1000 or other, leave as-is
+        # otherwise, pick based on the result_filter
+        if "denominators" in url_state:
+
+            first_part = url_state["denominators"][0]
+            if first_part in ["per1000", "raw"]:
+                val = first_part
+            elif url_state["result_filter"] != "all":
+                val = url_state["result_filter"]
+            else:
+                val = "other"
+        else:
+            # default for when someone visits /apps/decile (for example)
+            val = "per1000"
+    except NotFound:
+        val = "per1000"
+    if val == current_value:
+        return dash.no_update
+    return val
 
-    def update_dropdown_from_url(pathname):
-        """Cause the specified multi dropdown to match the current page location
-        """
-        if pathname:
-            changed, val = _select_value_from_url(
-                selector_id, page_state_key, pathname, is_multi=is_multi
-            )
-            if not changed:
-                raise PreventUpdate
-            logger.info(
-                "-- multi dropdown %s being set to %s from URL %s",
-                selector_id,
-                val,
-                pathname,
-            )
-            return val
-        raise PreventUpdate
 
-    return update_dropdown_from_url
+def _get_chart_selector_tab_from_url(pathname):
+    try:
+        _, url_state = urls.match(pathname)
+        return url_state.get("page_id", "measure")
+    except NotFound:
+        return "measure"
 
 
-for selector_id, page_state_key, default, is_multi in [
-    ("numerators-dropdown", "numerators", None, True),
-    ("denominator-tests-dropdown", "denominators", "", True),
-    ("groupby-dropdown", "groupby", "lab_id", False),
-]:
-    app.callback(Output(selector_id, "value"), [Input("url-from-user", "pathname")])(
-        _create_dropdown_update_func(selector_id, page_state_key, default, is_multi)
-    )
+# The dropdowns which are set from the URL, with the key of the page state
+# they're set from, and whether they're multi-selects
+URL_DROPDOWNS = [
+    ("numerators-dropdown", "numerators", True),
+    ("denominator-tests-dropdown", "denominators", True),
+    ("groupby-dropdown", "groupby", False),
+]
 
 
 @app.callback(
-    Output("chart-selector-tabs", "active_tab"), [Input("url-from-user", "pathname")]
-)
-def update_chart_selector_tabs_from_url(pathname):
-    if pathname:
-        # Sometimes None for reasons explained here:
-        # https://github.com/plotly/dash/issues/133#issuecomment-330714608
-        try:
-            _, url_state = urls.match(pathname)
-            return url_state.get("page_id", "measure")
-        except NotFound:
-            return "measure"
-    raise PreventUpdate
-
-
-# XXX can I use the _create_multi_dropdown_update_func pattern above for this?
-@app.callback(
-    Output("denominators-dropdown", "value"), [Input("url-from-user", "pathname")]
+    [Output(selector_id, "value") for selector_id, _, _ in URL_DROPDOWNS]
+    + [
+        Output("denominators-dropdown", "value"),
+        Output("chart-selector-tabs", "active_tab"),
+    ],
+    [Input("url-from-user", "pathname")],
 )
-def update_denominator_dropdown_from_url(pathname):
-    """Cause the denom dropdown to match the current page location
+def update_inputs_from_url(pathname):
+    """Cause the inputs to match the current page location
+
+    They're all set by one callback, rather than one callback per input, to
+    keep down the requests a page load makes.
     """
-    logger.info("-- denom dropdown being set from URL %s", pathname)
-    val = None
-    if pathname:
-        # Sometimes None for reasons explained here:
-        # https://github.com/plotly/dash/issues/133#issuecomment-330714608
-        using_default, current_value = _get_dropdown_current_value_by_id(
-            "denominators-dropdown"
-        )
-        try:
-            _, url_state = urls.match(pathname)
-            # if it's raw, per1000 or other, leave as-is
-            # otherwise, pick based on the result_filter
-            if "denominators" in url_state:
-
-                first_part = url_state["denominators"][0]
-                if first_part in ["per1000", "raw"]:
-                    val = first_part
-                elif url_state["result_filter"] != "all":
-                    val = url_state["result_filter"]
-                else:
-                    val = "other"
-            else:
-                # default for when someone visits /apps/decile (for example)
-                val = "per1000"
-        except NotFound:
-            val = "per1000"
-    if not val or val == current_value:
+    # Sometimes None for reasons explained here:
+    # https://github.com/plotly/dash/issues/133#issuecomment-330714608
+    if not pathname:
         raise PreventUpdate
-    else:
-        return val
-
-
-@app.callback(
-    Output("denominator-tests-dropdown", "style"),
-    [Input("denominators-dropdown", "value")],
-)
-def show_or_hide_denominators_multi_dropdown(denominators_selector):
-    if denominators_selector == "other":
-        return {"display": "block"}
-    else:
-        return {"display": "none"}
+    values = []
+    for selector_id, page_state_key, is_multi in URL_DROPDOWNS:
+        changed, val = _select_value_from_url(
+            selector_id, page_state_key, pathname, is_multi=is_multi
+        )
+        if changed:
+            logger.info(
+                "-- dropdown %s being set to %s from URL %s", selector_id, val, pathname
+            )
+            values.append(val)
+        else:
+            values.append(dash.no_update)
+    values.append(_get_denominators_dropdown_value_from_url(pathname))
+    values.append(_get_chart_selector_tab_from_url(pathname))
+    return values
 
 
 @app.callback(Output("error-container", "children"), [Input("page-state", "children")])
@@ -427,12 +418,19 @@ def show_error_from_page_state(page_state):
     [State("url-for-update", "search"), State("url-from-user", "search")],
 )
 def update_highlight_entities_querystring(page_state, current_qs, supplied_qs):
+    """Cause the query string to match the parts of the current page state
+    which aren't in the path: the highlighted organisations, and the
+    practices data is limited to
+    """
     page_state = get_state(page_state)
-    highlight_entities = page_state.get("highlight_entities", [])
+    query = {
+        "highlight_entities": page_state.get("highlight_entities", []),
+        "practice_ids_for_practice_filter": page_state.get(
+            "practice_ids_for_practice_filter", []
+        ),
+    }
     # XXX possibly raise a NotUpdate if there's no change
-    qs = "?" + urlencode(
-        {"highlight_entities": highlight_entities}, doseq=True, quote_via=quote_plus
-    )
+    qs = "?" + urlencode(query, doseq=True, quote_via=quote_plus)
     return qs
 
 
@@ -452,7 +450,7 @@ def update_org_focus_from_heatmap_click_or_query_string(
 
     page_state = get_state(page_state)
     # XXX what is current_qs any use for
-    query_string = supplied_qs and urllib.parse.parse_qs(supplied_qs[1:]) or {}
+    query_string = get_query(supplied_qs)
     ctx = dash.callback_context
     triggered_inputs = [x["prop_id"].split(".")[0] for x in ctx.triggered]
     if "heatmap-graph" in triggered_inputs:
@@ -498,13 +496,24 @@ def filter_org_focus_dropdown(ccg_ids, lab_ids, groupby):
         Output("practice-dropdown", "value"),
     ],
     [Input("url-from-user", "hash"), Input("groupby-dropdown", "value")],
-    [State("page-state", "children"), State("org-focus-dropdown", "value")],
+    [
+        State("page-state", "children"),
+        State("org-focus-dropdown", "value"),
+        State("url-from-user", "search"),
+    ],
 )
-def toggle_org_filter_form(filter_link, groupby, page_state, org_focus):
+def toggle_org_filter_form(filter_link, groupby, page_state, org_focus, supplied_qs):
     page_state = get_state(page_state)
     ccg_ids = page_state.get("ccg_ids_for_practice_filter", ["all"])
     lab_ids = page_state.get("lab_ids_for_practice_filter", ["all"])
-    practice_ids = page_state.get("practice_ids_for_practice_filter", ["all"])
+    # A URL from the user may limit the data to some practices before the
+    # page state does
+    supplied_practice_ids = get_query(supplied_qs).get(
+        "practice_ids_for_practice_filter", []
+    )
+    practice_ids = page_state.get(
+        "practice_ids_for_practice_filter", supplied_practice_ids or ["all"]
+    )
     show = {"display": "block"}
     hide = {"display": "none"}
     practice_ids_for_practice_filter = []
@@ -544,7 +553,7 @@ def toggle_org_filter_form(filter_link, groupby, page_state, org_focus):
             # If someone has focussed on one practice, assume they is
             # only interested in data from that one practice when
             # grouping by test or result type
-            practice_ids_for_practice_filter = org_focus
+            practice_ids_for_practice_filter = supplied_practice_ids or org_focus
 
     else:
         link_show = show
@@ -562,26 +571,63 @@ def toggle_org_filter_form(filter_link, groupby, page_state, org_focus):
     ]
 
 
-# for each chart, generate a function to show only that chart
-def _create_show_chart_func(chart):
-    """Generate a callback function which toggles visibility of the page_id
-    specified in the current page state
-    """
+SHOW = {"display": "block"}
+HIDE = {"display": "none"}
 
-    def show_chart(page_state):
-        page_state = get_state(page_state)
-        if page_state.get("page_id") == chart:
-            return {"display": "block"}
-        else:
-            return {"display": "none"}
+# Outputs which only depend on the value of one input, and so are set by
+# callbacks which run in the browser, rather than by a request to the app.
+# For each output: the input it depends on, its value for particular values
+# of the input, and its value for any other value
+CLIENTSIDE_OUTPUTS = [
+    (
+        Output("measurements-fieldset", "style"),
+        Input("chart-selector-tabs", "active_tab"),
+        {settings.MEASURE_ID: HIDE},
+        SHOW,
+    ),
+    (
+        Output("groupby-dropdown", "options"),
+        Input("chart-selector-tabs", "active_tab"),
+        {settings.MEASURE_ID: settings.CORE_DROPDOWN_OPTIONS},
+        settings.ANALYSE_DROPDOWN_OPTIONS,
+    ),
+    (
+        Output("org-focus-form", "style"),
+        Input("groupby-dropdown", "value"),
+        {"practice_id": SHOW, "ccg_id": SHOW, "lab_id": SHOW},
+        HIDE,
+    ),
+    (
+        Output("denominator-tests-dropdown", "style"),
+        Input("denominators-dropdown", "value"),
+        {"other": SHOW},
+        HIDE,
+    ),
+] + [
+    # Only show the page for the selected tab
+    (
+        Output(f"{page_id}-container", "style"),
+        Input("chart-selector-tabs", "active_tab"),
+        {page_id: SHOW},
+        HIDE,
+    )
+    for page_id in settings.PAGES
+]
 
-    return show_chart
 
+def _create_clientside_lookup(values, otherwise):
+    """Return the source of a clientside callback function which looks up
+    the value of its input in `values`, returning `otherwise` if it's missing
+    """
+    return f"""
+    function(value) {{
+        var values = {json.dumps(values)};
+        return values.hasOwnProperty(value) ? values[value] : {json.dumps(otherwise)};
+    }}
+    """
 
-# Register callbacks such that when the page state changes, only the
-# page id currently indicated in the page state is shown
-for page_id in settings.PAGES:
-    app.callback(
-        Output("{}-container".format(page_id), "style"),
-        [Input("page-state", "children")],
-    )(_create_show_chart_func(page_id))
+
+for output, input_, values, otherwise in CLIENTSIDE_OUTPUTS:
+    app.clientside_callback(
+        _create_clientside_lookup(values, otherwise), output, [input_]
+    )
@@ -0,0 +1,607 @@
+"""The processed data store, written by the pipeline (see `pipeline/write.py`)
+and read by the app.
+
+Processed data is partitioned by lab and month, with one CSV per partition
+at `<CSV_DIR>/processed/<lab_id>/<YYYY-MM>.csv`. Labs send us a month of
+data at a time, so a refresh only needs to write the partitions for that
+month rather than rebuilding the whole dataset.
+
+The pipeline also writes a schema sidecar next to each CSV it produces
+(e.g. `all_processed.schema.json`), giving the type of each column, the
+categories of each categorical column, row and null counts, and the range
+of each date column. Loaders use it to read without inferring any types, and
+to check that what they read matches what the pipeline wrote.
+
+"""
+import json
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import CategoricalDtype, union_categoricals
+
+import settings
+
+
+# The columns in each partition, in order
+PROCESSED_COLUMNS = [
+    "ccg_id",
+    "count",
+    "error",
+    "lab_id",
+    "month",
+    "practice_id",
+    "practice_name",
+    "result_category",
+    "test_code",
+    "total_list_size",
+]
+
+# Types used when reading processed data, other than `month`
+PROCESSED_DTYPES = {
+    "ccg_id": "category",
+    "count": "int64",
+    "error": "int64",
+    "lab_id": "category",
+    "practice_id": "category",
+    "practice_name": "category",
+    "result_category": "int64",
+    "test_code": "category",
+    "total_list_size": "int64",
+}
+
+# The columns of the processed data which only depend on the month and
+# practice. The app holds these in a table of practices rather than repeating
+# them on every row (see `compact_processed_data`)
+PROCESSED_PRACTICE_COLUMNS = [
+    "month",
+    "practice_id",
+    "practice_name",
+    "total_list_size",
+]
+
+# Types used when reading `processed_practices.csv`, other than `month`
+PROCESSED_PRACTICE_DTYPES = {
+    column: PROCESSED_DTYPES[column] for column in PROCESSED_PRACTICE_COLUMNS[1:]
+}
+
+# The columns of the compact processed data, and the types to which their
+# integers are downcast
+FACT_COLUMNS = [
+    column
+    for column in PROCESSED_COLUMNS
+    if column not in PROCESSED_PRACTICE_COLUMNS[2:]
+]
+FACT_DTYPES = {"count": "int32", "error": "int32", "result_category": "int8"}
+
+# Types used when reading `practice_codes.csv`, other than `month`
+PRACTICE_DTYPES = {
+    "ccg_id": "category",
+    "practice_id": "category",
+    "practice_name": "category",
+    # Even though list sizes are ints, because we have some NaN values in
+    # the data (i.e. practices without a known list size) we have to use
+    # floats
+    "total_list_size": "float64",
+}
+
+# Types used when reading `practice_labs.csv`, other than `month`
+PRACTICE_LAB_DTYPES = {"practice_id": "category", "lab_id": "category"}
+
+# Types used when reading `practice_list_sizes.csv`, other than `month`
+PRACTICE_LIST_SIZE_DTYPES = dict(PRACTICE_DTYPES, lab_id="category")
+
+# The columns by which totals across all tests are grouped
+ALL_TEST_TOTALS_COLUMNS = [
+    "month",
+    "practice_id",
+    "ccg_id",
+    "lab_id",
+    "result_category",
+]
+
+# The columns by which data rolled up into quarters or years is grouped
+ROLLUP_COLUMNS = ALL_TEST_TOTALS_COLUMNS + ["test_code"]
+
+# The periods which data can be rolled up into, with the number of months in
+# each, their pandas frequency, and how we describe them to users
+MONTHS_PER_PERIOD = {"month": 1, "quarter": 3, "year": 12}
+PERIOD_FREQUENCIES = {"month": "M", "quarter": "Q", "year": "A"}
+PERIOD_FORMATS = {"month": "%b %Y", "quarter": "Q%q %Y", "year": "%Y"}
+
+# The number of potassium tests a practice must send to a lab in a month
+# for it to be assigned to that lab
+MIN_POTASSIUM_TESTS_FOR_LAB = 50
+
+# All our data files have a single date column, holding the first day of
+# the month
+DATE_COLUMNS = ["month"]
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def get_processed_data_path():
+    return settings.CSV_DIR / "all_processed.csv.zip"
+
+
+def get_practice_data_path():
+    return settings.CSV_DIR / "practice_codes.csv"
+
+
+def get_practice_labs_path():
+    return settings.CSV_DIR / "practice_labs.csv"
+
+
+def get_practice_list_sizes_path():
+    return settings.CSV_DIR / "practice_list_sizes.csv"
+
+
+def get_sqlite_path():
+    return settings.CSV_DIR / "all_processed.sqlite"
+
+
+def get_processed_practices_path():
+    return settings.CSV_DIR / "processed_practices.csv"
+
+
+def get_cache_snapshots_dir():
+    return settings.CSV_DIR / "cache_snapshots"
+
+
+def get_sample_path(sample_size):
+    return settings.CSV_DIR / "samples" / f"processed_{sample_size}.csv"
+
+
+def get_schema_path(csv_path):
+    """Return the path of the schema sidecar for the CSV at `csv_path`
+    """
+    name = csv_path.name.split(".")[0]
+    return csv_path.with_name(f"{name}.schema.json")
+
+
+def get_partitions_dir():
+    return settings.CSV_DIR / "processed"
+
+
+def get_lab_partitions_dir(lab_id):
+    return get_partitions_dir() / lab_id
+
+
+def get_partition_path(lab_id, month):
+    return get_lab_partitions_dir(lab_id) / f"{month:%Y-%m}.csv"
+
+
+def get_partition_paths():
+    """Return the paths of all partitions in the store, ordered by lab and
+    month
+    """
+    return sorted(get_partitions_dir().glob("*/*.csv"))
+
+
+def get_served_data_paths():
+    """Return the paths of all the files the app reads its data from, with
+    their schema sidecars, whether or not they exist
+    """
+    csv_paths = [
+        get_processed_data_path(),
+        get_processed_practices_path(),
+        get_practice_list_sizes_path(),
+        get_practice_labs_path(),
+        get_practice_data_path(),
+        settings.CSV_DIR / "test_codes.csv",
+    ]
+    csv_paths += get_partition_paths()
+    csv_paths += sorted((settings.CSV_DIR / "samples").glob("*.csv"))
+    paths = [get_sqlite_path()]
+    for path in csv_paths:
+        paths += [path, get_schema_path(path)]
+    return paths
+
+
+def read_schema(csv_path):
+    """Return the schema for the CSV at `csv_path`, or None if the pipeline
+    didn't write one
+    """
+    try:
+        with open(get_schema_path(csv_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def get_read_dtypes(schema, dtypes, date_columns=DATE_COLUMNS):
+    """Return the dtypes with which to read a CSV, where date columns are read
+    as categories and then parsed by `parse_dates`.
+
+    If we have a schema, the categories of each categorical column are taken
+    from it so pandas doesn't have to work them out. Otherwise we fall back to
+    `dtypes`.
+    """
+    if schema is None:
+        read_dtypes = dict(dtypes)
+        read_dtypes.update({column: "category" for column in date_columns})
+        return read_dtypes
+    read_dtypes = {}
+    for column, spec in schema["columns"].items():
+        if spec["type"] in ("category", "date"):
+            read_dtypes[column] = CategoricalDtype(spec["categories"])
+        else:
+            read_dtypes[column] = spec["type"]
+    return read_dtypes
+
+
+def parse_dates(df, date_columns=DATE_COLUMNS):
+    """Convert date columns read as categories into datetimes, parsing each
+    distinct value once with an explicit format
+    """
+    for column in date_columns:
+        values = df[column].cat.remove_unused_categories()
+        dates = pd.to_datetime(values.cat.categories, format=DATE_FORMAT)
+        df[column] = values.cat.rename_categories(dates).astype("datetime64[ns]")
+    return df
+
+
+def check_schema(df, schema, source):
+    """Raise a ValueError if `df`, read from `source`, doesn't match `schema`
+    """
+    problems = []
+    if len(df) != schema["row_count"]:
+        problems.append(f"expected {schema['row_count']} rows, found {len(df)}")
+    for column, spec in schema["columns"].items():
+        null_count = df[column].isnull().sum()
+        # Values which aren't one of the expected categories are read as
+        # nulls, so this also catches unexpected values
+        if null_count != spec["null_count"]:
+            problems.append(
+                f"expected {spec['null_count']} nulls in {column}, "
+                f"found {null_count}"
+            )
+        if spec["type"] == "date" and spec["range"] and not null_count:
+            date_range = [f"{df[column].min():{DATE_FORMAT}}"]
+            date_range.append(f"{df[column].max():{DATE_FORMAT}}")
+            if date_range != spec["range"]:
+                problems.append(
+                    f"expected {column} in range {spec['range']}, found {date_range}"
+                )
+    if problems:
+        raise ValueError(
+            f"{source} doesn't match its schema ({'; '.join(problems)}). "
+            "Has the pipeline been run to completion?"
+        )
+
+
+def read_csv(path, schema, dtypes, **kwargs):
+    """Read the CSV at `path` using its schema, if it has one, and check the
+    result against it
+    """
+    usecols = list(schema["columns"]) if schema else None
+    df = pd.read_csv(
+        path,
+        dtype=get_read_dtypes(schema, dtypes),
+        usecols=usecols,
+        keep_default_na=False,
+        na_values=[""],
+        **kwargs,
+    )
+    df = parse_dates(df)
+    if schema:
+        check_schema(df, schema, path)
+    return df
+
+
+def read_partitions(paths, schema=None, check=True):
+    """Read the union of the partitions at `paths` into a single DataFrame
+
+    Pass `check=False` when reading only some of the partitions, in which case
+    `schema` is only used for types.
+    """
+    read_dtypes = get_read_dtypes(schema, PROCESSED_DTYPES)
+    frames = [
+        pd.read_csv(path, dtype=read_dtypes, keep_default_na=False, na_values=[""])
+        for path in paths
+    ]
+    # Concatenating categoricals with different categories gives us object
+    # columns, so we combine each column separately
+    columns = {}
+    for column in PROCESSED_COLUMNS:
+        if read_dtypes[column] == "category":
+            columns[column] = union_categoricals(
+                [df[column] for df in frames], sort_categories=True
+            )
+        else:
+            columns[column] = np.concatenate([df[column].values for df in frames])
+    df = parse_dates(pd.DataFrame(columns, columns=PROCESSED_COLUMNS))
+    if schema and check:
+        check_schema(df, schema, get_partitions_dir())
+    return df
+
+
+def load_processed_data():
+    """Return the union of the partitions in the store or, for deployments
+    which only have the merged file, the contents of `all_processed.csv.zip`,
+    sorted by month (see `sort_by_month`)
+    """
+    schema = read_schema(get_processed_data_path())
+    partition_paths = get_partition_paths()
+    if partition_paths:
+        df = read_partitions(partition_paths, schema)
+    else:
+        df = read_csv(get_processed_data_path(), schema, PROCESSED_DTYPES)
+    return sort_by_month(df)
+
+
+def sort_by_month(df):
+    """Return `df` sorted by month, so that a range of months can be found by
+    binary search (see `slice_months`)
+
+    The sort is stable and keeps the index, so each row is still labelled with
+    its position in the data as it was read.
+    """
+    return df.sort_values("month", kind="mergesort")
+
+
+def slice_months(df, month_from=None, month_to=None):
+    """Return the rows of `df`, which must be sorted by month, from
+    `month_from` to `month_to` inclusive (where each bound is only applied if
+    supplied)
+    """
+    months = df["month"].values
+    start = 0
+    end = len(df)
+    if isinstance(months, pd.Categorical):
+        # Compact months (see `compact_processed_data`) are sorted by their
+        # codes, which are positions in the sorted list of months
+        categories = months.categories.values
+        months = months.codes
+        if month_from is not None:
+            month_from = categories.searchsorted(np.datetime64(month_from), "left")
+            start = months.searchsorted(month_from, side="left")
+        if month_to is not None:
+            month_to = categories.searchsorted(np.datetime64(month_to), "right")
+            end = months.searchsorted(month_to, side="left")
+        return df.iloc[start:end]
+    if month_from is not None:
+        start = months.searchsorted(np.datetime64(month_from), side="left")
+    if month_to is not None:
+        end = months.searchsorted(np.datetime64(month_to), side="right")
+    return df.iloc[start:end]
+
+
+def sample_practices(df, sample_size, seed=0):
+    """Return a sorted list of `sample_size` distinct practices in the
+    processed data `df`, chosen at random but always the same for the same
+    data and `seed`
+
+    The sample is stratified by lab: each practice belongs to the lab it sent
+    the most tests to, and each lab's share of the sample is in proportion to
+    its number of practices.
+    """
+    df = df.groupby(["practice_id", "lab_id"], observed=True)["count"].sum()
+    df = df.reset_index().astype({"practice_id": str, "lab_id": str})
+    df = df.sort_values(["practice_id", "lab_id"])
+    df = df.sort_values("count", kind="mergesort")
+    df = df.drop_duplicates("practice_id", keep="last")
+    practices_by_lab = {
+        lab_id: sorted(lab_df["practice_id"]) for lab_id, lab_df in df.groupby("lab_id")
+    }
+    if sample_size >= len(df):
+        return sorted(df["practice_id"])
+    # Give each lab the whole part of its share, and the remaining places to
+    # the labs with the largest fractional parts, working in whole numbers so
+    # that ties are broken by lab_id rather than by rounding errors
+    shares = {
+        lab_id: len(practice_ids) * sample_size
+        for lab_id, practice_ids in practices_by_lab.items()
+    }
+    sizes = {lab_id: share // len(df) for lab_id, share in shares.items()}
+    remainders = sorted(
+        shares, key=lambda lab_id: shares[lab_id] % len(df), reverse=True
+    )
+    for lab_id in remainders[: sample_size - sum(sizes.values())]:
+        sizes[lab_id] += 1
+    random_state = np.random.RandomState(seed)
+    sample = []
+    for lab_id, practice_ids in practices_by_lab.items():
+        chosen = random_state.choice(practice_ids, size=sizes[lab_id], replace=False)
+        sample.extend(str(practice_id) for practice_id in chosen)
+    return sorted(sample)
+
+
+def get_processed_practices(df):
+    """Return the name and list size of each practice in each month of the
+    processed data `df`, indexed by month and practice_id
+
+    These are the same on every row for a practice and month, so we keep the
+    first we find.
+    """
+    df = df[PROCESSED_PRACTICE_COLUMNS].drop_duplicates(["month", "practice_id"])
+    return df.set_index(["month", "practice_id"])
+
+
+def compact_processed_data(df):
+    """Return the processed data `df` as a narrow table of facts, for holding
+    in memory
+
+    Columns which only depend on the month and practice are dropped (see
+    `get_processed_practices`), integers are downcast to `FACT_DTYPES`, and
+    months are held as a category, so that each row only stores a small
+    integer code into the sorted list of months. `expand_processed_data`
+    reverses this.
+    """
+    for column, dtype in FACT_DTYPES.items():
+        limits = np.iinfo(dtype)
+        values = df[column]
+        if len(values) and (values.min() < limits.min or values.max() > limits.max):
+            raise ValueError(f"Values of {column} are too large for {dtype}")
+    facts = df[FACT_COLUMNS].astype(FACT_DTYPES)
+    facts["month"] = pd.Categorical(
+        facts["month"], categories=sorted(facts["month"].unique())
+    )
+    return facts
+
+
+def restore_processed_types(df):
+    """Return `df`, which has some of the columns of the compact processed
+    data in its columns or index, with those columns given the types of the
+    processed data
+    """
+    if isinstance(df.index, pd.MultiIndex):
+        index = df.index.set_levels(
+            [_restore_index_type(level) for level in df.index.levels]
+        )
+    else:
+        index = _restore_index_type(df.index)
+    if index is not df.index:
+        df = df.set_axis(index, axis=0)
+    columns = {}
+    if "month" in df.columns and df["month"].dtype.name == "category":
+        columns["month"] = df["month"].astype("datetime64[ns]")
+    for column in FACT_DTYPES:
+        if column in df.columns and df[column].dtype != PROCESSED_DTYPES[column]:
+            columns[column] = df[column].astype(PROCESSED_DTYPES[column])
+    if columns:
+        df = df.assign(**columns)
+    return df
+
+
+def _restore_index_type(index):
+    if index.name == "month" and index.dtype.name == "category":
+        return pd.DatetimeIndex(np.asarray(index), name="month")
+    dtype = PROCESSED_DTYPES.get(index.name)
+    if index.name in FACT_DTYPES and index.dtype != dtype:
+        return index.astype(dtype)
+    return index
+
+
+def expand_processed_data(facts, practices):
+    """Return the rows of the processed data for rows of the compact processed
+    data `facts`, given the table of `practices` from which they were split
+    """
+    df = restore_processed_types(facts)
+    df = df.join(practices, on=["month", "practice_id"])
+    return df[PROCESSED_COLUMNS]
+
+
+def describe_memory(tables, row_count):
+    """Return the memory used by each of `tables`, a dict of names and
+    DataFrames, in bytes and in bytes per row of data which has `row_count`
+    rows
+    """
+    memory = {
+        name: df.memory_usage(index=True, deep=True).sum()
+        for name, df in tables.items()
+    }
+    report = pd.DataFrame({"bytes": pd.Series(memory, dtype="int64")})
+    report.loc["total"] = report["bytes"].sum()
+    report["bytes_per_row"] = (report["bytes"] / max(row_count, 1)).round(1)
+    return report
+
+
+def sum_counts(df, groupby):
+    """Return the total count and error in `df` grouped by the columns in
+    `groupby`, as 64-bit integers
+
+    pandas sums compact counts as 64-bit integers, only downcasting totals
+    which fit in the original type, so totals can't overflow.
+    """
+    columns = list(groupby) + ["count", "error"]
+    df = df[columns].groupby(list(groupby), observed=True).sum()
+    return df.astype({"count": "int64", "error": "int64"})
+
+
+def get_period_starts(months, granularity):
+    """Return the first month of the `granularity` period (see
+    `MONTHS_PER_PERIOD`) containing each of `months`, a Series of dates
+    """
+    if months.dtype.name == "category":
+        # Find the start of the period for each distinct month only
+        starts = get_period_starts(pd.Series(months.cat.categories), granularity)
+        return pd.Series(starts.values[months.cat.codes.values], index=months.index)
+    if granularity == "month":
+        return months
+    return months.dt.to_period(PERIOD_FREQUENCIES[granularity]).dt.start_time
+
+
+def format_periods(months, granularity):
+    """Return a description (e.g. "Q1 2019") of the `granularity` period
+    starting with each of `months`, a Series of dates
+    """
+    # Formatting periods is slow, so we only format each distinct month once
+    distinct_months = months.drop_duplicates()
+    periods = distinct_months.dt.to_period(PERIOD_FREQUENCIES[granularity])
+    descriptions = periods.dt.strftime(PERIOD_FORMATS[granularity])
+    return months.map(pd.Series(descriptions.values, index=distinct_months.values))
+
+
+def roll_up(df, granularity):
+    """Return the total count and error in `df` for each `granularity` period,
+    grouped by `ROLLUP_COLUMNS` and sorted by month
+
+    Each period is labelled by its first month, so the result can be queried
+    exactly like the monthly data.
+    """
+    columns = ROLLUP_COLUMNS + ["count", "error"]
+    df = df[columns].assign(month=get_period_starts(df["month"], granularity))
+    return sort_by_month(sum_counts(df, ROLLUP_COLUMNS).reset_index())
+
+
+def average_over_periods(df, granularity):
+    """Return the mean of the values in `df`, which is indexed by month and
+    possibly other columns, over the months with data in each `granularity`
+    period, indexed by the first month of each period instead
+
+    Summing list sizes across the months in a period would count each patient
+    several times, so rolled up counts are compared to the average list size.
+    """
+    keys = list(df.index.names)
+    df = df.reset_index()
+    df["month"] = get_period_starts(df["month"], granularity)
+    return df.groupby(keys, observed=True).mean()
+
+
+def total_all_tests(df):
+    """Return the total count and error across all tests in `df`, grouped by
+    `ALL_TEST_TOTALS_COLUMNS` and sorted by month
+    """
+    df = sum_counts(df, ALL_TEST_TOTALS_COLUMNS)
+    return sort_by_month(df.reset_index())
+
+
+def count_potassium_tests(df):
+    """Return the number of potassium tests each practice sent to each lab in
+    each month, as a Series indexed by month, practice_id and lab_id
+    """
+    df = df[df["test_code"] == "K"]
+    return df.groupby(["month", "practice_id", "lab_id"], observed=True)["count"].sum()
+
+
+def assign_labs_to_practices(potassium_counts):
+    """Return a DataFrame mapping (month, practice_id) to a lab_id, given the
+    number of potassium tests each practice sent to each lab (as returned by
+    `count_potassium_tests`)
+
+    Each practice is assigned to the lab where it sent the most potassium
+    tests. Where two labs tie, the one that comes last in lab_id order wins.
+    Practices which sent fewer than `MIN_POTASSIUM_TESTS_FOR_LAB` tests to
+    their lab aren't assigned to any lab.
+    """
+    df = potassium_counts.rename("count").reset_index()
+    df = df.sort_values(["month", "practice_id", "lab_id"])
+    max_counts = df.groupby(["month", "practice_id"], observed=True)["count"].transform(
+        "max"
+    )
+    df = df[df["count"] == max_counts]
+    df = df.drop_duplicates(["month", "practice_id"], keep="last")
+    df = df[df["count"] >= MIN_POTASSIUM_TESTS_FOR_LAB]
+    # We no longer need this column and don't want it accidentally ending up in
+    # any merges
+    return df[["month", "practice_id", "lab_id"]].reset_index(drop=True)
+
+
+def get_practice_list_sizes(practice_df, practices_with_data, practice_labs):
+    """Return the list size of each practice with data in each month, along
+    with the lab it's assigned to in that month (if any)
+    """
+    # If we have no data for a practice at all then we don't want to include it
+    # in our practice data, mainly so that its list size doesn't unfairly
+    # contribute to the CCG list size
+    practice_df = practice_df[practice_df.practice_id.isin(practices_with_data)]
+    return practice_df.merge(practice_labs, how="left", on=["month", "practice_id"])
@@ -0,0 +1,226 @@
+import gc
+import itertools
+import shutil
+import weakref
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+import dataset
+from app import cache
+from backends import shutdown_shards
+from data import get_all_entity_ids
+from data import get_backend
+from data import get_count_data
+from data import get_distinct_values
+from data import get_org_list
+from data import get_processed_schema
+from pipeline.get_data import build_sqlite
+from pipeline.get_data import read_csv_in_chunks
+from pipeline.write import SchemaBuilder
+from pipeline.write import write_partitions
+from pipeline.write import write_schema
+from store import PROCESSED_COLUMNS
+from store import PROCESSED_DTYPES
+from store import get_partition_paths
+from store import get_processed_data_path
+from store import read_schema
+
+
+LABS = {"nd": ["A1", "A2"], "plymouth": ["B1", "A2"]}
+
+
+def make_processed_df(lab_id, practice_ids):
+    data = []
+    months = ["2018-01-01", "2018-02-01", "2018-03-01"]
+    for i, (month, practice_id) in enumerate(itertools.product(months, practice_ids)):
+        ccg_id = "99A" if practice_id.startswith("A") else "99B"
+        for test_code, result_category in [("K", 0), ("K", -1), ("FBC", 0)]:
+            count = 10 + i + result_category
+            data.append(
+                [
+                    ccg_id,
+                    count,
+                    i % 3,
+                    lab_id,
+                    month,
+                    practice_id,
+                    f"{practice_id} SURGERY",
+                    result_category,
+                    test_code,
+                    100 * (i + 1),
+                ]
+            )
+        data.append(
+            [ccg_id, 3, 2, lab_id, month, practice_id, "X", 3, "HB", 100 * (i + 1)]
+        )
+    df = pd.DataFrame(data, columns=PROCESSED_COLUMNS)
+    df["month"] = pd.to_datetime(df["month"])
+    return df
+
+
+def make_practice_df():
+    data = []
+    for month in ["2018-01-01", "2018-02-01", "2018-03-01"]:
+        data.append([month, "A1", "99A", "nd", 1000])
+        data.append([month, "A2", "99A", "plymouth", 2000])
+        data.append([month, "B1", "99B", "plymouth", 1500])
+    df = pd.DataFrame(
+        data, columns=["month", "practice_id", "ccg_id", "lab_id", "total_list_size"]
+    )
+    df["month"] = pd.to_datetime(df["month"])
+    return df
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    with patch("settings.CSV_DIR", tmp_path), patch("dataset._current_version", None):
+        for lab_id, practice_ids in LABS.items():
+            write_partitions(make_processed_df(lab_id, practice_ids), lab_id)
+        schema = SchemaBuilder(PROCESSED_DTYPES)
+        for path in get_partition_paths():
+            for chunk in read_csv_in_chunks(path, PROCESSED_DTYPES):
+                schema.add(chunk)
+        write_schema(get_processed_data_path(), schema.build())
+        build_sqlite()
+        yield tmp_path
+        shutdown_shards()
+
+
+def query_with_backend(backend, fn, *args, **kwargs):
+    return query_all_with_backend(backend, fn, [(args, kwargs)])[0]
+
+
+def query_all_with_backend(backend, fn, calls):
+    # Cached results don't depend on the backend, so we have to start afresh
+    cache.clear()
+    with patch("settings.QUERY_BACKEND", backend):
+        return [fn(*args, **kwargs) for args, kwargs in calls]
+
+
+def sort_rows(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "sharded"])
+@patch("data.get_practice_data")
+@patch("settings.QUERY_SHARDS", 2)
+def test_backends_give_identical_count_data(mock_get_practice_data, backend, store_dir):
+    mock_get_practice_data.return_value = make_practice_df()
+    queries = itertools.product(
+        [["K"], ["all"], ["K", "FBC"]],
+        [["per1000"], ["raw"], ["K"], ["all"]],
+        [None, "within_range"],
+        [([], []), (["plymouth"], ["99A"])],
+        ["practice_id", "test_code", "result_category", "ccg_id", "lab_id", None],
+    )
+    calls = []
+    for numerators, denominators, result_filter, (lab_ids, ccg_ids), by in queries:
+        if by is None and denominators not in (["per1000"], ["raw"]):
+            # Test denominators aren't supported for raw rows
+            continue
+        kwargs = {
+            "numerators": numerators,
+            "denominators": denominators,
+            "result_filter": result_filter,
+            "lab_ids_for_practice_filter": lab_ids,
+            "ccg_ids_for_practice_filter": ccg_ids,
+            "by": by,
+        }
+        calls.append(((), kwargs))
+    month_ranges = [("2018-02", "2018-02"), ("2018-02", None), (None, "2018-02")]
+    for (month_from, month_to), by in itertools.product(
+        month_ranges, ["practice_id", "test_code", None]
+    ):
+        kwargs = {
+            "numerators": ["K"],
+            "denominators": ["per1000"],
+            "by": by,
+            "month_from": month_from,
+            "month_to": month_to,
+        }
+        calls.append(((), kwargs))
+    for granularity, denominators, by in itertools.product(
+        ["quarter", "year"],
+        [["per1000"], ["all"], ["K"]],
+        ["practice_id", "test_code", "lab_id"],
+    ):
+        kwargs = {
+            "numerators": ["K"],
+            "denominators": denominators,
+            "by": by,
+            "month_from": "2018-02",
+            "granularity": granularity,
+        }
+        calls.append(((), kwargs))
+    pandas_results = query_all_with_backend("pandas", get_count_data, calls)
+    results = query_all_with_backend(backend, get_count_data, calls)
+    assert all(not df.empty for df in pandas_results)
+    for (_, kwargs), pandas_df, df in zip(calls, pandas_results, results):
+        if kwargs["by"] is None:
+            # The raw rows should be the same rows of the same data
+            assert sorted(pandas_df.index) == sorted(df.index)
+        pd.testing.assert_frame_equal(sort_rows(pandas_df), sort_rows(df))
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "sharded"])
+@patch("settings.QUERY_SHARDS", 2)
+def test_backends_give_identical_entities(backend, store_dir):
+    pandas_ids = query_with_backend("pandas", get_all_entity_ids)
+    ids = query_with_backend(backend, get_all_entity_ids)
+    assert pandas_ids == ids
+    assert pandas_ids["practice_id"] == {"A1", "A2", "B1"}
+    with patch("data.get_practice_data") as mock_get_practice_data:
+        mock_get_practice_data.return_value = make_practice_df().assign(
+            practice_name=lambda df: df["practice_id"] + " SURGERY"
+        )
+        pandas_orgs = query_with_backend(
+            "pandas", get_org_list, "practice_id", lab_ids_filter=["plymouth"]
+        )
+        orgs = query_with_backend(
+            backend, get_org_list, "practice_id", lab_ids_filter=["plymouth"]
+        )
+    assert pandas_orgs == orgs
+    assert [org["value"] for org in pandas_orgs] == ["A2", "B1"]
+
+
+def test_schema_is_read_once_per_version(store_dir):
+    cache.clear()
+    with patch("store.read_schema", wraps=read_schema) as mock_read_schema:
+        get_processed_schema()
+        get_distinct_values("practice_id")
+        get_distinct_values("lab_id")
+        assert mock_read_schema.call_count == 1
+        dataset.load_version("new", lambda: None)
+        get_processed_schema()
+        assert mock_read_schema.call_count == 2
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "sharded"])
+def test_old_version_backend_keeps_its_data(store_dir, backend):
+    with patch("settings.QUERY_BACKEND", backend):
+        old_backend = get_backend()
+        assert old_backend.distinct("lab_id") == ["nd", "plymouth"]
+        # The pipeline removes a lab's data while requests for the old
+        # version are still being answered
+        shutil.rmtree(store_dir / "processed" / "plymouth")
+        build_sqlite(force=True)
+        dataset.load_version("new", get_backend)
+        assert old_backend.distinct("lab_id") == ["nd", "plymouth"]
+        assert get_backend().distinct("lab_id") == ["nd"]
+        # Once requests stop using the old backend, it's released
+        old_backend = weakref.ref(old_backend)
+        gc.collect()
+        assert old_backend() is None
+
+
+def test_entities_come_from_schema(store_dir):
+    cache.clear()
+    with patch("data.get_backend") as mock_get_backend:
+        mock_get_backend.return_value.distinct.return_value = [-1, 0, 3]
+        ids = get_all_entity_ids()
+    # Only columns without categories in the schema need the data
+    mock_get_backend.return_value.distinct.assert_called_once_with("result_category")
+    assert ids["practice_id"] == {"A1", "A2", "B1"}
+    assert ids["lab_id"] == {"nd", "plymouth"}
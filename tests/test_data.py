@@ -1,6 +1,10 @@
 from unittest.mock import patch
 import pandas as pd
+from app import cache
+import data
 from data import get_count_data
+from data import get_filtered_list_sizes
+from data import get_list_sizes
 
 
 def make_df():
@@ -45,3 +49,143 @@ def test_count_data_only_within(mock_get_data):
     mock_get_data.return_value = make_df()
     result = get_count_data(["FBC"], ["per1000"], result_filter="within_range")
     assert result[result["practice_id"] == 1]["calc_value"].iloc[0] == 250
+
+
+@patch("data.get_backend", wraps=data.get_backend)
+@patch("data.get_filtered_list_sizes")
+@patch("data.get_data")
+def test_count_data_shares_aggregates(
+    mock_get_data, mock_get_filtered_list_sizes, mock_get_backend
+):
+    cache.clear()
+    df = make_df()
+    df["month"] = pd.to_datetime(df["month"])
+    mock_get_data.return_value = df
+    mock_get_filtered_list_sizes.return_value = pd.DataFrame(
+        {"total_list_size": [100]}, index=df["month"].drop_duplicates()
+    )
+    fbc_over_hb1 = get_count_data(["FBC"], ["HB1"], by="result_category")
+    assert mock_get_backend.call_count == 2
+    # Both halves of this query were already computed for the one above,
+    # with their roles swapped
+    hb1_over_fbc = get_count_data(["HB1"], ["FBC"], by="result_category")
+    assert mock_get_backend.call_count == 2
+    assert list(fbc_over_hb1["denominator"]) == [30]
+    assert sorted(hb1_over_fbc["denominator"]) == [10, 30]
+
+
+@patch("data.get_all_test_totals", wraps=data.get_all_test_totals)
+@patch("data.get_filtered_list_sizes")
+@patch("data.get_data")
+def test_count_data_all_tests_uses_totals(
+    mock_get_data, mock_get_filtered_list_sizes, mock_get_all_test_totals
+):
+    cache.clear()
+    df = make_df()
+    df["month"] = pd.to_datetime(df["month"])
+    df["ccg_id"] = "99A"
+    df["lab_id"] = "nd"
+    mock_get_data.return_value = df
+    mock_get_filtered_list_sizes.return_value = pd.DataFrame(
+        {"total_list_size": [100]}, index=df["month"].drop_duplicates()
+    )
+    all_tests = get_count_data(["all"], ["per1000"], by="result_category")
+    mock_get_all_test_totals.assert_called()
+    both_tests = get_count_data(["FBC", "HB1"], ["per1000"], by="result_category")
+    pd.testing.assert_frame_equal(all_tests, both_tests)
+    assert sorted(all_tests["numerator"]) == [10, 30, 30]
+
+
+@patch("data.get_filtered_list_sizes")
+@patch("data.get_data")
+def test_count_data_month_range(mock_get_data, mock_get_filtered_list_sizes):
+    cache.clear()
+    df = make_df()
+    df = pd.concat([df.assign(month=month) for month in ["2018-01-01", "2018-02-01"]])
+    df["month"] = pd.to_datetime(df["month"])
+    mock_get_data.return_value = df.reset_index(drop=True)
+    mock_get_filtered_list_sizes.return_value = pd.DataFrame(
+        {"total_list_size": [100, 200]}, index=df["month"].drop_duplicates()
+    )
+    result = get_count_data(["FBC"], ["per1000"], by="test_code")
+    assert list(result["month"].dt.month) == [1, 2]
+    result = get_count_data(
+        ["FBC"], ["per1000"], by="test_code", month_from="2018-02", month_to="2018-02"
+    )
+    assert list(result["month"].dt.month) == [2]
+    assert list(result["calc_value"]) == [200]
+
+
+def make_practice_df():
+    data = [
+        ["2018-01-01", "A1", "99A", "nd", 100],
+        ["2018-01-01", "A2", "99A", "plymouth", 200],
+        ["2018-01-01", "B1", "99B", None, 400],
+        ["2018-02-01", "A1", "99A", "nd", 110],
+        ["2018-02-01", "B1", "99B", "nd", 410],
+    ]
+    df = pd.DataFrame(
+        data, columns=["month", "practice_id", "ccg_id", "lab_id", "total_list_size"],
+    )
+    df["month"] = pd.to_datetime(df["month"])
+    return df
+
+
+@patch("data.get_practice_data")
+def test_list_sizes(mock_get_practice_data):
+    cache.clear()
+    mock_get_practice_data.return_value = make_practice_df()
+    by_lab = get_list_sizes(("month", "lab_id"))
+    assert by_lab[("2018-01-01", "nd")] == 100
+    assert by_lab[("2018-02-01", "nd")] == 520
+    national = get_filtered_list_sizes()["total_list_size"]
+    assert list(national) == [700, 520]
+    by_ccg = get_filtered_list_sizes(ccg_ids=["99B"])["total_list_size"]
+    assert list(by_ccg) == [400, 410]
+    by_lab_and_ccg = get_filtered_list_sizes(lab_ids=["nd"], ccg_ids=["99A"])
+    assert list(by_lab_and_ccg["total_list_size"]) == [100, 110]
+    by_practice = get_filtered_list_sizes(lab_ids=["nd"], practice_ids=["B1"])
+    assert list(by_practice["total_list_size"]) == [410]
+    by_lab_by_quarter = get_list_sizes(("month", "lab_id"), "quarter")
+    assert by_lab_by_quarter[("2018-01-01", "nd")] == 310
+    national_by_quarter = get_filtered_list_sizes(granularity="quarter")
+    assert list(national_by_quarter["total_list_size"]) == [610]
+
+
+@patch("data.get_practice_data")
+@patch("data.get_data")
+def test_count_data_by_quarter(mock_get_data, mock_get_practice_data):
+    cache.clear()
+    data = [
+        ["2018-01-01", "A1", "99A", "nd", 0, "K", 10, 1],
+        ["2018-02-01", "A1", "99A", "nd", 0, "K", 20, 0],
+        ["2018-01-01", "B1", "99B", "nd", 0, "K", 5, 0],
+        ["2018-02-01", "B1", "99B", "nd", 0, "K", 5, 0],
+    ]
+    df = pd.DataFrame(
+        data,
+        columns=[
+            "month",
+            "practice_id",
+            "ccg_id",
+            "lab_id",
+            "result_category",
+            "test_code",
+            "count",
+            "error",
+        ],
+    )
+    df["month"] = pd.to_datetime(df["month"])
+    mock_get_data.return_value = df
+    mock_get_practice_data.return_value = make_practice_df()
+    result = get_count_data(["K"], ["per1000"], by="ccg_id", granularity="quarter")
+    assert list(result["month"]) == [pd.Timestamp("2018-01-01")] * 2
+    assert list(result["numerator"]) == [30, 10]
+    # The list sizes are averaged over the months in the quarter
+    assert list(result["total_list_size"]) == [205, 405]
+    assert result["label"].iloc[0].endswith(" in Q1 2018")
+    # The quarter containing the first month is included in full
+    result = get_count_data(
+        ["K"], ["per1000"], by="ccg_id", granularity="quarter", month_from="2018-02"
+    )
+    assert list(result["numerator"]) == [30, 10]
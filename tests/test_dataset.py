@@ -0,0 +1,341 @@
+import mmap
+import os
+import pickle
+import struct
+import threading
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data
+import dataset
+import store
+from app import cache
+from app import healthz
+from app import ready
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    with patch("settings.CSV_DIR", tmp_path), patch("dataset._current_version", None):
+        cache.clear()
+        yield tmp_path
+
+
+def test_data_version_changes_with_files(data_dir):
+    version = dataset.get_data_version()
+    (data_dir / "test_codes.csv").write_text("datalab_testcode,testname\n")
+    assert dataset.get_data_version() != version
+    version = dataset.get_data_version()
+    (data_dir / "samples").mkdir()
+    (data_dir / "samples" / "processed_10.csv").write_text("month\n")
+    assert dataset.get_data_version() != version
+    # Files the app doesn't read aren't part of the version
+    version = dataset.get_data_version()
+    (data_dir / "pipeline_manifest.json").write_text("{}")
+    assert dataset.get_data_version() == version
+
+
+def test_check_for_new_version(data_dir):
+    path = data_dir / "test_codes.csv"
+    path.write_text("1")
+
+    @cache.memoize(make_name=dataset.versioned_name)
+    def read_data():
+        reads.append(path)
+        return path.read_text()
+
+    def warm():
+        warmed.append(read_data())
+
+    reads = []
+    warmed = []
+    assert read_data() == "1"
+    old_version = dataset.get_version()
+    assert dataset.check_for_new_version(warm) is None
+
+    path.write_text("22")
+    new_version = dataset.get_data_version()
+    # A new version is only loaded once it has stopped changing...
+    assert dataset.check_for_new_version(warm) == new_version
+    assert dataset.get_version() == old_version
+    assert read_data() == "1"
+    # ...and results for it are computed before any requests use it
+    assert dataset.check_for_new_version(warm, new_version) is None
+    assert warmed == ["22"]
+    assert dataset.get_version() == new_version
+    assert read_data() == "22"
+    assert len(reads) == 2
+
+
+def test_failed_load_keeps_current_version(data_dir):
+    version = dataset.get_version()
+    (data_dir / "test_codes.csv").write_text("1")
+    new_version = dataset.get_data_version()
+
+    def warm():
+        assert dataset.get_version() == new_version
+        raise ValueError("Bad data")
+
+    with pytest.raises(ValueError):
+        dataset.check_for_new_version(warm, new_version)
+    assert dataset.get_version() == version
+
+
+def test_cache_snapshot_round_trip(data_dir):
+    path = data_dir / "test_codes.csv"
+    path.write_text("1")
+    reads = []
+
+    @cache.memoize(make_name=dataset.versioned_name)
+    def read_data():
+        reads.append(path)
+        return path.read_text()
+
+    assert read_data() == "1"
+    snapshot_path = dataset.save_cache_snapshot(cache)
+    assert snapshot_path.exists()
+    cache.clear()
+    assert dataset.load_cache_snapshot(cache) > 0
+    assert read_data() == "1"
+    assert len(reads) == 1
+
+    # Snapshots are only loaded for the same versions of the data and code
+    cache.clear()
+    with patch("dataset.get_code_version") as mock_get_code_version:
+        mock_get_code_version.return_value = "other"
+        assert dataset.load_cache_snapshot(cache) == 0
+        dataset.save_cache_snapshot(cache)
+    assert not snapshot_path.exists()
+    path.write_text("22")
+    with patch("dataset._current_version", dataset.get_data_version()):
+        assert dataset.load_cache_snapshot(cache) == 0
+        assert read_data() == "22"
+
+
+@patch("dataset._unsnapshotted_keys", {})
+def test_preloadable_results_arent_snapshotted(data_dir):
+    reads = []
+
+    @dataset.preloadable
+    @cache.memoize(make_name=dataset.versioned_name)
+    def get_all_data():
+        reads.append("all")
+        return "all the data"
+
+    @cache.memoize(make_name=dataset.versioned_name)
+    def get_query_result():
+        reads.append("query")
+        return "a query result"
+
+    get_all_data()
+    get_query_result()
+    dataset.save_cache_snapshot(cache)
+    cache.clear()
+    dataset.load_cache_snapshot(cache)
+    assert get_query_result() == "a query result"
+    assert get_all_data() == "all the data"
+    assert reads == ["all", "query", "all"]
+
+
+@patch("dataset._unsnapshotted_keys", {})
+def test_snapshots_only_hold_the_current_version(data_dir):
+    reads = []
+
+    @dataset.preloadable
+    @cache.memoize(make_name=dataset.versioned_name)
+    def get_all_data():
+        return "all the data"
+
+    @cache.memoize(make_name=dataset.versioned_name)
+    def get_query_result():
+        reads.append(dataset.get_version())
+        return f"a query result for {dataset.get_version()}"
+
+    with patch("dataset._current_version", "old"):
+        get_all_data()
+        get_query_result()
+        dataset.load_version("new", get_query_result)
+        assert dataset._unsnapshotted_keys == {}
+        dataset.save_cache_snapshot(cache)
+        cache.clear()
+        # Only the result for the new version was saved, along with the
+        # version flask-caching gives each memoized function
+        assert dataset.load_cache_snapshot(cache) == 3
+        assert get_query_result() == "a query result for new"
+        assert reads == ["old", "new"]
+
+
+@patch("dataset._snapshot_writer", None)
+def test_only_one_worker_writes_snapshots(data_dir):
+    assert dataset.is_snapshot_writer()
+    assert dataset.is_snapshot_writer()
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(reader)
+            os.write(writer, pickle.dumps(dataset.is_snapshot_writer()))
+            os._exit(0)
+        finally:
+            os._exit(1)
+    os.close(writer)
+    with os.fdopen(reader, "rb") as f:
+        is_writer_in_other_worker = pickle.loads(f.read())
+    assert os.waitpid(pid, 0)[1] == 0
+    assert not is_writer_in_other_worker
+    os.close(dataset._snapshot_writer[1])
+
+
+def test_ready_once_loaded(data_dir):
+    with patch("dataset._ready", threading.Event()):
+        assert healthz() == "OK"
+        assert ready()[1] == 503
+        # Failing to load the data doesn't make the app ready
+        dataset.load(Mock(side_effect=ValueError("Bad data")), cache)
+        assert ready()[1] == 503
+        warm = Mock()
+        dataset.load(warm, cache)
+        warm.assert_called_once_with()
+        assert ready() == "OK"
+
+
+def make_large_processed_df(num_rows):
+    random = np.random.RandomState(0)
+    practice_ids = [f"P{i:04d}" for i in range(500)]
+    months = pd.date_range("2018-01-01", periods=24, freq="MS")
+    df = pd.DataFrame(
+        {
+            "ccg_id": random.choice(["99A", "99B"], num_rows),
+            "count": random.randint(0, 100, num_rows),
+            "error": random.randint(0, 5, num_rows),
+            "lab_id": random.choice(["nd", "plymouth", "cornwall"], num_rows),
+            "month": months[random.randint(0, len(months), num_rows)],
+            "practice_id": random.choice(practice_ids, num_rows),
+            "practice_name": "X",
+            "result_category": random.choice([-1, 0, 1, 2], num_rows),
+            "test_code": random.choice([f"T{i}" for i in range(100)], num_rows),
+            "total_list_size": random.randint(1000, 9000, num_rows),
+        }
+    )
+    for column in ["ccg_id", "lab_id", "practice_id", "practice_name", "test_code"]:
+        df[column] = df[column].astype("category")
+    return store.sort_by_month(df)
+
+
+def get_buffers(df):
+    arrays = [np.asarray(df.index)]
+    for column in df.columns:
+        values = df[column].values
+        arrays.append(getattr(values, "codes", values))
+    return arrays
+
+
+def get_shared_page_fraction(arrays):
+    """Return the fraction of the pages holding `arrays` which this process
+    shares with another, according to the "exclusively mapped" bit of each
+    page's entry in /proc/self/pagemap
+    """
+    shared = total = 0
+    with open("/proc/self/pagemap", "rb") as f:
+        for array in arrays:
+            start = array.ctypes.data // mmap.PAGESIZE
+            end = (array.ctypes.data + array.nbytes - 1) // mmap.PAGESIZE + 1
+            f.seek(start * 8)
+            for (entry,) in struct.iter_unpack("Q", f.read((end - start) * 8)):
+                if entry >> 63 & 1:
+                    total += 1
+                    shared += not (entry >> 56 & 1)
+    return shared / total
+
+
+def get_private_memory():
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Private_Dirty:"):
+                return int(line.split()[1]) * 1024
+
+
+@patch("settings.QUERY_BACKEND", "pandas")
+def test_preloaded_data_isnt_copied_into_the_cache(data_dir):
+    with patch("store.load_processed_data") as mock_load_processed_data:
+        mock_load_processed_data.return_value = make_large_processed_df(1000)
+        dataset.preload(data.get_data)
+    # Only the preloaded frame is held, not a pickled copy in the cache
+    assert data.get_data() is data.get_data()
+    assert len(cache.cache._cache) == 0
+
+
+@patch("settings.QUERY_BACKEND", "pandas")
+def test_new_versions_of_preloaded_data_are_preloaded(data_dir):
+    with patch("store.load_processed_data") as mock_load_processed_data, patch(
+        "data.warm_cache"
+    ):
+        mock_load_processed_data.return_value = make_large_processed_df(100)
+        dataset.load_version("old", data.preload)
+        old_facts = data.get_data()
+        mock_load_processed_data.return_value = make_large_processed_df(200)
+        dataset.load_version("new", data.preload)
+    assert data.get_data() is not old_facts
+    assert data.get_data() is data.get_data()
+    assert len(cache.cache._cache) == 0
+
+
+# How much memory forked workers share depends on the machine and on what
+# else is running, so this is only measured when asked for
+@pytest.mark.skipif(
+    not os.environ.get("MEMORY_BENCHMARKS"),
+    reason="Set MEMORY_BENCHMARKS=true to measure memory sharing",
+)
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/smaps_rollup"), reason="Needs Linux's /proc"
+)
+@patch("settings.QUERY_BACKEND", "pandas")
+def test_preloaded_data_stays_shared_between_workers(data_dir):
+    with patch("store.load_processed_data") as mock_load_processed_data:
+        mock_load_processed_data.return_value = make_large_processed_df(500000)
+        dataset.preload(data.get_data)
+        dataset.preload(data.get_all_test_totals)
+    facts = data.get_data()
+    data_size = facts.memory_usage(deep=True).sum()
+
+    # Fork some workers, and record how much of the data each still shares
+    # with this process, and how much memory of its own it's using, after
+    # each of several rounds of queries
+    workers = []
+    for _ in range(3):
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(reader)
+                backend = data.get_backend()
+                samples = []
+                for _ in range(4):
+                    for groupby in [["month", "practice_id"], ["month", "lab_id"]]:
+                        backend.aggregate(groupby, test_codes=["T1", "T2"])
+                        backend.aggregate(groupby, all_test_totals=True)
+                    samples.append(
+                        (
+                            get_shared_page_fraction(get_buffers(facts)),
+                            get_private_memory(),
+                        )
+                    )
+                os.write(writer, pickle.dumps(samples))
+                os._exit(0)
+            finally:
+                os._exit(1)
+        os.close(writer)
+        workers.append((pid, reader))
+    for pid, reader in workers:
+        with os.fdopen(reader, "rb") as f:
+            samples = pickle.loads(f.read())
+        assert os.waitpid(pid, 0)[1] == 0
+        assert len(samples) == 4
+        assert all(shared > 0.99 for shared, _ in samples)
+        # Once the first queries have allocated working memory, workers don't
+        # keep growing
+        assert samples[-1][1] - samples[1][1] < data_size / 10
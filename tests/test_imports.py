@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from colormaps import COLORMAP_RGB_CODES
+from colormaps import compute_colormap_rgb_codes
+
+
+# What a worker runs to set up the app's callbacks (see `index.py`), with a
+# layout which doesn't need any data
+SETUP_APP = """
+import pandas as pd
+from app import app
+from layout import layout
+app.layout = layout(pd.DataFrame(columns=["value", "label"]), [], [], [])
+import apps.base
+import apps.analyse
+import apps.heatmap
+import apps.datatable
+import apps.measure
+import stateful_routing
+"""
+
+# How long setting up the app may spend importing modules, in seconds
+IMPORT_TIME_BUDGET = 5
+
+# Modules which workers shouldn't need to import at all
+UNWANTED_MODULES = ["matplotlib"]
+
+
+def get_import_times(code):
+    """Return a dict of the time, in seconds, taken to import each module
+    imported when a fresh interpreter runs `code` (including the modules
+    each imports), and the total time spent importing
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=Path(__file__).parents[1],
+        env=dict(os.environ, DEBUG="true"),
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    times = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        seconds = int(cumulative) / 1e6
+        times[name.strip()] = seconds
+        # Modules imported by other modules are indented
+        if not name.startswith("  "):
+            total += seconds
+    return times, total
+
+
+def test_app_imports_within_budget():
+    times, total = get_import_times(SETUP_APP)
+    for module in UNWANTED_MODULES:
+        assert module not in times
+    slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)[:10]
+    summary = "\n".join(f"{name}: {seconds:.3f}s" for name, seconds in slowest)
+    assert total < IMPORT_TIME_BUDGET, f"Slowest imports:\n{summary}"
+
+
+def test_precomputed_colormaps_match_matplotlib():
+    for cmap, rgb_codes in COLORMAP_RGB_CODES.items():
+        assert compute_colormap_rgb_codes(cmap) == rgb_codes
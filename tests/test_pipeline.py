@@ -0,0 +1,241 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+import store
+from app import cache
+from data import get_data
+from pipeline.get_data import postprocess_files
+from pipeline.get_data import process_all
+from pipeline.get_data import process_file
+from pipeline.get_data import process_lab_file
+from pipeline.get_data import read_csv_in_chunks
+from pipeline.get_data import write_sample
+from pipeline.manifest import CODE_PATHS
+from pipeline.manifest import hash_file
+from pipeline.manifest import hash_inputs
+from store import PROCESSED_COLUMNS
+from store import PROCESSED_PRACTICE_COLUMNS
+from store import get_partition_paths
+from store import load_processed_data
+from store import read_partitions
+from store import read_schema
+
+
+def make_processed_df(lab_id, practice_ids):
+    data = []
+    for practice_id in practice_ids:
+        for month in ["2018-01-01", "2018-02-01"]:
+            data.append(["99A", 10, 0, lab_id, month, practice_id, "X", 0, "K", 100])
+            data.append(["99A", 3, 2, lab_id, month, practice_id, "X", 3, "FBC", 100])
+    return pd.DataFrame(data, columns=PROCESSED_COLUMNS)
+
+
+def test_postprocess_files_merges_all_files(tmp_path):
+    write_raw_data(tmp_path)
+    filenames = []
+    expected = []
+    for lab_id, practice_ids in [("nd", ["A1", "A2"]), ("plymouth", ["B1"])]:
+        df = make_processed_df(lab_id, practice_ids)
+        filename = str(tmp_path / f"{lab_id}_processed.csv")
+        df.to_csv(filename, index=False)
+        filenames.append(filename)
+        expected.append(df)
+    with patch("settings.CSV_DIR", tmp_path), patch("pipeline.get_data.CHUNK_SIZE", 3):
+        postprocess_files(filenames)
+    result = pd.read_csv(tmp_path / "all_processed.csv.zip")
+    expected = pd.concat(expected, ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected)
+    # Each practice's name and list size are written once per month
+    practices = pd.read_csv(tmp_path / "processed_practices.csv")
+    assert len(practices) == 6
+    assert list(practices.columns) == PROCESSED_PRACTICE_COLUMNS
+
+
+def write_raw_data(tmp_path):
+    """Write a practices table, North Devon mapping and raw lab files to
+    `tmp_path` and return the (lab_code, filename) pairs for the raw files
+    """
+    practices = []
+    for month in ["2018-01-01", "2018-02-01"]:
+        for practice_id in ["A1", "B1"]:
+            practices.append(["99A", practice_id, f"{practice_id} SURGERY", month, 100])
+    pd.DataFrame(
+        practices,
+        columns=["ccg_id", "practice_id", "practice_name", "month", "total_list_size"],
+    ).to_csv(tmp_path / "practice_codes.csv", index=False)
+    pd.DataFrame([["ND1", "A1"]], columns=["LIMS code", "ODS code"]).to_csv(
+        tmp_path / "north_devon_practice_mapping.csv", index=False
+    )
+    labs = []
+    for lab_code, practice_id in [("nd", "ND1"), ("plymouth", "B1")]:
+        raw = pd.DataFrame(
+            [
+                ["2018-01-01", practice_id, "K", 0, "10"],
+                ["2018-02-01", practice_id, "K", 0, "1-5"],
+            ],
+            columns=["month", "practice_id", "test_code", "result_category", "count"],
+        )
+        filename = str(tmp_path / f"{lab_code}_raw.csv")
+        raw.to_csv(filename, index=False)
+        labs.append((lab_code, filename))
+    return labs
+
+
+def test_process_all(tmp_path):
+    labs = write_raw_data(tmp_path)
+    with patch("settings.CSV_DIR", tmp_path):
+        process_all(labs, workers=2, write_zip=True)
+    list_sizes = pd.read_csv(tmp_path / "practice_list_sizes.csv")
+    assert sorted(list_sizes.practice_id) == ["A1", "A1", "B1", "B1"]
+    # None of the practices send enough potassium tests to be assigned a lab
+    assert list_sizes.lab_id.isnull().all()
+    result = pd.read_csv(tmp_path / "all_processed.csv.zip")
+    result = result.sort_values(["lab_id", "month"]).reset_index(drop=True)
+    assert list(result.columns) == PROCESSED_COLUMNS
+    assert list(result.lab_id) == ["nd", "nd", "plymouth", "plymouth"]
+    assert list(result.practice_id) == ["A1", "A1", "B1", "B1"]
+    assert list(result["count"]) == [10, 3, 10, 3]
+    assert list(result.error) == [0, 2, 0, 2]
+
+
+def test_postprocess_files_only_reads_changed_partitions(tmp_path):
+    labs = write_raw_data(tmp_path)
+
+    def get_partitions_read():
+        paths = [str(call[0][0]) for call in mock_read_csv_in_chunks.call_args_list]
+        mock_read_csv_in_chunks.reset_mock()
+        return [path for path in paths if "/processed/" in path]
+
+    with patch("settings.CSV_DIR", tmp_path), patch(
+        "pipeline.get_data.read_csv_in_chunks", wraps=read_csv_in_chunks
+    ) as mock_read_csv_in_chunks:
+        process_all(labs, workers=1)
+        assert len(get_partitions_read()) == 4
+        # The merged file is only written when asked for
+        assert not (tmp_path / "all_processed.csv.zip").exists()
+        lab_code, filename = labs[1]
+        raw = pd.read_csv(filename)
+        raw.loc[raw.month == "2018-02-01", "count"] = "20"
+        raw.to_csv(filename, index=False)
+        process_all(labs, workers=1)
+        assert get_partitions_read() == [
+            str(tmp_path / "processed" / "plymouth" / "2018-02.csv")
+        ]
+    # What's written is the same as if every partition had been read
+    schema = read_schema(tmp_path / "all_processed.csv.zip")
+    assert schema["row_count"] == 4
+    assert schema["columns"]["practice_id"]["categories"] == ["A1", "B1"]
+    assert len(pd.read_csv(tmp_path / "processed_practices.csv")) == 4
+    assert len(list((tmp_path / "processed_summaries").iterdir())) == 4
+
+
+def test_write_sample(tmp_path):
+    labs = write_raw_data(tmp_path)
+    with patch("settings.CSV_DIR", tmp_path):
+        process_all(labs, workers=1)
+        cache.clear()
+        sampled = get_data(1)
+        write_sample(1)
+        cache.clear()
+        # The sample is read from the file, without loading the full data, and
+        # is the same sample
+        with patch("store.load_processed_data") as mock_load_processed_data:
+            result = get_data(1)
+            mock_load_processed_data.assert_not_called()
+    assert list(result["practice_id"].unique()) == list(sampled["practice_id"].unique())
+    assert len(result) == len(sampled) == 2
+
+
+def test_process_lab_file_only_writes_changed_partitions(tmp_path):
+    labs = write_raw_data(tmp_path)
+    lab_code, filename = labs[1]
+    with patch("settings.CSV_DIR", tmp_path):
+        written, _ = process_lab_file(lab_code, filename)
+        assert [p.name for p in written] == ["2018-01.csv", "2018-02.csv"]
+        written, _ = process_lab_file(lab_code, filename)
+        assert written == []
+        # A lab sending just its latest month only touches that partition
+        raw = pd.read_csv(filename)
+        raw = raw[raw.month == "2018-02-01"].assign(count=20)
+        raw.to_csv(filename, index=False)
+        written, _ = process_lab_file(lab_code, filename)
+        assert [p.name for p in written] == ["2018-02.csv"]
+        df = read_partitions(get_partition_paths())
+    assert list(df["count"]) == [10, 20]
+    assert df["month"].dtype.kind == "M"
+    assert df["lab_id"].dtype.name == "category"
+
+
+def test_process_lab_file_removes_partitions_no_longer_produced(tmp_path):
+    labs = write_raw_data(tmp_path)
+    lab_code, filename = labs[1]
+    with patch("settings.CSV_DIR", tmp_path):
+        process_lab_file(lab_code, filename)
+        # The lab's file now covers two months, but the first no longer has
+        # any data for practices we know about
+        raw = pd.read_csv(filename)
+        raw.loc[raw.month == "2018-01-01", "practice_id"] = "UNKNOWN"
+        raw.to_csv(filename, index=False)
+        written, _ = process_lab_file(lab_code, filename)
+        assert [p.name for p in written] == ["2018-01.csv"]
+        assert [p.name for p in get_partition_paths()] == ["2018-02.csv"]
+
+
+def test_process_file_skips_unchanged_inputs(tmp_path):
+    labs = write_raw_data(tmp_path)
+    lab_code, filename = labs[1]
+    with patch("settings.CSV_DIR", tmp_path), patch(
+        "pipeline.get_data.process_lab_file", wraps=process_lab_file
+    ) as mock_process_lab_file:
+        process_file(lab_code, filename)
+        assert mock_process_lab_file.call_count == 1
+        process_file(lab_code, filename)
+        assert mock_process_lab_file.call_count == 1
+        # Changing files which aren't inputs to this stage doesn't matter
+        (tmp_path / "test_codes.csv").write_text("datalab_testcode,testname\n")
+        process_file(lab_code, filename)
+        assert mock_process_lab_file.call_count == 1
+        process_file(lab_code, filename, force=True)
+        assert mock_process_lab_file.call_count == 2
+        practices = pd.read_csv(tmp_path / "practice_codes.csv")
+        practices.assign(total_list_size=200).to_csv(
+            tmp_path / "practice_codes.csv", index=False
+        )
+        process_file(lab_code, filename)
+        assert mock_process_lab_file.call_count == 3
+
+
+def test_app_code_doesnt_invalidate_stages():
+    with patch("pipeline.manifest.hash_file", wraps=hash_file) as mock_hash_file:
+        hash_inputs([])
+    hashed = {Path(args[0]) for args, _ in mock_hash_file.call_args_list}
+    assert hashed == set(CODE_PATHS)
+    assert Path(store.__file__) not in hashed
+
+
+def test_schema_sidecar(tmp_path):
+    labs = write_raw_data(tmp_path)
+    with patch("settings.CSV_DIR", tmp_path):
+        process_all(labs, workers=1)
+        schema = read_schema(tmp_path / "all_processed.csv.zip")
+        assert schema["row_count"] == 4
+        assert schema["columns"]["lab_id"]["categories"] == ["nd", "plymouth"]
+        assert schema["columns"]["month"]["range"] == ["2018-01-01", "2018-02-01"]
+        df = load_processed_data()
+        assert df["month"].dtype.kind == "M"
+        assert list(df["lab_id"].cat.categories) == ["nd", "plymouth"]
+        # A partition written after the schema (e.g. because
+        # `postprocess_files` wasn't run) is caught when loading
+        lab_code, filename = labs[1]
+        practices = pd.read_csv(tmp_path / "practice_codes.csv")
+        practices = pd.concat([practices, practices.assign(month="2018-03-01")])
+        practices.to_csv(tmp_path / "practice_codes.csv", index=False)
+        raw = pd.read_csv(filename)
+        raw = pd.concat([raw, raw.assign(month="2018-03-01")])
+        raw.to_csv(filename, index=False)
+        assert len(process_lab_file(lab_code, filename)[0]) == 1
+        with pytest.raises(ValueError, match="doesn't match its schema"):
+            load_processed_data()
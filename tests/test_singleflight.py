@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+import dataset
+from app import cache
+from singleflight import single_flight
+
+
+@pytest.fixture
+def flight_dir(tmp_path):
+    with patch("settings.CSV_DIR", tmp_path), patch(
+        "settings.SINGLE_FLIGHT_DIR", tmp_path / "single_flight"
+    ), patch("dataset._current_version", None):
+        cache.clear()
+        yield tmp_path
+
+
+def make_slow_query(calls_path):
+    @single_flight
+    @cache.memoize(make_name=dataset.versioned_name)
+    def slow_query(numerators, by="practice_id"):
+        with open(calls_path, "a") as f:
+            f.write(f"{os.getpid()}\n")
+        time.sleep(0.5)
+        return {"numerators": numerators, "by": by}
+
+    return slow_query
+
+
+def test_concurrent_calls_in_worker_compute_once(flight_dir):
+    calls_path = flight_dir / "calls"
+    slow_query = make_slow_query(calls_path)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(slow_query(["K"])))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [{"numerators": ["K"], "by": "practice_id"}] * 5
+    assert len(calls_path.read_text().splitlines()) == 1
+    # Different arguments are computed separately
+    assert slow_query(["K"], by="lab_id") == {"numerators": ["K"], "by": "lab_id"}
+    assert len(calls_path.read_text().splitlines()) == 2
+
+
+def test_concurrent_calls_across_workers_compute_once(flight_dir):
+    calls_path = flight_dir / "calls"
+    slow_query = make_slow_query(calls_path)
+    pids = []
+    for _ in range(3):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if slow_query(["K"]) == {"numerators": ["K"], "by": "practice_id"}:
+                    # Later calls in the same worker are answered from its cache
+                    slow_query(["K"])
+                    os._exit(0)
+            finally:
+                os._exit(1)
+        pids.append(pid)
+    for pid in pids:
+        assert os.waitpid(pid, 0)[1] == 0
+    assert len(calls_path.read_text().splitlines()) == 1
+    # The result was shared through a file, as other workers were waiting
+    assert len(list((flight_dir / "single_flight").glob("*.pickle"))) == 1
+
+
+def test_uncontended_results_arent_written(flight_dir):
+    calls_path = flight_dir / "calls"
+    slow_query = make_slow_query(calls_path)
+    slow_query(["K"])
+    assert [path.suffix for path in (flight_dir / "single_flight").iterdir()] == [
+        ".lock"
+    ]
+
+
+def test_old_results_are_removed(flight_dir):
+    calls_path = flight_dir / "calls"
+    slow_query = make_slow_query(calls_path)
+    slow_query(["K"])
+    (flight_dir / "single_flight" / "other.pickle").write_bytes(b"")
+    (flight_dir / "single_flight" / "other.lock").write_bytes(b"")
+    with patch("settings.SINGLE_FLIGHT_RESULT_TIMEOUT", 0):
+        slow_query(["FBC"])
+    assert list((flight_dir / "single_flight").iterdir()) == []
@@ -0,0 +1,160 @@
+import pandas as pd
+import pytest
+
+from app import app
+from layout import index_components
+from layout import layout
+from urls import urls
+
+
+@pytest.fixture(scope="module")
+def stateful_routing():
+    tests_df = pd.DataFrame(
+        {"value": ["K", "NA", "CL"], "label": ["Potassium", "Sodium", "Chloride"]}
+    )
+    labs = [{"value": "nd", "label": "N. Devon"}]
+    ccgs = [{"value": "99A", "label": "99A"}]
+    practices = [{"value": "P1", "label": "Practice 1"}]
+    app.layout = layout(tests_df, ccgs, labs, practices)
+    index_components(app.layout)
+    # Set up all the callbacks, as `index.setup_callbacks` does
+    import apps.analyse
+    import apps.datatable
+    import apps.heatmap
+    import apps.measure
+    import stateful_routing
+
+    return stateful_routing
+
+
+def get_dependency_depth(changed_props, target_prop):
+    """Return the most callbacks which run one after another between a change
+    to any of `changed_props` and an update to `target_prop`, or 0 if they
+    don't lead to it
+    """
+    depths = [0]
+    for callback_id, callback in app.callback_map.items():
+        if not any(
+            f"{x['id']}.{x['property']}" in changed_props for x in callback["inputs"]
+        ):
+            continue
+        # Callbacks with several outputs have ids like "..a.b...c.d.."
+        outputs = callback_id.strip(".").split("...")
+        if target_prop in outputs:
+            depths.append(1)
+        else:
+            depth = get_dependency_depth(outputs, target_prop)
+            if depth:
+                depths.append(depth + 1)
+    return max(depths)
+
+
+@pytest.mark.parametrize("figure", ["deciles-graph.figure", "heatmap-graph.figure"])
+def test_charts_are_rendered_straight_from_the_url(stateful_routing, figure):
+    # Dash holds a callback back until every callback upstream of its inputs
+    # has run, so the charts for a URL from the user are only rendered after
+    # one request if nothing else comes between them
+    url_props = ["url-from-user.pathname", "url-from-user.search", "url-from-user.hash"]
+    assert get_dependency_depth(url_props, figure) == 1
+    # Changes to the page state only reach the charts by changing the URL
+    # (see `update_url_from_page_state`), which `url-from-user` follows
+    assert get_dependency_depth(["page-state.children"], figure) == 0
+
+
+def test_state_from_url_includes_the_query_string(stateful_routing):
+    state = stateful_routing.get_state_from_url(
+        "/data/chart/by/test_code/showing/ccg_id/all/lab_id/all/numerators/"
+        "K/denominators/per1000/filter/all",
+        "?highlight_entities=P1&practice_ids_for_practice_filter=P1",
+    )
+    assert state["highlight_entities"] == ["P1"]
+    assert state["practice_ids_for_practice_filter"] == ["P1"]
+
+
+def count_server_requests(changed_props):
+    """Return the most requests the browser can make to the app when
+    `changed_props` change, following each callback's outputs on to the
+    callbacks which take them as inputs
+    """
+    requests = 0
+    called = set()
+    changed_props = set(changed_props)
+    while True:
+        callbacks = [
+            (callback_id, callback)
+            for callback_id, callback in app.callback_map.items()
+            if callback_id not in called
+            and any(
+                f"{x['id']}.{x['property']}" in changed_props
+                for x in callback["inputs"]
+            )
+        ]
+        if not callbacks:
+            return requests
+        for callback_id, callback in callbacks:
+            called.add(callback_id)
+            if "clientside_function" not in callback:
+                requests += 1
+            # Callbacks with several outputs have ids like "..a.b...c.d.."
+            changed_props.update(callback_id.strip(".").split("..."))
+
+
+# The requests each interaction with the page makes, which were 14, 18, 14,
+# 13 and 22 before showing and hiding things was done in the browser
+INTERACTION_REQUESTS = [
+    (["chart-selector-tabs.active_tab"], 10),
+    (["groupby-dropdown.value"], 14),
+    (["denominators-dropdown.value"], 10),
+    (["numerators-dropdown.value"], 10),
+    (["url-from-user.pathname", "url-from-user.search", "url-from-user.hash"], 16),
+]
+
+
+@pytest.mark.parametrize("changed_props,max_requests", INTERACTION_REQUESTS)
+def test_server_requests_per_interaction(stateful_routing, changed_props, max_requests):
+    assert count_server_requests(changed_props) <= max_requests
+
+
+def test_visibility_is_set_in_the_browser(stateful_routing):
+    for output, _, _, _ in stateful_routing.CLIENTSIDE_OUTPUTS:
+        callback = app.callback_map[
+            f"{output.component_id}.{output.component_property}"
+        ]
+        assert "clientside_function" in callback
+
+
+def test_dropdown_defaults_come_from_the_current_layout(stateful_routing):
+    get_default = stateful_routing._get_dropdown_current_value_by_id
+    assert get_default("denominator-tests-dropdown") == (True, "K")
+    # The layout is rebuilt for each new version of the data
+    tests_df = pd.DataFrame({"value": ["NA"], "label": ["Sodium"]})
+    index_components(layout(tests_df, [], [], []))
+    try:
+        assert get_default("denominator-tests-dropdown") == (True, "NA")
+    finally:
+        index_components(app.layout)
+
+
+ANALYSIS_URL = "/data/chart/by/practice_id/showing/ccg_id/all/lab_id/all/numerators/K/denominators/per1000/filter/all"
+
+
+@pytest.mark.parametrize(
+    "suffix,month_from,month_to",
+    [
+        ("/from/2019-01/to/2019-06", "2019-01", "2019-06"),
+        ("/from/2019-01", "2019-01", ""),
+        ("/to/2019-06", "", "2019-06"),
+        ("", "", ""),
+    ],
+)
+def test_month_range_bounds_are_each_optional(
+    stateful_routing, suffix, month_from, month_to
+):
+    for granularity in ["", "quarter"]:
+        url = ANALYSIS_URL + suffix + (f"/per/{granularity}" if granularity else "")
+        url_state = stateful_routing.get_url_state(url)
+        assert url_state["month_from"] == month_from
+        assert url_state["month_to"] == month_to
+        assert url_state["granularity"] == granularity
+        page_state = {k: v for k, v in url_state.items() if v}
+        assert urls.build("analysis", page_state, append_unknown=False) == url
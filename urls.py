@@ -1,3 +1,5 @@
+import itertools
+
 from werkzeug.routing import Map, Rule, Submount
 from werkzeug.routing import UnicodeConverter, BaseConverter, AnyConverter
 
@@ -30,24 +32,40 @@ class FilterEntityConverter(BaseConverter):
     regex = r"(?:ccg_id|lab_id)"
 
 
+class MonthConverter(BaseConverter):
+    regex = r"\d{4}-\d{2}"
+
+
+class GranularityConverter(BaseConverter):
+    regex = r"(?:month|quarter|year)"
+
+
+ANALYSIS_PATH = "/<app:page_id>/by/<groupby_entity_type:groupby>/showing/ccg_id/<list:ccg_ids_for_practice_filter>/lab_id/<list:lab_ids_for_practice_filter>/numerators/<list:numerators>/denominators/<list:denominators>/filter/<string:result_filter>"
+MONTH_FROM_PATH = "/from/<month:month_from>"
+MONTH_TO_PATH = "/to/<month:month_to>"
+GRANULARITY_PATH = "/per/<granularity:granularity>"
+
+# Each of the first and last months and the granularity is optional, so there's
+# a rule for every combination of them. When building URLs, the first rule for
+# which we have all the arguments is used, so rules with more of them come
+# before rules with fewer.
+ANALYSIS_RULES = [
+    Rule(ANALYSIS_PATH + "".join(suffixes), endpoint="analysis")
+    for suffixes in itertools.product(
+        [MONTH_FROM_PATH, ""], [MONTH_TO_PATH, ""], [GRANULARITY_PATH, ""]
+    )
+]
+
+
 url_map = Map(
-    [
-        Submount(
-            "/data",
-            [
-                Rule("/", endpoint="index"),
-                Rule(
-                    "/<app:page_id>/by/<groupby_entity_type:groupby>/showing/ccg_id/<list:ccg_ids_for_practice_filter>/lab_id/<list:lab_ids_for_practice_filter>/numerators/<list:numerators>/denominators/<list:denominators>/filter/<string:result_filter>",
-                    endpoint="analysis",
-                ),
-            ],
-        )
-    ],
+    [Submount("/data", [Rule("/", endpoint="index")] + ANALYSIS_RULES)],
     converters={
         "list": ListConverter,
         "app": AppConverter,
         "groupby_entity_type": GroupByEntityConverter,
         "filter_entity_type": FilterEntityConverter,
+        "month": MonthConverter,
+        "granularity": GranularityConverter,
     },
 )
 